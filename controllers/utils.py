@@ -1293,7 +1293,6 @@ class StudentAdaptiveEncouragementSubscriberHandler(BaseHandler):
         if not student:
             return
 
-        original = student.additional_fields
         if 'subscribe' in self.request.params:
             subscribe = self.request.get('subscribe')
         else:
@@ -1306,37 +1305,11 @@ class StudentAdaptiveEncouragementSubscriberHandler(BaseHandler):
             value = 'No thanks'
 
         if value is not None:
-            new_af = self.replace_value_in_additional_fields(original, 'SendMail', value)
-            if new_af is not None:
-                student.additional_fields = new_af
-                student.put()
+            student.set_additional_field('SendMail', value)
+            student.put()
 
         self.redirect('/student/home')
 
-    def replace_value_in_additional_fields(self, original, token, value):
-        af = None
-        index = original.find(token)
-        if index >= 0:
-            start = original[:index + len(token)]
-            ss = original[index + len(token):]
-            logging.info(start)
-            logging.info(ss)
-            end_index = ss.find('"]')
-            if end_index > 0:
-                end = ss[end_index:]
-                logging.info(end)
-                af = start + '", "' + value + end
-                logging.info('new af:')
-                logging.info(af)
-            else:
-                return None
-        else:
-            tmp = original[:len(original) - 1]
-            af = tmp + ', ["' + token + '", "' + value + '"]]'
-            logging.info('no send mail token found, adding')
-            logging.info(af)
-
-        return af
 
 class StudentMailingListSubscriberHandler(BaseHandler):
     """Handles the subscribing and unsubscribing of being on a mailing list"""
@@ -1347,7 +1320,6 @@ class StudentMailingListSubscriberHandler(BaseHandler):
         if not student:
             return
 
-        original = student.additional_fields
         if 'mlsubscribe' in self.request.params:
             subscribe = self.request.get('mlsubscribe')
         else:
@@ -1360,37 +1332,11 @@ class StudentMailingListSubscriberHandler(BaseHandler):
             value = 'No thanks'
 
         if value is not None:
-            new_af = self.replace_value_in_additional_fields(original, 'MailList', value)
-            if new_af is not None:
-                student.additional_fields = new_af
-                student.put()
+            student.set_additional_field('MailList', value)
+            student.put()
 
         self.redirect('/student/home')
 
-    def replace_value_in_additional_fields(self, original, token, value):
-        af = None
-        index = original.find(token)
-        if index >= 0:
-            start = original[:index + len(token)]
-            ss = original[index + len(token):]
-            logging.info(start)
-            logging.info(ss)
-            end_index = ss.find('"]')
-            if end_index > 0:
-                end = ss[end_index:]
-                logging.info(end)
-                af = start + '", "' + value + end
-                logging.info('new af:')
-                logging.info(af)
-            else:
-                return None
-        else:
-            tmp = original[:len(original) - 1]
-            af = tmp + ', ["' + token + '", "' + value + '"]]'
-            logging.info('no mail list token found, adding')
-            logging.info(af)
-
-        return af
 
 class StudentProfileHandler(BaseHandler):
     """Handles the click to 'Progress' link in the nav bar."""
@@ -1429,20 +1375,19 @@ class StudentProfileHandler(BaseHandler):
 
         #name = student.name
         #apf: original code above in comment, added to take account of name being in additional fields now
-        origin = student.additional_fields
-        sm = self.strip_name_from_additional_fields(origin, 'SendMail')
+        sm = student.get_additional_field('SendMail')
         ae_subscribed = False
         if sm == 'Yes':
             ae_subscribed = True
 
-        ml = self.strip_name_from_additional_fields(origin, 'MailList')
+        ml = student.get_additional_field('MailList')
         ml_subscribed = False
         if ml == 'Yes':
             ml_subscribed = True
 
         if student.name == None or not student.name or student.name.isspace():
-            gn = self.strip_name_from_additional_fields(origin, 'GivenName')
-            fn = self.strip_name_from_additional_fields(origin, 'FamilyName')
+            gn = student.get_additional_field('GivenName')
+            fn = student.get_additional_field('FamilyName')
             name = gn + ' ' + fn
         else:
             name = student.name
@@ -1487,15 +1432,6 @@ class StudentProfileHandler(BaseHandler):
 
         self.render('student_profile.html')
 
-    def strip_name_from_additional_fields(self, origin, token):
-        name = None
-        index = origin.find(token)
-        if index >= 0:
-            ss = origin[index:]
-            end_index = ss.find('"]')
-            if end_index > 0:
-                name = ss[len(token) + 4:end_index]
-        return name
 
 class StudentEditStudentHandler(BaseHandler):
     """Handles edits to student records by students."""
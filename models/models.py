@@ -18,14 +18,17 @@
 
 __author__ = 'Pavel Simakov (psimakov@google.com)'
 
+import ast
 import collections
 import copy
+import cPickle
 import datetime
 import logging
 import os
-import sys
+import threading
 import time
 import webapp2
+import zlib
 
 import jinja2
 
@@ -61,10 +64,40 @@ NO_OBJECT = {}
 # The default amount of time to cache the items for in memcache.
 DEFAULT_CACHE_TTL_SECS = 60 * 5
 
+# The default amount of time to keep items in the process cache for.
+DEFAULT_L1_TTL_SECS = 60
+
 # https://developers.google.com/appengine/docs/python/memcache/#Python_Limits
 MEMCACHE_MAX = (1000 * 1000 - 96 - 250)
 MEMCACHE_MULTI_MAX = 32 * 1000 * 1000
 
+# Values MemcacheManager pickles itself are stored as strings starting with this
+# prefix and a format byte: pickled, compressed, or a manifest of chunks.
+MEMCACHE_PAYLOAD_PREFIX = '\x00gcb-payload:'
+MEMCACHE_PAYLOAD_PICKLED = 'p'
+MEMCACHE_PAYLOAD_COMPRESSED = 'z'
+MEMCACHE_PAYLOAD_CHUNKED = 'c'
+
+# Version of the format of the values MemcacheManager stores. It is part of the
+# memcache namespace of every key, so app versions storing values differently
+# do not read each other's values; bump it whenever the format changes.
+MEMCACHE_FORMAT_VERSION = 2
+
+# Pickled values at least this many bytes long are compressed.
+MEMCACHE_COMPRESS_MIN = 16 * 1000
+
+# Values too big for one item are split into at most this many chunks.
+MEMCACHE_MAX_CHUNKS = 16
+
+# On a cache miss in MemcacheManager.get_or_load(), one caller takes a lease
+# on the key for this long while it loads the value...
+MEMCACHE_LOAD_LEASE_SECS = 10
+# ...and the others wait this long for it, polling first after
+# MEMCACHE_LOAD_POLL_SECS and then twice as long each time, before loading
+# the value themselves.
+MEMCACHE_LOAD_WAIT_SECS = 1.5
+MEMCACHE_LOAD_POLL_SECS = 0.05
+
 # Update frequency for Student.last_seen_on.
 STUDENT_LAST_SEEN_ON_UPDATE_SEC = 15 * 60 # 15 minutes, was originally 1 day #24 * 60 * 60  # 1 day.
 
@@ -80,6 +113,18 @@ CACHE_PUT = PerfCounter(
 CACHE_PUT_TOO_BIG = PerfCounter(
     'gcb-models-cache-put-too-big',
     'Number of times an object was too big to put in memcache.')
+CACHE_PUT_FAILED = PerfCounter(
+    'gcb-models-cache-put-failed',
+    'Number of times memcache did not store an object put into it.')
+CACHE_PUT_BYTES = PerfCounter(
+    'gcb-models-cache-put-bytes',
+    'Number of bytes put into memcache, after pickling and compression.')
+CACHE_PUT_COMPRESSED = PerfCounter(
+    'gcb-models-cache-put-compressed',
+    'Number of objects compressed before they were put into memcache.')
+CACHE_PUT_CHUNKED = PerfCounter(
+    'gcb-models-cache-put-chunked',
+    'Number of objects split into chunks to be put into memcache.')
 CACHE_HIT = PerfCounter(
     'gcb-models-cache-hit',
     'A number of times an object was found in memcache.')
@@ -89,8 +134,52 @@ CACHE_MISS = PerfCounter(
 CACHE_DELETE = PerfCounter(
     'gcb-models-cache-delete',
     'A number of times an object was deleted from memcache.')
+CACHE_LOAD = PerfCounter(
+    'gcb-models-cache-load',
+    'A number of times an object missing from memcache was loaded while '
+    'holding its lease.')
+CACHE_LOAD_COALESCED = PerfCounter(
+    'gcb-models-cache-load-coalesced',
+    'A number of times an object missing from memcache was not loaded because '
+    'another request loaded it.')
+CACHE_LOAD_WAIT_TIMEOUT = PerfCounter(
+    'gcb-models-cache-load-wait-timeout',
+    'A number of times an object missing from memcache was loaded after '
+    'waiting in vain for another request to load it.')
+CACHE_COPY = PerfCounter(
+    'gcb-models-cache-copy',
+    'A number of times a cached object was deep-copied.')
+CACHE_COPY_USEC = PerfCounter(
+    'gcb-models-cache-copy-usec',
+    'Microseconds spent deep-copying cached objects.')
+CACHE_COPY_AVOIDED = PerfCounter(
+    'gcb-models-cache-copy-avoided',
+    'A number of times a cached object was returned or stored without a '
+    'deep copy.')
 
 # performance counters for in-process cache
+ADAPTIVE_ENCOURAGEMENT_WRITES = PerfCounter(
+    'gcb-models-adaptive-encouragement-writes',
+    'A number of adaptive encouragement records written to datastore.')
+ADAPTIVE_ENCOURAGEMENT_WRITES_AVOIDED = PerfCounter(
+    'gcb-models-adaptive-encouragement-writes-avoided',
+    'A number of adaptive encouragement record writes skipped because '
+    'nothing had changed.')
+
+CACHE_HIT_L1 = PerfCounter(
+    'gcb-models-cache-hit-l1',
+    'A number of times an object was found in the process cache.')
+CACHE_MISS_L1 = PerfCounter(
+    'gcb-models-cache-miss-l1',
+    'A number of times an object was not found in the process cache.')
+CACHE_STALE_L1 = PerfCounter(
+    'gcb-models-cache-stale-l1',
+    'A number of times an object in the process cache had expired or been '
+    'invalidated.')
+CACHE_EVICT_L1 = PerfCounter(
+    'gcb-models-cache-evict-l1',
+    'A number of objects evicted from the process cache to make room.')
+
 CACHE_PUT_LOCAL = PerfCounter(
     'gcb-models-cache-put-local',
     'A number of times an object was put into local memcache.')
@@ -105,13 +194,206 @@ CACHE_MISS_LOCAL = PerfCounter(
 WELCOME_NOTIFICATION_INTENT = 'welcome'
 
 
+class ProcessCache(object):
+    """A bounded, process-wide cache in front of memcache for hot key families.
+
+    Only keys in a family registered with MemcacheManager.register_l1_key_prefix
+    are kept. Entries expire after their family's TTL, and the least recently
+    used are evicted past MAX_ENTRIES. Every change or delete of a key in a
+    family increments the family's version stamp in memcache (see
+    MemcacheManager.invalidate_l1); an entry stored under an older stamp is
+    stale. Sets that fill memcache after a miss do not. Each instance reads a stamp at most once
+    every VERSION_CHECK_SECS, so writes on other instances are seen within
+    that time, and writes on this instance at once.
+
+    Entries are shared by all requests of the instance; MemcacheManager copies
+    them as it does values in the readonly local cache.
+    """
+
+    MAX_ENTRIES = 1000
+    VERSION_CHECK_SECS = 1
+
+    _lock = threading.Lock()
+    # (namespace, key) -> (value, expires_at, version)
+    _entries = collections.OrderedDict()
+    # (namespace, prefix) -> (version, checked_at)
+    _versions = {}
+
+    @classmethod
+    def _version_key(cls, prefix):
+        return 'l1-version:%s' % prefix
+
+    @classmethod
+    def get_version(cls, namespace, prefix, now):
+        """Gets a family's version stamp, reading memcache once per period."""
+        cached = cls._versions.get((namespace, prefix))
+        if cached and now - cached[1] < cls.VERSION_CHECK_SECS:
+            return cached[0]
+        key = cls._version_key(prefix)
+        version = memcache.get(key, namespace=namespace)
+        if version is None:
+            # Seeded from the clock, so stamps do not repeat after eviction.
+            version = int(now * 1000)
+            if not memcache.add(key, version, namespace=namespace):
+                version = memcache.get(key, namespace=namespace) or version
+        cls._versions[(namespace, prefix)] = (version, now)
+        return version
+
+    @classmethod
+    def get(cls, namespace, key, prefix):
+        """Returns (True, value) if key has a live entry, else (False, None)."""
+        now = time.time()
+        version = cls.get_version(namespace, prefix, now)
+        with cls._lock:
+            entry = cls._entries.pop((namespace, key), None)
+            if entry is None:
+                CACHE_MISS_L1.inc()
+                return False, None
+            value, expires_at, entry_version = entry
+            if expires_at <= now or entry_version != version:
+                CACHE_STALE_L1.inc()
+                return False, None
+            cls._entries[(namespace, key)] = entry
+        CACHE_HIT_L1.inc()
+        return True, value
+
+    @classmethod
+    def put(cls, namespace, key, value, ttl, version):
+        """Keeps a value read from memcache under the version read before it."""
+        with cls._lock:
+            cls._entries.pop((namespace, key), None)
+            cls._entries[(namespace, key)] = (value, time.time() + ttl, version)
+            while len(cls._entries) > cls.MAX_ENTRIES:
+                cls._entries.popitem(last=False)
+                CACHE_EVICT_L1.inc()
+
+    @classmethod
+    def invalidate(cls, namespace, keys, prefixes):
+        """Drops keys and moves their families to a new version stamp."""
+        with cls._lock:
+            for key in keys:
+                cls._entries.pop((namespace, key), None)
+        now = time.time()
+        for prefix in prefixes:
+            version = memcache.incr(
+                cls._version_key(prefix), initial_value=int(now * 1000),
+                namespace=namespace)
+            if version is None:
+                # Without a new stamp the family is not safe to cache here.
+                cls._versions.pop((namespace, prefix), None)
+            else:
+                cls._versions[(namespace, prefix)] = (version, now)
+
+
 class MemcacheManager(object):
-    """Class that consolidates all memcache operations."""
+    """Class that consolidates all memcache operations.
+
+    Values are deep-copied only when they are kept in the local cache of a
+    readonly block, so callers cannot modify the local copy. Outside such a
+    block each get() unpickles a fresh value and set() pickles the value
+    right away, so no copy is needed. Key families whose values are never
+    modified can be registered with register_frozen_key_prefix(); their
+    values are shared with the local cache as they are.
+
+    Hot key families can be registered with register_l1_key_prefix() to be
+    kept across requests in the ProcessCache, in front of memcache.
+    """
 
     _LOCAL_CACHE = None
     _IS_READONLY = False
     _READONLY_REENTRY_COUNT = 0
     _READONLY_APP_CONTEXT = None
+    _FROZEN_KEY_PREFIXES = ()
+    # prefix -> TTL in seconds of the key families kept in the ProcessCache.
+    _L1_KEY_PREFIXES = {}
+
+    @classmethod
+    def register_l1_key_prefix(cls, prefix, ttl=DEFAULT_L1_TTL_SECS):
+        """Registers a family of keys to keep in the process cache.
+
+        Args:
+            prefix: str. The keys starting with it are kept.
+            ttl: int. Seconds an entry is kept for.
+        """
+        cls._L1_KEY_PREFIXES[prefix] = ttl
+
+    @classmethod
+    def _get_l1_prefix(cls, key):
+        for prefix in cls._L1_KEY_PREFIXES:
+            if key.startswith(prefix):
+                return prefix
+        return None
+
+    @classmethod
+    def _invalidate_l1(cls, keys, namespace, bump=True):
+        """Drops keys from the process cache.
+
+        Args:
+            keys: list of str. The keys.
+            namespace: str. Their namespace.
+            bump: bool. Whether the keys' values changed, so their families'
+                version stamps are bumped and every instance drops them; read
+                through fills only drop this instance's entries.
+        """
+        prefixes = set()
+        l1_keys = []
+        for key in keys:
+            prefix = cls._get_l1_prefix(key)
+            if prefix is not None:
+                prefixes.add(prefix)
+                l1_keys.append(key)
+        if prefixes:
+            ProcessCache.invalidate(
+                namespace, l1_keys, prefixes if bump else [])
+
+    @classmethod
+    def invalidate_l1(cls, keys, namespace=None):
+        """Drops keys whose values changed from every instance's process cache.
+
+        delete() and delete_multi() do this themselves; set() and set_multi()
+        do not, as most sets fill the cache after a miss. Call this after
+        setting values that were changed.
+        """
+        if CAN_USE_MEMCACHE.value:
+            cls._invalidate_l1(keys, cls._get_namespace(namespace))
+
+    @classmethod
+    def register_frozen_key_prefix(cls, prefix):
+        """Registers a family of keys whose values callers never modify.
+
+        Args:
+            prefix: str. The keys starting with it are frozen.
+        """
+        if prefix not in cls._FROZEN_KEY_PREFIXES:
+            cls._FROZEN_KEY_PREFIXES += (prefix,)
+
+    @classmethod
+    def is_frozen_key(cls, key):
+        return bool(cls._FROZEN_KEY_PREFIXES) and key.startswith(
+            cls._FROZEN_KEY_PREFIXES)
+
+    @classmethod
+    def _copy(cls, key, value, shared=None):
+        """Deep-copies a value if it is shared with the local cache.
+
+        Args:
+            key: str. The value's key.
+            value: The value.
+            shared: bool. Whether the value is shared, as values in the
+                process cache are; by default if in a readonly block.
+        Returns:
+            The value, or a deep copy of it.
+        """
+        if shared is None:
+            shared = cls._IS_READONLY
+        if not shared or cls.is_frozen_key(key):
+            CACHE_COPY_AVOIDED.inc()
+            return value
+        start = time.time()
+        value = copy.deepcopy(value)
+        CACHE_COPY.inc()
+        CACHE_COPY_USEC.inc(increment=int((time.time() - start) * 1000000))
+        return value
 
     @classmethod
     def _is_same_app_context_if_set(cls):
@@ -236,9 +518,10 @@ class MemcacheManager(object):
 
     @classmethod
     def _get_namespace(cls, namespace):
-        if namespace is not None:
-            return namespace
-        return cls.get_namespace()
+        """The memcache namespace of a namespace's keys."""
+        if namespace is None:
+            namespace = cls.get_namespace()
+        return '%s.v%s' % (namespace, MEMCACHE_FORMAT_VERSION)
 
     @classmethod
     def get(cls, key, namespace=None):
@@ -249,9 +532,20 @@ class MemcacheManager(object):
 
         is_cached, value = cls._local_cache_get(key, _namespace)
         if is_cached:
-            return copy.deepcopy(value)
+            return cls._copy(key, value)
+
+        l1_prefix = cls._get_l1_prefix(key)
+        if l1_prefix is not None:
+            is_cached, value = ProcessCache.get(_namespace, key, l1_prefix)
+            if is_cached:
+                cls._local_cache_put(key, _namespace, value)
+                return cls._copy(key, value, shared=True)
+            # Read before the value, so a write in between makes it stale.
+            l1_version = ProcessCache.get_version(
+                _namespace, l1_prefix, time.time())
 
-        value = memcache.get(key, namespace=_namespace)
+        value = cls._decode_multi(
+            {key: memcache.get(key, namespace=_namespace)}, _namespace).get(key)
 
         # We store some objects in memcache that don't evaluate to True, but are
         # real objects, '{}' for example. Count a cache miss only in a case when
@@ -262,7 +556,12 @@ class MemcacheManager(object):
             CACHE_MISS.inc(context=key)
 
         cls._local_cache_put(key, _namespace, value)
-        return copy.deepcopy(value)
+        if l1_prefix is not None and value is not None:
+            ProcessCache.put(
+                _namespace, key, value, cls._L1_KEY_PREFIXES[l1_prefix],
+                l1_version)
+            return cls._copy(key, value, shared=True)
+        return cls._copy(key, value)
 
     @classmethod
     def get_multi(cls, keys, namespace=None):
@@ -276,7 +575,26 @@ class MemcacheManager(object):
         if is_cached:
             return values
 
-        values = memcache.get_multi(keys, namespace=_namespace)
+        l1_values = {}
+        l1_versions = {}
+        if cls._L1_KEY_PREFIXES:
+            remaining_keys = []
+            for key in keys:
+                l1_prefix = cls._get_l1_prefix(key)
+                if l1_prefix is not None:
+                    is_cached, value = ProcessCache.get(
+                        _namespace, key, l1_prefix)
+                    if is_cached:
+                        l1_values[key] = cls._copy(key, value, shared=True)
+                        continue
+                    l1_versions[key] = (l1_prefix, ProcessCache.get_version(
+                        _namespace, l1_prefix, time.time()))
+                remaining_keys.append(key)
+            keys = remaining_keys
+
+        values = cls._decode_multi(
+            memcache.get_multi(keys, namespace=_namespace) if keys else {},
+            _namespace)
         for key, value in values.items():
             if value is not None:
                 CACHE_HIT.inc()
@@ -284,24 +602,228 @@ class MemcacheManager(object):
                 logging.info('Cache miss, key: %s. %s', key, Exception())
                 CACHE_MISS.inc(context=key)
 
+        for key, (l1_prefix, l1_version) in l1_versions.iteritems():
+            value = values.get(key)
+            if value is not None:
+                ProcessCache.put(
+                    _namespace, key, value, cls._L1_KEY_PREFIXES[l1_prefix],
+                    l1_version)
+                values[key] = cls._copy(key, value, shared=True)
+
+        values.update(l1_values)
         cls._local_cache_put_multi(values, _namespace)
         return values
 
+    @classmethod
+    def get_or_load(cls, key, loader, ttl=DEFAULT_CACHE_TTL_SECS,
+                    namespace=None):
+        """Gets an item, loading it in a single caller on a cache miss.
+
+        On a miss, the caller that takes a short lease on the key in memcache
+        calls loader() and sets the item. Other callers wait for the item
+        instead of loading it too; if it does not appear in time they load
+        it themselves.
+
+        Args:
+            key: str. The item's key.
+            loader: callable taking no arguments and returning the value to
+                cache; never None (see NO_OBJECT).
+            ttl: int. Seconds to keep the loaded value in memcache.
+            namespace: str or None. The namespace; by default the current one.
+        Returns:
+            The cached or loaded value.
+        """
+        value = cls.get(key, namespace=namespace)
+        if value is not None:
+            return value
+        if not CAN_USE_MEMCACHE.value:
+            return loader()
+
+        _namespace = cls._get_namespace(namespace)
+        lease_key = 'lease:%s' % key
+        if memcache.add(
+                lease_key, True, time=MEMCACHE_LOAD_LEASE_SECS,
+                namespace=_namespace):
+            CACHE_LOAD.inc()
+            try:
+                value = loader()
+                cls.set(key, value, ttl=ttl, namespace=_namespace)
+            finally:
+                memcache.delete(lease_key, namespace=_namespace)
+            return value
+
+        delay = MEMCACHE_LOAD_POLL_SECS
+        deadline = time.time() + MEMCACHE_LOAD_WAIT_SECS
+        while time.time() + delay < deadline:
+            time.sleep(delay)
+            delay *= 2
+            # Not get(): the local cache remembers the miss.
+            value = cls._decode_multi(
+                {key: memcache.get(key, namespace=_namespace)},
+                _namespace).get(key)
+            if value is not None:
+                CACHE_LOAD_COALESCED.inc()
+                cls._local_cache_put(key, _namespace, value)
+                return cls._copy(key, value)
+
+        CACHE_LOAD_WAIT_TIMEOUT.inc()
+        value = loader()
+        cls.set(key, value, ttl=ttl, namespace=_namespace)
+        return value
+
+    @classmethod
+    def replace_if_unchanged(cls, key, loader, ttl=DEFAULT_CACHE_TTL_SECS,
+                             namespace=None):
+        """Replaces an item with loader()'s value unless it changes meanwhile.
+
+        Args:
+            key: str. The item's key.
+            loader: callable taking no arguments and returning the new value.
+            ttl: int. Seconds to keep the new value in memcache.
+            namespace: str or None. The namespace; by default the current one.
+        Returns:
+            True if the item was replaced; False if it was missing, or was set
+            or deleted by someone else while loader() ran.
+        """
+        if not CAN_USE_MEMCACHE.value:
+            return False
+        _namespace = cls._get_namespace(namespace)
+        client = memcache.Client()
+        if client.gets(key, namespace=_namespace) is None:
+            return False
+        items = cls._encode(key, loader())
+        if items is None:
+            CACHE_PUT_TOO_BIG.inc()
+            return False
+        value_item = items.pop(key)
+        if items:
+            memcache.set_multi(items, time=ttl, namespace=_namespace)
+        if not client.cas(key, value_item, time=ttl, namespace=_namespace):
+            return False
+        CACHE_PUT.inc()
+        cls._invalidate_l1([key], _namespace, bump=False)
+        return True
+
+    @classmethod
+    def _encode(cls, key, value):
+        """Serializes a value once into the memcache items that store it.
+
+        Strings and numbers are stored as they are. Other values are pickled,
+        compressed if big, and split into chunks with a manifest under key if
+        still too big for one item.
+
+        Returns:
+            A dict of the items to put into memcache, or None if the value is
+            too big even in chunks.
+        """
+        if isinstance(value, (bool, int, long)) or (
+                isinstance(value, basestring) and
+                len(value) < MEMCACHE_COMPRESS_MIN and
+                not value.startswith(MEMCACHE_PAYLOAD_PREFIX)):
+            return {key: value}
+        data = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+        payload_format = MEMCACHE_PAYLOAD_PICKLED
+        if len(data) >= MEMCACHE_COMPRESS_MIN:
+            compressed = zlib.compress(data, 1)
+            if len(compressed) < len(data):
+                CACHE_PUT_COMPRESSED.inc()
+                data = compressed
+                payload_format = MEMCACHE_PAYLOAD_COMPRESSED
+        prefix_size = len(MEMCACHE_PAYLOAD_PREFIX) + 1
+        if len(key) + prefix_size + len(data) <= MEMCACHE_MAX:
+            return {key: MEMCACHE_PAYLOAD_PREFIX + payload_format + data}
+
+        chunk_size = MEMCACHE_MAX - len(key) - 64
+        if len(data) > chunk_size * MEMCACHE_MAX_CHUNKS:
+            return None
+        CACHE_PUT_CHUNKED.inc()
+        # Chunk keys differ per payload, so a manifest never mixes chunks of
+        # two different writes.
+        token = '%x' % (zlib.crc32(data) & 0xffffffff)
+        items = {}
+        chunk_keys = []
+        for index, start in enumerate(xrange(0, len(data), chunk_size)):
+            chunk_key = '%s:chunk:%s:%s' % (key, token, index)
+            items[chunk_key] = data[start:start + chunk_size]
+            chunk_keys.append(chunk_key)
+        items[key] = MEMCACHE_PAYLOAD_PREFIX + MEMCACHE_PAYLOAD_CHUNKED + (
+            cPickle.dumps((payload_format, chunk_keys),
+                          cPickle.HIGHEST_PROTOCOL))
+        return items
+
+    @classmethod
+    def _loads(cls, payload_format, data):
+        if payload_format == MEMCACHE_PAYLOAD_COMPRESSED:
+            data = zlib.decompress(data)
+        return cPickle.loads(data)
+
+    @classmethod
+    def _decode_multi(cls, values, namespace):
+        """Decodes in place values as _encode() stored them.
+
+        The chunks of all chunked values are read in one get_multi; a value
+        missing any of its chunks is dropped, as a cache miss.
+        """
+        manifests = {}
+        for key, value in values.items():
+            if not (isinstance(value, str) and
+                    value.startswith(MEMCACHE_PAYLOAD_PREFIX)):
+                continue
+            payload_format = value[len(MEMCACHE_PAYLOAD_PREFIX)]
+            data = value[len(MEMCACHE_PAYLOAD_PREFIX) + 1:]
+            try:
+                if payload_format == MEMCACHE_PAYLOAD_CHUNKED:
+                    manifests[key] = cPickle.loads(data)
+                else:
+                    values[key] = cls._loads(payload_format, data)
+            except Exception:  # pylint: disable=broad-except
+                logging.exception('Failed to decode: %s, %s', key, namespace)
+                del values[key]
+        if not manifests:
+            return values
+
+        chunks = memcache.get_multi([
+            chunk_key for unused_format, chunk_keys in manifests.itervalues()
+            for chunk_key in chunk_keys], namespace=namespace)
+        for key, (payload_format, chunk_keys) in manifests.iteritems():
+            del values[key]
+            if not all(chunk_key in chunks for chunk_key in chunk_keys):
+                continue
+            try:
+                values[key] = cls._loads(payload_format, ''.join(
+                    chunks[chunk_key] for chunk_key in chunk_keys))
+            except Exception:  # pylint: disable=broad-except
+                logging.exception('Failed to decode: %s, %s', key, namespace)
+        return values
+
+    @classmethod
+    def _size(cls, items):
+        return sum(
+            len(key) + (len(value) if isinstance(value, basestring) else 8)
+            for key, value in items.iteritems())
+
     @classmethod
     def set(cls, key, value, ttl=DEFAULT_CACHE_TTL_SECS, namespace=None):
         """Sets an item in memcache if memcache is enabled."""
-        # Ensure subsequent mods to value do not affect the cached copy.
-        value = copy.deepcopy(value)
-
         try:
             if CAN_USE_MEMCACHE.value:
-                size = sys.getsizeof(value)
-                if size > MEMCACHE_MAX:
+                # Ensure subsequent mods to value do not affect the cached copy.
+                value = cls._copy(key, value)
+                items = cls._encode(key, value)
+                if items is None:
                     CACHE_PUT_TOO_BIG.inc()
                 else:
                     CACHE_PUT.inc()
+                    CACHE_PUT_BYTES.inc(increment=cls._size(items))
                     _namespace = cls._get_namespace(namespace)
-                    memcache.set(key, value, ttl, namespace=_namespace)
+                    if len(items) == 1:
+                        if not memcache.set(
+                                key, items[key], ttl, namespace=_namespace):
+                            CACHE_PUT_FAILED.inc()
+                    elif memcache.set_multi(
+                            items, time=ttl, namespace=_namespace):
+                        CACHE_PUT_FAILED.inc()
+                    cls._invalidate_l1([key], _namespace, bump=False)
                     cls._local_cache_put(key, _namespace, value)
         except:  # pylint: disable=bare-except
             logging.exception(
@@ -315,15 +837,25 @@ class MemcacheManager(object):
             if CAN_USE_MEMCACHE.value:
                 if not mapping:
                     return
-                size = sum([
-                    sys.getsizeof(key) + sys.getsizeof(value)
-                    for key, value in mapping.items()])
-                if size > MEMCACHE_MULTI_MAX:
+                items = {}
+                for key, value in mapping.iteritems():
+                    value_items = cls._encode(key, value)
+                    if value_items is None:
+                        items = None
+                        break
+                    items.update(value_items)
+                size = cls._size(items) if items is not None else None
+                if size is None or size > MEMCACHE_MULTI_MAX:
                     CACHE_PUT_TOO_BIG.inc()
                 else:
                     CACHE_PUT.inc()
+                    CACHE_PUT_BYTES.inc(increment=size)
                     _namespace = cls._get_namespace(namespace)
-                    memcache.set_multi(mapping, time=ttl, namespace=_namespace)
+                    not_set = memcache.set_multi(
+                        items, time=ttl, namespace=_namespace)
+                    if not_set:
+                        CACHE_PUT_FAILED.inc(increment=len(not_set))
+                    cls._invalidate_l1(mapping.keys(), _namespace, bump=False)
                     cls._local_cache_put_multi(mapping, _namespace)
         except:  # pylint: disable=bare-except
             logging.exception(
@@ -337,7 +869,9 @@ class MemcacheManager(object):
         assert not cls._IS_READONLY
         if CAN_USE_MEMCACHE.value:
             CACHE_DELETE.inc()
-            memcache.delete(key, namespace=cls._get_namespace(namespace))
+            _namespace = cls._get_namespace(namespace)
+            memcache.delete(key, namespace=_namespace)
+            cls._invalidate_l1([key], _namespace)
 
     @classmethod
     def delete_multi(cls, key_list, namespace=None):
@@ -345,8 +879,9 @@ class MemcacheManager(object):
         assert not cls._IS_READONLY
         if CAN_USE_MEMCACHE.value:
             CACHE_DELETE.inc(increment=len(key_list))
-            memcache.delete_multi(
-                key_list, namespace=cls._get_namespace(namespace))
+            _namespace = cls._get_namespace(namespace)
+            memcache.delete_multi(key_list, namespace=_namespace)
+            cls._invalidate_l1(key_list, _namespace)
 
     @classmethod
     def incr(cls, key, delta, namespace=None):
@@ -447,24 +982,15 @@ class ContentChunkDAO(object):
         if entity_id is None:
             return
 
-        memcache_key = cls._get_memcache_key(entity_id)
-        found = MemcacheManager.get(memcache_key)
+        def load():
+            entity = ContentChunkEntity.get_by_id(entity_id)
+            return cls._make_dto(entity) if entity else NO_OBJECT
 
+        found = MemcacheManager.get_or_load(
+            cls._get_memcache_key(entity_id), load)
         if found == NO_OBJECT:
             return None
-        elif found:
-            return found
-        else:
-            result = None
-            cache_value = NO_OBJECT
-
-            entity = ContentChunkEntity.get_by_id(entity_id)
-            if entity:
-                result = cls._make_dto(entity)
-                cache_value = result
-
-            MemcacheManager.set(memcache_key, cache_value)
-            return result
+        return found
 
     @classmethod
     def get_by_uid(cls, uid):
@@ -1072,8 +1598,7 @@ class StudentProfileDAO(object):
         if not cls._can_send_welcome_notifications(handler):
             return
 
-        origin = student.additional_fields
-        preferred_email = strip_name_from_additional_fields(origin, 'EmailAddress')
+        preferred_email = student.get_additional_field('EmailAddress')
 
         if services.unsubscribe.has_unsubscribed(preferred_email):#student.email
             return
@@ -1085,8 +1610,8 @@ class StudentProfileDAO(object):
         assert sender, 'Must set welcome_notifications_sender in course.yaml'
 
         if student.name == None or not student.name or student.name.isspace():
-            gn = strip_name_from_additional_fields(origin, 'GivenName')
-            fn = strip_name_from_additional_fields(origin, 'FamilyName')
+            gn = student.get_additional_field('GivenName')
+            fn = student.get_additional_field('FamilyName')
             fullname = gn + ' ' + fn
         else:
             fullname = student.name
@@ -1298,6 +1823,67 @@ class _ReadOnlyStringProperty(db.StringProperty):
                     '%s.' % self.name)
         super(_ReadOnlyStringProperty, self).__set__(model_instance, value)
 
+class AdaptiveEncouragementCache(caching.RequestScopedSingleton):
+    """Request-scoped cache of AdaptiveEncouragement records by user_id.
+
+    Records not in this cache are looked up in memcache and then datastore;
+    a student without a record is cached as None, in memcache as NO_OBJECT.
+    """
+
+    def __init__(self):
+        self._user_id_to_ae = {}
+
+    @classmethod
+    def _key(cls, user_id):
+        """Make key specific to user_id and current namespace."""
+        return '%s-%s' % (MemcacheManager.get_namespace(), user_id)
+
+    def _get_by_user_id(self, user_id):
+        key = self._key(user_id)
+        if key in self._user_id_to_ae:
+            return self._user_id_to_ae[key]
+        # pylint: disable=protected-access
+        ae = AdaptiveEncouragement._load_by_user_id(user_id)
+        self._user_id_to_ae[key] = ae
+        return ae
+
+    def _get_multi_by_user_ids(self, user_ids):
+        found = {}
+        missing = []
+        for user_id in user_ids:
+            key = self._key(user_id)
+            if key in self._user_id_to_ae:
+                found[user_id] = self._user_id_to_ae[key]
+            else:
+                missing.append(user_id)
+        if missing:
+            # pylint: disable=protected-access
+            loaded = AdaptiveEncouragement._load_multi_by_user_ids(missing)
+            for user_id in missing:
+                ae = loaded.get(user_id)
+                self._user_id_to_ae[self._key(user_id)] = ae
+                found[user_id] = ae
+        return found
+
+    def _set(self, user_id, ae):
+        self._user_id_to_ae[self._key(user_id)] = ae
+
+    @classmethod
+    def get_by_user_id(cls, user_id):
+        # pylint: disable=protected-access
+        return cls.instance()._get_by_user_id(user_id)
+
+    @classmethod
+    def get_multi_by_user_ids(cls, user_ids):
+        # pylint: disable=protected-access
+        return cls.instance()._get_multi_by_user_ids(user_ids)
+
+    @classmethod
+    def set(cls, user_id, ae):
+        # pylint: disable=protected-access
+        cls.instance()._set(user_id, ae)
+
+
 class AdaptiveEncouragement(BaseEntity):
     
     user_id=db.StringProperty(indexed=True)
@@ -1308,39 +1894,415 @@ class AdaptiveEncouragement(BaseEntity):
     lesson_emails_sent=db.IntegerProperty(indexed=False)
     feedback_count=db.IntegerProperty(indexed=False)
     feedback_with_narrative_count=db.IntegerProperty(indexed=False)
+    # Legacy sent-lists: str() of a Python list of powerful idea or unit names.
+    # They are read once and moved into the list properties below, see
+    # get_sent_set().
     pi_started_emails_sent=db.TextProperty(indexed=False)
     unit_completed_emails_sent=db.TextProperty(indexed=False)
     pi_completed_emails_sent=db.TextProperty(indexed=False)
+    pi_started_sent=db.StringListProperty(indexed=False)
+    unit_completed_sent=db.StringListProperty(indexed=False)
+    pi_completed_sent=db.StringListProperty(indexed=False)
     cron_inactive_not_started_email=db.BooleanProperty(indexed=False)
     cron_inactive_started_email=db.BooleanProperty(indexed=False)
 
+    # Sent-list names, as used by adaptive encouragement rules, mapped to the
+    # list property holding them.
+    SENT_LIST_PROPERTIES = {
+        'pi_started_emails_sent': 'pi_started_sent',
+        'unit_completed_emails_sent': 'unit_completed_sent',
+        'pi_completed_emails_sent': 'pi_completed_sent',
+    }
+
+    # The weekly quota fields, which modules.courses.ae_quota reserves emails
+    # from in transactions; see merge_quota().
+    QUOTA_WEEK_FIELD = 'first_ae_email_sent_in_week'
+    QUOTA_COUNT_FIELDS = ('lesson_emails_sent', 'feedback_emails_sent')
+
+    # Most records written in one cross-group transaction by put_multi().
+    MAX_PUT_MULTI_GROUPS = 25
+
+    # Sent-lists decoded into sets by get_sent_set(), by sent-list name.
+    _sent_sets = None
+
+    # Property values as last loaded from or written to datastore; None for a
+    # record never saved. See is_dirty().
+    _saved_values = None
+
     def __init__(self, *args, **kwargs):
         super(AdaptiveEncouragement, self).__init__(*args, **kwargs)
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_sent_sets', None)
+        return state
+
+    @classmethod
+    def from_entity(cls, entity):
+        ae = super(AdaptiveEncouragement, cls).from_entity(entity)
+        ae._saved_values = ae._get_values()
+        return ae
+
+    def _get_values(self):
+        values = {}
+        for name, prop in self.properties().iteritems():
+            # last_updated changes on every put, so it does not make a record
+            # dirty.
+            if name == 'last_updated':
+                continue
+            value = prop.get_value_for_datastore(self)
+            values[name] = list(value) if isinstance(value, list) else value
+        return values
+
+    def get_dirty_fields(self):
+        """Names of the properties changed since the record was loaded or saved.
+
+        Every property is dirty in a record never saved.
+        """
+        values = self._get_values()
+        if self._saved_values is None:
+            return sorted(values)
+        return sorted(
+            name for name, value in values.iteritems()
+            if self._saved_values.get(name) != value)
+
+    def is_dirty(self):
+        return self._saved_values is None or bool(self.get_dirty_fields())
+
+    def merge_quota(self, other):
+        """Takes in the weekly quota reserved in another copy of the record.
+
+        Quotas only move forward: the later week is kept, and within one week
+        the higher count of each kind of email.
+        """
+        week = getattr(self, self.QUOTA_WEEK_FIELD)
+        other_week = getattr(other, self.QUOTA_WEEK_FIELD)
+        if other_week is None or (week is not None and week > other_week):
+            return
+        if week is None or other_week > week:
+            setattr(self, self.QUOTA_WEEK_FIELD, other_week)
+            for name in self.QUOTA_COUNT_FIELDS:
+                setattr(self, name, getattr(other, name))
+            return
+        for name in self.QUOTA_COUNT_FIELDS:
+            setattr(self, name, max(
+                getattr(self, name) or 0, getattr(other, name) or 0))
+
+    @classmethod
+    def _put_merged(cls, aes):
+        """Puts records, first merging in the quota of their stored copies."""
+        for ae, stored in zip(aes, get([ae.key() for ae in aes])):
+            if stored is not None:
+                ae.merge_quota(stored)
+        return put(aes)
+
+    def put(self):
+        """Writes the record, unless nothing changed since it was loaded.
+
+        The record is written in a transaction that merges in the weekly quota
+        of the stored record, so a copy loaded before a quota reservation does
+        not undo it; see merge_quota(). A written record is also put into
+        memcache and the request cache.
+        """
+        if not self.is_dirty():
+            ADAPTIVE_ENCOURAGEMENT_WRITES_AVOIDED.inc()
+            return self.key()
+        ADAPTIVE_ENCOURAGEMENT_WRITES.inc()
+        result = db.run_in_transaction(self._put_merged, [self])[0]
+        self._saved_values = self._get_values()
+        MemcacheManager.set(self._memcache_key(self.user_id), self)
+        AdaptiveEncouragementCache.set(self.user_id, self)
+        return result
+
+    @classmethod
+    def put_multi(cls, aes):
+        """Writes the changed records of many students with batched puts.
+
+        Like put(), the records are merged with the weekly quota of their
+        stored copies; each MAX_PUT_MULTI_GROUPS of them are written in one
+        cross-group transaction.
+        """
+        aes = list(aes)
+        dirty = [ae for ae in aes if ae.is_dirty()]
+        ADAPTIVE_ENCOURAGEMENT_WRITES_AVOIDED.inc(
+            increment=len(aes) - len(dirty))
+        if not dirty:
+            return
+        ADAPTIVE_ENCOURAGEMENT_WRITES.inc(increment=len(dirty))
+        options = db.create_transaction_options(xg=True)
+        for start in xrange(0, len(dirty), cls.MAX_PUT_MULTI_GROUPS):
+            db.run_in_transaction_options(
+                options, cls._put_merged,
+                dirty[start:start + cls.MAX_PUT_MULTI_GROUPS])
+        for ae in dirty:
+            ae._saved_values = ae._get_values()
+            AdaptiveEncouragementCache.set(ae.user_id, ae)
+        MemcacheManager.set_multi(dict(
+            (cls._memcache_key(ae.user_id), ae) for ae in dirty))
+
+    def delete(self):
+        """Do the normal delete() and also mark the student as having no record."""
+        super(AdaptiveEncouragement, self).delete()
+        MemcacheManager.delete(self._memcache_key(self.user_id))
+        AdaptiveEncouragementCache.set(self.user_id, None)
+
+    @classmethod
+    def _memcache_key(cls, user_id):
+        """Makes a memcache key from user_id."""
+        return 'entity:adaptive-encouragement:%s' % user_id
+
+    def get_sent_set(self, sent_list):
+        """Gets the names a sent-list holds as a set; it is built once.
+
+        A record still holding the legacy text value of the sent-list has it
+        parsed here, once, and moved into the list property; the text value is
+        cleared so the next put() completes the migration.
+
+        Args:
+            sent_list: str. A key of SENT_LIST_PROPERTIES.
+        Returns:
+            The set of powerful idea or unit names the sent-list holds.
+        """
+        if self._sent_sets is None:
+            self._sent_sets = {}
+        sent = self._sent_sets.get(sent_list)
+        if sent is None:
+            property_name = self.SENT_LIST_PROPERTIES[sent_list]
+            names = getattr(self, property_name)
+            legacy = getattr(self, sent_list)
+            if legacy:
+                try:
+                    legacy_names = ast.literal_eval(legacy)
+                except (SyntaxError, ValueError):
+                    logging.error(
+                        'Bad %s in adaptive encouragement record for %s',
+                        sent_list, self.user_id)
+                    legacy_names = []
+                names.extend(
+                    name for name in legacy_names if name not in names)
+                setattr(self, sent_list, None)
+            sent = set(names)
+            self._sent_sets[sent_list] = sent
+        return sent
+
+    def is_sent(self, sent_list, name):
+        return name in self.get_sent_set(sent_list)
+
+    def mark_sent(self, sent_list, name):
+        """Adds a name to a sent-list; returns False if it was already there.
+
+        Note: this method does not commit the change. The caller should call
+        put().
+        """
+        sent = self.get_sent_set(sent_list)
+        if name in sent:
+            return False
+        sent.add(name)
+        getattr(self, self.SENT_LIST_PROPERTIES[sent_list]).append(name)
+        return True
+
     @classmethod
     def safe_key(cls, db_key, transform_fn):
         return db.Key.from_path(cls.kind(), transform_fn(db_key.id_or_name()))
 
     @classmethod
     def _add_new(cls, user_id, feedback_emails_sent=0, lesson_emails_sent=0, feedback_count=0, feedback_with_narrative_count=0, pi_started_emails_sent=None, unit_completed_emails_sent=None, pi_completed_emails_sent=None, cron_inactive_not_started_email=False, cron_inactive_started_email=False):
-        return AdaptiveEncouragement(key_name=user_id, user_id=user_id, feedback_emails_sent=feedback_emails_sent, lesson_emails_sent=lesson_emails_sent, feedback_count=feedback_count, feedback_with_narrative_count=feedback_with_narrative_count, pi_started_emails_sent=pi_started_emails_sent, unit_completed_emails_sent=unit_completed_emails_sent, pi_completed_emails_sent=pi_completed_emails_sent, cron_inactive_not_started_email=cron_inactive_not_started_email, cron_inactive_started_email=cron_inactive_not_started_email)
+        return AdaptiveEncouragement(key_name=user_id, user_id=user_id, feedback_emails_sent=feedback_emails_sent, lesson_emails_sent=lesson_emails_sent, feedback_count=feedback_count, feedback_with_narrative_count=feedback_with_narrative_count, pi_started_emails_sent=pi_started_emails_sent, unit_completed_emails_sent=unit_completed_emails_sent, pi_completed_emails_sent=pi_completed_emails_sent, cron_inactive_not_started_email=cron_inactive_not_started_email, cron_inactive_started_email=cron_inactive_started_email)
 
     @classmethod
     def get_by_user_id(cls, user_id):
-        """Load AdaptiveEncouragement record by user_id. Fail if user_id is not unique."""
-        # Check AdaptiveEncouragement entities for user_id: do a double look up here:
-        # first by the key_name value and then by the user_id field value.
-        ae = AdaptiveEncouragement.get_by_key_name(user_id)
+        """Load AdaptiveEncouragement record by user_id; None if there is none.
+
+        Records are cached for the request and in memcache, including the
+        absence of one.
+        """
+        return AdaptiveEncouragementCache.get_by_user_id(user_id)
+
+    @classmethod
+    def get_multi_by_user_ids(cls, user_ids):
+        """Loads the records of many students with batched reads.
+
+        Returns a dict of user_id to record for the students that have one.
+        """
+        aes = AdaptiveEncouragementCache.get_multi_by_user_ids(list(user_ids))
+        return dict(
+            (user_id, ae) for user_id, ae in aes.iteritems() if ae is not None)
+
+    @classmethod
+    def _load_by_user_id(cls, user_id):
+        """Load a record from memcache or datastore. Fail if user_id is not unique."""
+        memcache_key = cls._memcache_key(user_id)
+        ae = MemcacheManager.get(memcache_key)
+        if NO_OBJECT == ae:
+            return None
         if ae:
             return ae
 
-        aes = AdaptiveEncouragement.all().filter(
-            AdaptiveEncouragement.user_id.name, user_id).fetch(limit=2)
-        if len(aes) > 1:
-            raise Exception(
-                'There is more than one adaptive encouragement record with user_id "%s"' % user_id)
+        # Records are keyed by user_id. Before the key migration is done, look
+        # for one keyed otherwise by the user_id field value too.
+        ae = AdaptiveEncouragement.get_by_key_name(user_id)
+        if not ae and not AdaptiveEncouragementKeyMigration.is_done():
+            aes = AdaptiveEncouragement.all().filter(
+                AdaptiveEncouragement.user_id.name, user_id).fetch(limit=2)
+            if len(aes) > 1:
+                raise Exception(
+                    'There is more than one adaptive encouragement record with user_id "%s"' % user_id)
+            ae = aes[0] if aes else None
+
+        MemcacheManager.set(memcache_key, ae or NO_OBJECT)
+        return ae
+
+    @classmethod
+    def _load_multi_by_user_ids(cls, user_ids):
+        """Loads records from memcache, then datastore with one get.
+
+        Only key names are looked up; until the key migration is done a
+        record keyed otherwise is only found by get_by_user_id().
+        """
+        memcache_keys = dict(
+            (user_id, cls._memcache_key(user_id)) for user_id in user_ids)
+        cached = MemcacheManager.get_multi(memcache_keys.values())
+
+        result = {}
+        missing = []
+        for user_id in user_ids:
+            ae = cached.get(memcache_keys[user_id])
+            if ae is None:
+                missing.append(user_id)
+            elif NO_OBJECT != ae:
+                result[user_id] = ae
+        if missing:
+            memcache_update = {}
+            for user_id, ae in zip(
+                    missing, AdaptiveEncouragement.get_by_key_name(missing)):
+                if ae is not None:
+                    result[user_id] = ae
+                memcache_update[memcache_keys[user_id]] = ae or NO_OBJECT
+            MemcacheManager.set_multi(memcache_update)
+        return result
+
+
+class AdaptiveEncouragementCronState(BaseEntity):
+    """Checkpoint of the inactive users adaptive encouragement cron.
+
+    One entity per course namespace. A run splits windows of an indexed
+    Student property into shards, each checked by its own task. After each
+    shard is queued the window and query cursor reached are saved, so a run cut
+    short by the request deadline resumes where it stopped.
+    """
+
+    KEY_NAME = 'inactive_users'
+
+    # When the run in progress started; None if no run is in progress.
+    run_started_on = db.DateTimeProperty(indexed=False)
+    # When the last completed run started; the next run only checks students
+    # who have become inactive since then.
+    last_run_started_on = db.DateTimeProperty(indexed=False)
+    window_index = db.IntegerProperty(indexed=False, default=0)
+    cursor = db.TextProperty(indexed=False)
+
+    @classmethod
+    def get_or_create(cls):
+        state = cls.get_by_key_name(cls.KEY_NAME)
+        if state is None:
+            state = cls(key_name=cls.KEY_NAME)
+        return state
+
+
+class AdaptiveEncouragementCronShard(BaseEntity):
+    """Record of one completed shard of the inactive users cron.
+
+    The key name is the shard name, which is built from the run, the window
+    and the shard's start cursor. A shard task that finds its record already
+    exists does nothing, so retried or requeued shards send no email twice.
+    """
+
+    students = db.IntegerProperty(indexed=False, default=0)
+    emails = db.IntegerProperty(indexed=False, default=0)
+    completed_on = db.DateTimeProperty(auto_now_add=True, indexed=False)
+
+
+class AdaptiveEncouragementKeyMigration(BaseEntity):
+    """Progress of moving AdaptiveEncouragement records to user_id key names.
+
+    Records have always been created keyed by user_id, but get_by_user_id()
+    also queried the user_id field in case one was not. run() re-keys any such
+    record once; after that the query is no longer made.
+    """
+
+    KEY_NAME = 'adaptive_encouragement_keys'
+    BATCH_SIZE = 500
+
+    # Namespaces whose migration this instance knows to be done.
+    _DONE_NAMESPACES = set()
+
+    cursor = db.TextProperty(indexed=False)
+    done = db.BooleanProperty(indexed=False, default=False)
+
+    @classmethod
+    def _memcache_key(cls):
+        return 'entity:adaptive-encouragement-key-migration'
+
+    @classmethod
+    def is_done(cls):
+        namespace = MemcacheManager.get_namespace()
+        if namespace in cls._DONE_NAMESPACES:
+            return True
+        done = MemcacheManager.get(cls._memcache_key())
+        if done is None:
+            migration = cls.get_by_key_name(cls.KEY_NAME)
+            done = bool(migration and migration.done)
+            MemcacheManager.set(cls._memcache_key(), done)
+        if done:
+            cls._DONE_NAMESPACES.add(namespace)
+        return done
+
+    @classmethod
+    def run(cls, deadline):
+        """Re-keys records in batches until done or past deadline.
+
+        Args:
+            deadline: float. The time.time() after which to stop; the next
+                call resumes where this one stopped.
+        Returns:
+            True if the migration is done.
+        """
+        if cls.is_done():
+            return True
+        migration = cls.get_by_key_name(cls.KEY_NAME)
+        if migration is None:
+            migration = cls(key_name=cls.KEY_NAME)
+
+        while time.time() < deadline:
+            query = AdaptiveEncouragement.all()
+            if migration.cursor:
+                query.with_cursor(migration.cursor)
+            aes = query.fetch(cls.BATCH_SIZE)
+            for ae in aes:
+                if ae.key().name() == ae.user_id:
+                    continue
+                if not AdaptiveEncouragement.get_by_key_name(ae.user_id):
+                    AdaptiveEncouragement(key_name=ae.user_id, **dict(
+                        (name, getattr(ae, name))
+                        for name in AdaptiveEncouragement.properties())).put()
+                logging.info(
+                    'Re-keyed adaptive encouragement record %s for %s.',
+                    ae.key(), ae.user_id)
+                # Skip AdaptiveEncouragement.delete(): the record now cached
+                # for this user_id is the re-keyed one.
+                super(AdaptiveEncouragement, ae).delete()
+
+            if len(aes) < cls.BATCH_SIZE:
+                migration.cursor = None
+                migration.done = True
+                migration.put()
+                MemcacheManager.set(cls._memcache_key(), True)
+                cls._DONE_NAMESPACES.add(MemcacheManager.get_namespace())
+                return True
+            migration.cursor = query.cursor()
+            migration.put()
+        return False
 
-        return aes[0] if aes else None
 
 class Student(BaseEntity):
     """Student data specific to a course instance.
@@ -1463,6 +2425,8 @@ class Student(BaseEntity):
         super(Student, self).__init__(*args, **kwargs)
         self._federated_email_cached = False
         self._federated_email_value = None
+        self._additional_fields_source = None
+        self._additional_fields_value = None
 
     @classmethod
     def safe_key(cls, db_key, transform_fn):
@@ -1514,6 +2478,51 @@ class Student(BaseEntity):
     def profile(self):
         return StudentProfileDAO.get_profile_by_user_id(self.user_id)
 
+    def _get_additional_fields_pairs(self):
+        """Gets additional_fields as a list of [name, value] pairs.
+
+        The JSON text is parsed once and the result kept until additional_fields
+        is assigned a new value.
+        """
+        source = self.additional_fields
+        if (self._additional_fields_value is None or
+            source is not self._additional_fields_source):
+            pairs = []
+            if source:
+                try:
+                    pairs = [
+                        list(pair) for pair in transforms.loads(source)
+                        if isinstance(pair, list) and len(pair) == 2]
+                except (TypeError, ValueError):
+                    logging.error(
+                        'Malformed additional_fields for student %s',
+                        self.user_id)
+            self._additional_fields_source = source
+            self._additional_fields_value = (pairs, dict(reversed(pairs)))
+        return self._additional_fields_value
+
+    def get_additional_field(self, name, default=None):
+        """Gets the value of one registration form field, or default."""
+        unused_pairs, values = self._get_additional_fields_pairs()
+        return values.get(name, default)
+
+    def set_additional_field(self, name, value):
+        """Sets one registration form field, adding it if not yet present.
+
+        Note: this method does not commit the change. The caller should call
+        put() on the Student entity.
+        """
+        pairs, unused_values = self._get_additional_fields_pairs()
+        pairs = [list(pair) for pair in pairs]
+        found = False
+        for pair in pairs:
+            if pair[0] == name:
+                pair[1] = value
+                found = True
+        if not found:
+            pairs.append([name, value])
+        self.additional_fields = transforms.dumps(pairs)
+
     def put(self):
         """Do the normal put() and also add the object to cache."""
         StudentCache.remove(self.user_id)
@@ -1710,13 +2719,22 @@ class EventEntity(BaseEntity):
     @classmethod
     def record(cls, source, user, data):
         """Records new event into a datastore."""
+        cls.create(source, user, data).put()
+
+    @classmethod
+    def create(cls, source, user, data):
+        """Runs the record hooks and returns the new event, not yet saved.
+
+        Callers recording events in batches put() them later; recorded_on is
+        already set to now.
+        """
         cls._run_record_hooks(source, user, data)
 
         event = cls()
         event.source = source
         event.user_id = user.user_id()
         event.data = data
-        event.put()
+        return event
 
     def for_export(self, transform_fn):
         model = super(EventEntity, self).for_export(transform_fn)
@@ -1728,6 +2746,19 @@ class EventEntity(BaseEntity):
         return [self.user_id]
 
 
+class EventPipelineBatch(BaseEntity):
+    """Progress of recording one batch of the buffered events pipeline.
+
+    The key name is the batch id. The batch's events are saved before the
+    record is created; students_done counts the students, in the order of the
+    batch, whose progress has been applied since. It is saved every few
+    students, so it may lag behind the students applied.
+    """
+
+    students_done = db.IntegerProperty(indexed=False, default=0)
+    created_on = db.DateTimeProperty(auto_now_add=True, indexed=False)
+
+
 class StudentAnswersEntity(BaseEntity):
     """Student answers to the assessments."""
 
@@ -1757,6 +2788,52 @@ class StudentPropertyEntity(BaseEntity):
     # Each of the following is a string representation of a JSON dict.
     value = db.TextProperty()
 
+    # Decoded value, kept by get_value_dict() until value is reassigned, and
+    # whether it has changes not yet serialized back into value.
+    _value_source = None
+    _value_dict = None
+    _value_dirty = False
+
+    def __getstate__(self):
+        self._flush_value_dict()
+        state = self.__dict__.copy()
+        for name in ('_value_source', '_value_dict', '_value_dirty'):
+            state.pop(name, None)
+        return state
+
+    def get_value_dict(self):
+        """Gets value decoded as a dict; it is decoded once and then reused.
+
+        Changes made through set_value_item() and inc_value_item() are kept in
+        the dict and only serialized back into value by put().
+        """
+        source = self.value
+        if self._value_dict is None or source is not self._value_source:
+            try:
+                value_dict = transforms.loads(source) if source else {}
+            except (TypeError, ValueError):
+                value_dict = {}
+            self._value_source = source
+            self._value_dict = value_dict
+            self._value_dirty = False
+        return self._value_dict
+
+    def set_value_item(self, key, value):
+        self.get_value_dict()[key] = value
+        self._value_dirty = True
+
+    def inc_value_item(self, key, value=1):
+        value_dict = self.get_value_dict()
+        value_dict[key] = value_dict.get(key, 0) + value
+        self._value_dirty = True
+
+    def _flush_value_dict(self):
+        # A direct assignment to value since the dict was decoded wins.
+        if self._value_dirty and self.value is self._value_source:
+            self.value = transforms.dumps(self._value_dict)
+            self._value_source = self.value
+        self._value_dirty = False
+
     @classmethod
     def _memcache_key(cls, key):
         """Makes a memcache key from primary key."""
@@ -1780,6 +2857,7 @@ class StudentPropertyEntity(BaseEntity):
 
     def put(self):
         """Do the normal put() and also add the object to memcache."""
+        self._flush_value_dict()
         result = super(StudentPropertyEntity, self).put()
         MemcacheManager.set(self._memcache_key(self.key().name()), self)
         return result
@@ -1793,20 +2871,60 @@ class StudentPropertyEntity(BaseEntity):
     def get(cls, student, property_name):
         """Loads student property."""
         key = cls.create_key(student.user_id, property_name)
-        value = MemcacheManager.get(cls._memcache_key(key))
+        value = MemcacheManager.get_or_load(
+            cls._memcache_key(key),
+            lambda: cls.get_by_key_name(key) or NO_OBJECT)
         if NO_OBJECT == value:
             return None
-        if not value:
-            value = cls.get_by_key_name(key)
-            if value:
-                MemcacheManager.set(cls._memcache_key(key), value)
-            else:
-                MemcacheManager.set(cls._memcache_key(key), NO_OBJECT)
         return value
 
+    @classmethod
+    def get_multi(cls, students, property_name):
+        """Loads a property of many students; None where there is none.
+
+        Values found in memcache are used as is; the rest are loaded with one
+        datastore get and put back into memcache with one call.
+        """
+        keys = [cls.create_key(student.user_id, property_name)
+                for student in students]
+        if not keys:
+            return []
+        memcache_keys = [cls._memcache_key(key) for key in keys]
+        cached = MemcacheManager.get_multi(memcache_keys)
+
+        missing = [
+            key for key, memcache_key in zip(keys, memcache_keys)
+            if cached.get(memcache_key) is None]
+        loaded = {}
+        if missing:
+            loaded = dict(zip(missing, cls.get_by_key_name(missing)))
+            MemcacheManager.set_multi(dict(
+                (cls._memcache_key(key), value or NO_OBJECT)
+                for key, value in loaded.iteritems()))
+
+        values = []
+        for key, memcache_key in zip(keys, memcache_keys):
+            if key in loaded:
+                values.append(loaded[key])
+            else:
+                value = cached[memcache_key]
+                values.append(None if NO_OBJECT == value else value)
+        return values
+
 
 class BaseJsonDao(object):
-    """Base DAO class for entities storing their data in a single JSON blob."""
+    """Base DAO class for entities storing their data in a single JSON blob.
+
+    get_all_mapped() caches the map of all DTOs for ALL_MAPPED_TTL_SECS with
+    the time it was built. Past ALL_MAPPED_SOFT_TTL_SECS the cached map is
+    still returned, and a task rebuilds it in the background; see
+    JsonDaoAllMappedRefresher. Saves and deletes drop the cached map, so the
+    next read rebuilds it at once. Set ALL_MAPPED_SOFT_TTL_SECS to None to
+    cache the map for ALL_MAPPED_TTL_SECS only and rebuild it when it expires.
+    """
+
+    ALL_MAPPED_SOFT_TTL_SECS = DEFAULT_CACHE_TTL_SECS
+    ALL_MAPPED_TTL_SECS = 60 * 60
 
     class EntityKeyTypeId(object):
 
@@ -1840,25 +2958,35 @@ class BaseJsonDao(object):
         # Keeping case-sensitivity in kind() because Foo(object) != foo(object).
         return '(entity-get-all:%s)' % cls.ENTITY.kind()
 
+    @classmethod
+    def _load_all_mapped(cls):
+        """Builds the (built_on, {id: dto} or NO_OBJECT) pair to cache."""
+        return time.time(), (
+            {dto.id: dto for dto in cls.get_all_iter()} or NO_OBJECT)
+
     @classmethod
     def get_all_mapped(cls):
-        # try to get from memcache
-        entities = MemcacheManager.get(cls._memcache_all_key())
-        if entities is not None and entities != NO_OBJECT:
-            cls._maybe_apply_post_load_hooks(entities.itervalues())
-            return entities
+        # get from memcache, or from datastore in one request at a time
+        ttl = cls.ALL_MAPPED_TTL_SECS
+        if cls.ALL_MAPPED_SOFT_TTL_SECS is None:
+            ttl = DEFAULT_CACHE_TTL_SECS
+        cached = MemcacheManager.get_or_load(
+            cls._memcache_all_key(), cls._load_all_mapped, ttl=ttl)
+        if isinstance(cached, tuple):
+            built_on, entities = cached
+        else:
+            # cached before build times were kept
+            built_on, entities = 0, cached
+        if entities == NO_OBJECT:
+            entities = {}
 
-        # get from datastore
-        result = {dto.id: dto for dto in cls.get_all_iter()}
+        # past the soft TTL, serve the map and rebuild it in the background
+        if (cls.ALL_MAPPED_SOFT_TTL_SECS is not None and
+            time.time() - built_on > cls.ALL_MAPPED_SOFT_TTL_SECS):
+            JsonDaoAllMappedRefresher.enqueue(cls)
 
-        # put into memcache
-        result_to_cache = NO_OBJECT
-        if result:
-            result_to_cache = result
-        MemcacheManager.set(cls._memcache_all_key(), result_to_cache)
-
-        cls._maybe_apply_post_load_hooks(result.itervalues())
-        return result
+        cls._maybe_apply_post_load_hooks(entities.itervalues())
+        return entities
 
     @classmethod
     def get_all(cls):
@@ -1921,16 +3049,12 @@ class BaseJsonDao(object):
     def _load_entity(cls, obj_id):
         if not obj_id:
             return None
-        memcache_key = cls._memcache_key(obj_id)
-        entity = MemcacheManager.get(memcache_key)
+        entity = MemcacheManager.get_or_load(
+            cls._memcache_key(obj_id),
+            lambda: cls.ENTITY_KEY_TYPE.get_entity_by_key(
+                cls.ENTITY, obj_id) or NO_OBJECT)
         if NO_OBJECT == entity:
             return None
-        if not entity:
-            entity = cls.ENTITY_KEY_TYPE.get_entity_by_key(cls.ENTITY, obj_id)
-            if entity:
-                MemcacheManager.set(memcache_key, entity)
-            else:
-                MemcacheManager.set(memcache_key, NO_OBJECT)
         return entity
 
     @classmethod
@@ -2013,6 +3137,7 @@ class BaseJsonDao(object):
         MemcacheManager.delete(cls._memcache_all_key())
         id_or_name = entity.key().id_or_name()
         MemcacheManager.set(cls._memcache_key(id_or_name), entity)
+        MemcacheManager.invalidate_l1([cls._memcache_key(id_or_name)])
         cls._maybe_apply_post_save_hooks([(id_or_name, dto)])
         return id_or_name
 
@@ -2029,6 +3154,8 @@ class BaseJsonDao(object):
         MemcacheManager.delete(cls._memcache_all_key())
         for key, entity in zip(keys, entities):
             MemcacheManager.set(cls._memcache_key(key.id_or_name()), entity)
+        MemcacheManager.invalidate_l1(
+            [cls._memcache_key(key.id_or_name()) for key in keys])
 
         id_or_name_list = [key.id_or_name() for key in keys]
         cls._maybe_apply_post_save_hooks(zip(id_or_name_list, dtos))
@@ -2045,6 +3172,86 @@ class BaseJsonDao(object):
     def clone(cls, dto):
         return cls.DTO(None, copy.deepcopy(dto.dict))
 
+    @classmethod
+    def register_l1_cache(cls, ttl=DEFAULT_L1_TTL_SECS):
+        """Keeps this DAO's entities and list in the process cache.
+
+        Each kind gets its own version stamp, so a save only drops this kind's
+        entries on other instances. Only register DAOs read on most requests
+        that rarely change; DAOs saved on ordinary requests (e.g.
+        StudentPreferencesDAO) would drop their entries on every instance as
+        often as they are read.
+
+        Args:
+            ttl: int. Seconds an entry is kept for.
+        """
+        kind = cls.ENTITY.kind()
+        MemcacheManager.register_l1_key_prefix('(entity:%s:' % kind, ttl=ttl)
+        MemcacheManager.register_l1_key_prefix(
+            '(entity-get-all:%s)' % kind, ttl=ttl)
+
+
+
+
+class JsonDaoAllMappedRefresher(webapp2.RequestHandler):
+    """Rebuilds the cached map of a BaseJsonDao's DTOs in the background.
+
+    get_all_mapped() enqueues a task when the cached map is past its soft TTL;
+    a short memcache lease per DAO and namespace keeps it to one task at a
+    time. The map is only replaced if it has not been dropped or replaced
+    while it was rebuilt, so a save during the rebuild is never overwritten.
+    """
+
+    URL = '/_ah/queue/json-dao-all-mapped-refresh'
+
+    # Seconds during which one rebuild of a map is enqueued at most.
+    LEASE_SECS = 60
+
+    @classmethod
+    def enqueue(cls, dao):
+        lease_key = 'refresh:%s' % dao._memcache_all_key()
+        namespace = MemcacheManager.get_namespace()
+        if not memcache.add(
+                lease_key, True, time=cls.LEASE_SECS, namespace=namespace):
+            return
+        try:
+            taskqueue.Task(url=cls.URL, params={
+                'namespace': namespace,
+                'dao': '%s.%s' % (dao.__module__, dao.__name__),
+            }).add()
+        except Exception:  # pylint: disable=broad-except
+            logging.exception('Failed to enqueue a rebuild of %s', dao.__name__)
+            memcache.delete(lease_key, namespace=namespace)
+
+    @classmethod
+    def _get_dao(cls, dao_name):
+        module_name, class_name = dao_name.rsplit('.', 1)
+        module = __import__(module_name, fromlist=[class_name])
+        dao = getattr(module, class_name, None)
+        if not (isinstance(dao, type) and issubclass(dao, BaseJsonDao)):
+            return None
+        return dao
+
+    def post(self):
+        if 'X-AppEngine-QueueName' not in self.request.headers:
+            self.response.set_status(500)
+            return
+        dao_name = self.request.get('dao')
+        dao = self._get_dao(dao_name)
+        if dao is None:
+            logging.critical('JSON DAO refresh queue had unknown DAO %s',
+                             dao_name)
+            self.response.set_status(200)
+            return
+        with common_utils.Namespace(self.request.get('namespace')):
+            MemcacheManager.replace_if_unchanged(
+                dao._memcache_all_key(), dao._load_all_mapped,
+                ttl=dao.ALL_MAPPED_TTL_SECS)
+            memcache.delete(
+                'refresh:%s' % dao._memcache_all_key(),
+                namespace=MemcacheManager.get_namespace())
+        self.response.set_status(200)
+
 
 class LastModfiedJsonDao(BaseJsonDao):
     """Base DAO that updates the last_modified field of entities on every save.
@@ -2153,6 +3360,9 @@ class QuestionDAO(LastModfiedJsonDao):
         return None
 
 
+QuestionDAO.register_l1_cache()
+
+
 class QuestionImporter(object):
     """Helper class for converting ver. 1.2 questoins to ver. 1.3 ones."""
 
@@ -2452,6 +3662,9 @@ class QuestionGroupDAO(LastModfiedJsonDao):
                 'Non-unique question group description: %s' % description)
 
 
+QuestionGroupDAO.register_l1_cache()
+
+
 class LabelEntity(BaseEntity):
     """A class representing labels that can be applied to Student, Unit, etc."""
     data = db.TextProperty(indexed=False)
@@ -2629,6 +3842,9 @@ class LabelDAO(BaseJsonDao):
         return items
 
 
+LabelDAO.register_l1_cache()
+
+
 class StudentPreferencesEntity(BaseEntity):
     """A class representing an individual's preferences for a course.
 
@@ -2763,6 +3979,9 @@ class RoleDAO(BaseJsonDao):
     ENTITY_KEY_TYPE = BaseJsonDao.EntityKeyTypeId
 
 
+RoleDAO.register_l1_cache()
+
+
 def get_global_handlers():
     return [
         (StudentLifecycleObserver.URL, StudentLifecycleObserver),
@@ -16,14 +16,19 @@
 
 __author__ = 'Sean Lip (sll@google.com)'
 
+import collections
 import datetime
+import hashlib
 import logging
 import os
+import threading
+import time
 from collections import defaultdict
 
-import transforms
+import counters
 
 from common import utils
+from models import MemcacheManager
 from models import QuestionDAO
 from models import QuestionGroupDAO
 from models import StudentPropertyEntity
@@ -37,6 +42,201 @@ TRACKABLE_COMPONENTS = [
 ]
 
 
+ACTIVITY_CACHE_HIT = counters.PerfCounter(
+    'gcb-models-progress-activity-cache-hit',
+    'A number of times a parsed activity was found in the process cache.')
+ACTIVITY_CACHE_MEMCACHE_HIT = counters.PerfCounter(
+    'gcb-models-progress-activity-cache-memcache-hit',
+    'A number of times a parsed activity was found in memcache.')
+ACTIVITY_PARSED = counters.PerfCounter(
+    'gcb-models-progress-activity-parsed',
+    'A number of times an activity was parsed from its JavaScript file.')
+
+
+class ActivityCache(object):
+    """Parsed activities, by file path and the file's content.
+
+    Keying by a hash of the content as well as the path means an edited
+    activity gets a new entry, so entries never need invalidating. The most
+    recently used activities are kept in the process, and all of them in
+    memcache for other instances. Activities are shared: do not modify them.
+
+    A parsed activity is the scope its file was evaluated in. Only the names
+    the file defines are put in memcache; the rest of the scope is added back
+    on a memcache hit.
+    """
+
+    MAX_ACTIVITIES = 200
+
+    MEMCACHE_KEY_PREFIX = 'activity:'
+
+    # The names an activity file defines.
+    MEMCACHED_NAMES = ('activity', 'noverify')
+
+    _activities = collections.OrderedDict()
+    _lock = threading.Lock()
+
+    @classmethod
+    def _memcache_key(cls, path, text):
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+        return cls.MEMCACHE_KEY_PREFIX + hashlib.md5(
+            '%s\n%s' % (path, text)).hexdigest()
+
+    @classmethod
+    def get(cls, path, text, parse):
+        """Gets the parsed activity of a file, calling parse(text) once.
+
+        Args:
+            path: str. The activity file's path.
+            text: str. The activity file's content.
+            parse: callable taking text and returning the parsed activity.
+        Returns:
+            The parsed activity.
+        """
+        if text is None:
+            return parse(text)
+        key = cls._memcache_key(path, text)
+        cache_key = (MemcacheManager.get_namespace(), key)
+        with cls._lock:
+            activity = cls._activities.pop(cache_key, None)
+            if activity is not None:
+                cls._activities[cache_key] = activity
+                ACTIVITY_CACHE_HIT.inc()
+                return activity
+
+        cached = MemcacheManager.get(key)
+        if cached is not None:
+            ACTIVITY_CACHE_MEMCACHE_HIT.inc()
+            activity = dict(verify.Activity().scope)
+            activity.update(cached)
+        else:
+            ACTIVITY_PARSED.inc()
+            activity = parse(text)
+            MemcacheManager.set(key, dict(
+                (name, activity[name]) for name in cls.MEMCACHED_NAMES
+                if name in activity))
+
+        with cls._lock:
+            cls._activities[cache_key] = activity
+            while len(cls._activities) > cls.MAX_ACTIVITIES:
+                cls._activities.popitem(last=False)
+        return activity
+
+
+# Parsed activities are shared and never modified, so memcache need not copy
+# them.
+MemcacheManager.register_frozen_key_prefix(ActivityCache.MEMCACHE_KEY_PREFIX)
+
+
+class CourseStructureIndex(object):
+    """The parts of a course's structure the progress cascade looks up.
+
+    An index is built once per course and shared by the trackers of all
+    requests; see get(). It is keyed on the last-modified time of the course's
+    structure file, so it is rebuilt once a saved or imported course is read.
+    The file is read through the course's file system cache, so checking its
+    time is cheap. Where the file system does not give the time, the index is
+    rebuilt at the latest MAX_AGE_SECS after it was built.
+    """
+
+    COURSE_FILE = os.path.join('data', 'course.json')
+    MAX_AGE_SECS = 60
+
+    # Per namespace, the (version, built_on, index) built last.
+    _INDEXES = {}
+
+    def __init__(self, course):
+        # All keyed by str(unit_id).
+        self.unit_lesson_ids = {}
+        self.unit_assessments = {}
+        self.parent_unit_ids = {}
+        # Keyed by (str(unit_id), str(lesson_id)).
+        self.lesson_has_activity = {}
+        for unit in course.get_units():
+            unit_id = str(unit.unit_id)
+            lessons = course.get_lessons(unit.unit_id)
+            self.unit_lesson_ids[unit_id] = [
+                lesson.lesson_id for lesson in lessons]
+            self.unit_assessments[unit_id] = (
+                getattr(unit, 'pre_assessment', None),
+                getattr(unit, 'post_assessment', None))
+            for lesson in lessons:
+                self.lesson_has_activity[(unit_id, str(lesson.lesson_id))] = (
+                    bool(lesson.activity))
+            parent_unit = course.get_parent_unit(unit.unit_id)
+            self.parent_unit_ids[unit_id] = (
+                parent_unit.unit_id if parent_unit else None)
+        # Per student labels: the (unit_id, type) of the units that count
+        # towards completing the course.
+        self._course_units = {}
+        # Per (str(unit_id), str(lesson_id)): the ids of the trackable
+        # components in the lesson body, as a tuple and as a frozenset.
+        self._component_ids = {}
+
+    @classmethod
+    def _get_version(cls, app_context):
+        """The last-modified time of the course's structure file, or None."""
+        stream = app_context.fs.impl.get(
+            os.path.join(app_context.get_home(), cls.COURSE_FILE))
+        metadata = getattr(stream, 'metadata', None)
+        return getattr(metadata, 'updated_on', None)
+
+    @classmethod
+    def get(cls, course):
+        """Gets the index of a course, building it if it is out of date."""
+        namespace = course.app_context.get_namespace_name()
+        version = cls._get_version(course.app_context)
+        now = time.time()
+        cached = cls._INDEXES.get(namespace)
+        if cached and cached[0] == version and (
+                version is not None or now - cached[1] < cls.MAX_AGE_SECS):
+            return cached[2]
+        index = cls(course)
+        cls._INDEXES[namespace] = (version, now, index)
+        return index
+
+    def get_course_units(self, course, student):
+        """The (unit_id, type) of the units the student completes the course by.
+
+        These are the units on the student's track, less assessments used as
+        lessons within a unit.
+        """
+        key = student.labels or ''
+        units = self._course_units.get(key)
+        if units is None:
+            units = [
+                (unit.unit_id, unit.type)
+                for unit in course.get_track_matching_student(student)
+                if not self.parent_unit_ids.get(str(unit.unit_id))]
+            self._course_units[key] = units
+        return units
+
+    def get_component_ids(self, course, unit_id, lesson_id):
+        """The ids of a lesson's trackable components, in order and as a set.
+
+        The lesson body is parsed for its components the first time they are
+        asked for.
+
+        Returns:
+            A (tuple, frozenset) pair of the same component ids.
+        """
+        key = (str(unit_id), str(lesson_id))
+        ids = self._component_ids.get(key)
+        if ids is None:
+            components = []
+            for cpt_name in TRACKABLE_COMPONENTS:
+                all_cpts = course.get_components_with_name(
+                    unit_id, lesson_id, cpt_name)
+                components += [
+                    cpt['instanceid'] for cpt in all_cpts if cpt['instanceid']]
+            ids = (tuple(components), frozenset(components))
+            self._component_ids[key] = ids
+        return ids
+
+
 class UnitLessonCompletionTracker(object):
     """Tracks student completion for a unit/lesson-based linear course."""
 
@@ -104,17 +304,33 @@ class UnitLessonCompletionTracker(object):
 
     def __init__(self, course):
         self._course = course
+        self._structure = None
 
     def _get_course(self):
         return self._course
 
+    def _get_structure(self):
+        """Gets the course's CourseStructureIndex; read once per tracker."""
+        if self._structure is None:
+            self._structure = CourseStructureIndex.get(self._get_course())
+        return self._structure
+
     def get_activity_as_python(self, unit_id, lesson_id):
-        """Gets the corresponding activity as a Python object."""
-        root_name = 'activity'
+        """Gets the corresponding activity as a Python object.
+
+        The activity is parsed once per version of its file; see
+        ActivityCache. It is shared, so callers must not modify it.
+        """
         course = self._get_course()
-        activity_text = course.app_context.fs.get(
-            os.path.join(course.app_context.get_home(),
-                         course.get_activity_filename(unit_id, lesson_id)))
+        path = os.path.join(course.app_context.get_home(),
+                            course.get_activity_filename(unit_id, lesson_id))
+        activity_text = course.app_context.fs.get(path)
+        return ActivityCache.get(
+            path, activity_text, self._parse_activity)
+
+    @classmethod
+    def _parse_activity(cls, activity_text):
+        root_name = 'activity'
         content, noverify_text = verify.convert_javascript_to_python(
             activity_text, root_name)
         activity = verify.evaluate_python_expression_from_text(
@@ -174,9 +390,10 @@ class UnitLessonCompletionTracker(object):
 
         # If this assessment is used as a "lesson" within a unit, prepend
         # the unit identifier.
-        parent_unit = self._get_course().get_parent_unit(assessment_id)
-        if parent_unit:
-            assessment_key = '.'.join([self._get_unit_key(parent_unit.unit_id),
+        parent_unit_id = self._get_structure().parent_unit_ids.get(
+            str(assessment_id))
+        if parent_unit_id:
+            assessment_key = '.'.join([self._get_unit_key(parent_unit_id),
                                        assessment_key])
         return assessment_key
 
@@ -189,13 +406,15 @@ class UnitLessonCompletionTracker(object):
 
     def get_valid_component_ids(self, unit_id, lesson_id):
         """Returns a list of cpt ids representing trackable components."""
-        components = []
-        for cpt_name in TRACKABLE_COMPONENTS:
-            all_cpts = self._get_course().get_components_with_name(
-                unit_id, lesson_id, cpt_name)
-            components += [
-                cpt['instanceid'] for cpt in all_cpts if cpt['instanceid']]
-        return components
+        cpt_ids, unused_cpt_id_set = self._get_structure().get_component_ids(
+            self._get_course(), unit_id, lesson_id)
+        return list(cpt_ids)
+
+    def _get_valid_component_id_set(self, unit_id, lesson_id):
+        """Returns a frozenset of the trackable component ids in a lesson."""
+        unused_cpt_ids, cpt_id_set = self._get_structure().get_component_ids(
+            self._get_course(), unit_id, lesson_id)
+        return cpt_id_set
 
     def get_valid_block_ids(self, unit_id, lesson_id):
         """Returns a list of block ids representing interactive activities."""
@@ -508,22 +727,19 @@ class UnitLessonCompletionTracker(object):
             return
 
         self._set_entity_value(progress, event_key, self.IN_PROGRESS_STATE)
-        course = self._get_course()
-        for unit in course.get_track_matching_student(student):
-            if course.get_parent_unit(unit.unit_id):
-                # Completion of an assessment-as-lesson rolls up to its
-                # containing unit; it is not considered for overall course
-                # completion (except insofar as assessment completion
-                # contributes to the completion of its owning unit)
-                pass
-            else:
-                if unit.type == verify.UNIT_TYPE_ASSESSMENT:
-                    if not self.is_assessment_completed(progress, unit.unit_id):
-                        return
-                elif unit.type == verify.UNIT_TYPE_UNIT:
-                    unit_state = self.get_unit_status(progress, unit.unit_id)
-                    if unit_state != self.COMPLETED_STATE:
-                        return
+        # Completion of an assessment-as-lesson rolls up to its containing
+        # unit; it is not considered for overall course completion (except
+        # insofar as assessment completion contributes to the completion of
+        # its owning unit), so the index leaves those out.
+        for unit_id, unit_type in self._get_structure().get_course_units(
+                self._get_course(), student):
+            if unit_type == verify.UNIT_TYPE_ASSESSMENT:
+                if not self.is_assessment_completed(progress, unit_id):
+                    return
+            elif unit_type == verify.UNIT_TYPE_UNIT:
+                unit_state = self.get_unit_status(progress, unit_id)
+                if unit_state != self.COMPLETED_STATE:
+                    return
         self._set_entity_value(progress, event_key, self.COMPLETED_STATE)
 
     def _update_course_forced(self, progress):
@@ -545,20 +761,18 @@ class UnitLessonCompletionTracker(object):
         self._set_entity_value(progress, event_key, self.IN_PROGRESS_STATE)
 
         # Check if all lessons in this unit have been completed.
-        lessons = self._get_course().get_lessons(unit_id)
-        for lesson in lessons:
+        structure = self._get_structure()
+        for lesson_id in structure.unit_lesson_ids.get(unit_id, ()):
             if (self.get_lesson_status(
-                    progress,
-                    unit_id, lesson.lesson_id) != self.COMPLETED_STATE):
+                    progress, unit_id, lesson_id) != self.COMPLETED_STATE):
                 return
 
         # Check whether pre/post assessments in this unit have been completed.
-        unit = self._get_course().find_unit_by_id(unit_id)
-        pre_assessment_id = unit.pre_assessment
+        pre_assessment_id, post_assessment_id = (
+            structure.unit_assessments.get(unit_id, (None, None)))
         if (pre_assessment_id and
             not self.get_assessment_status(progress, pre_assessment_id)):
             return
-        post_assessment_id = unit.post_assessment
         if (post_assessment_id and
             not self.get_assessment_status(progress, post_assessment_id)):
             return
@@ -585,18 +799,18 @@ class UnitLessonCompletionTracker(object):
         # Record that at least one part of this lesson has been completed.
         self._set_entity_value(progress, event_key, self.IN_PROGRESS_STATE)
 
-        lessons = self._get_course().get_lessons(unit_id)
-        for lesson in lessons:
-            if str(lesson.lesson_id) == lesson_id and lesson:
-                # Is the activity completed?
-                if (lesson.activity and self.get_activity_status(
-                        progress, unit_id, lesson_id) != self.COMPLETED_STATE):
-                    return
+        has_activity = self._get_structure().lesson_has_activity.get(
+            (unit_id, lesson_id))
+        if has_activity is not None:
+            # Is the activity completed?
+            if (has_activity and self.get_activity_status(
+                    progress, unit_id, lesson_id) != self.COMPLETED_STATE):
+                return
 
-                # Are all components of the lesson completed?
-                if (self.get_html_status(
-                        progress, unit_id, lesson_id) != self.COMPLETED_STATE):
-                    return
+            # Are all components of the lesson completed?
+            if (self.get_html_status(
+                    progress, unit_id, lesson_id) != self.COMPLETED_STATE):
+                return
 
         # Record that all activities in this lesson have been completed.
         self._set_entity_value(progress, event_key, self.COMPLETED_STATE)
@@ -636,7 +850,7 @@ class UnitLessonCompletionTracker(object):
         # Record that at least one block in this activity has been completed.
         self._set_entity_value(progress, event_key, self.IN_PROGRESS_STATE)
 
-        cpt_ids = self.get_valid_component_ids(unit_id, lesson_id)
+        cpt_ids = self._get_valid_component_id_set(unit_id, lesson_id)
         for cpt_id in cpt_ids:
             if not self.is_component_completed(
                     progress, unit_id, lesson_id, cpt_id):
@@ -739,36 +953,48 @@ class UnitLessonCompletionTracker(object):
         self._put_event(
             student, 'activity', self._get_activity_key(unit_id, lesson_id))
 
+    def get_html_completed_event(self, unit_id, lesson_id):
+        """Returns the event put_html_completed() records; None if invalid.
+
+        The event is an (event_entity, event_key) pair for put_events().
+        """
+        if not self._get_course().is_valid_unit_lesson_id(unit_id, lesson_id):
+            return None
+        return 'html', self._get_html_key(unit_id, lesson_id)
+
+    def get_block_completed_event(self, unit_id, lesson_id, block_id):
+        """Returns the event put_block_completed() records; None if invalid."""
+        if not self._get_course().is_valid_unit_lesson_id(unit_id, lesson_id):
+            return None
+        if block_id not in self.get_valid_block_ids(unit_id, lesson_id):
+            return None
+        return 'block', self._get_block_key(unit_id, lesson_id, block_id)
+
+    def get_component_completed_event(self, unit_id, lesson_id, cpt_id):
+        """Returns the event put_component_completed() records; None if invalid."""
+        if not self._get_course().is_valid_unit_lesson_id(unit_id, lesson_id):
+            return None
+        if cpt_id not in self._get_valid_component_id_set(unit_id, lesson_id):
+            return None
+        return 'component', self._get_component_key(unit_id, lesson_id, cpt_id)
+
     def put_html_completed(self, student, unit_id, lesson_id):
         """Records that the given student has completed a lesson page."""
-        if not self._get_course().is_valid_unit_lesson_id(unit_id, lesson_id):
-            return
-        self._put_event(
-            student, 'html', self._get_html_key(unit_id, lesson_id))
+        event = self.get_html_completed_event(unit_id, lesson_id)
+        if event:
+            self._put_event(student, *event)
 
     def put_block_completed(self, student, unit_id, lesson_id, block_id):
         """Records that the given student has completed an activity block."""
-        if not self._get_course().is_valid_unit_lesson_id(unit_id, lesson_id):
-            return
-        if block_id not in self.get_valid_block_ids(unit_id, lesson_id):
-            return
-        self._put_event(
-            student,
-            'block',
-            self._get_block_key(unit_id, lesson_id, block_id)
-        )
+        event = self.get_block_completed_event(unit_id, lesson_id, block_id)
+        if event:
+            self._put_event(student, *event)
 
     def put_component_completed(self, student, unit_id, lesson_id, cpt_id):
         """Records completion of a component in a lesson body."""
-        if not self._get_course().is_valid_unit_lesson_id(unit_id, lesson_id):
-            return
-        if cpt_id not in self.get_valid_component_ids(unit_id, lesson_id):
-            return
-        self._put_event(
-            student,
-            'component',
-            self._get_component_key(unit_id, lesson_id, cpt_id)
-        )
+        event = self.get_component_completed_event(unit_id, lesson_id, cpt_id)
+        if event:
+            self._put_event(student, *event)
 
     def put_assessment_completed(self, student, assessment_id):
         """Records that the given student has completed the given assessment."""
@@ -804,22 +1030,90 @@ class UnitLessonCompletionTracker(object):
         """Records that the given student has accessed this lesson page."""
         # This method currently exists because we need to mark lesson bodies
         # without interactive blocks as 'completed' when they are accessed.
-        if not self.get_valid_component_ids(unit_id, lesson_id):
+        if not self._get_valid_component_id_set(unit_id, lesson_id):
             self.put_html_completed(student, unit_id, lesson_id)
 
     def _put_event(self, student, event_entity, event_key):
         """Starts a cascade of updates in response to an event taking place."""
-        if student.is_transient or event_entity not in self.EVENT_CODE_MAPPING:
+        self.put_events(student, [(event_entity, event_key)])
+
+    def put_events(self, student, events):
+        """Records several events for a student in one pass and one write.
+
+        Each event is applied as _update_event() would apply a direct update.
+        The containers above the events (html, activity, lesson, unit) are
+        then re-evaluated once each, children before parents, however many of
+        the events they contain; the course is re-evaluated once at the end.
+
+        Args:
+          student: the student
+          events: list of (event_entity, event_key) pairs, as returned by the
+              get_*_event() methods.
+        """
+        events = [
+            (event_entity, event_key) for event_entity, event_key in events
+            if event_entity in self.EVENT_CODE_MAPPING]
+        if student.is_transient or not events:
             return
 
         progress = self.get_or_create_progress(student)
 
-        self._update_event(
-            student, progress, event_entity, event_key, direct_update=True)
+        updated = []
+        pending = {}
+        update_course = False
+        for event_entity, event_key in events:
+            if event_entity in self.UPDATER_MAPPING:
+                # This is a derived event, so directly mark it as completed.
+                self._set_entity_value(
+                    progress, event_key, self.COMPLETED_STATE)
+            else:
+                # This is not a derived event, so increment its counter by one.
+                self._inc(progress, event_key)
+            updated.append((event_entity, event_key))
+            update_course |= self._add_parent_events(
+                pending, event_entity, event_key)
+
+        # A parent key has fewer parts than its children's, so taking the
+        # longest pending key first evaluates every child before its parent.
+        while pending:
+            event_key = max(pending, key=lambda key: key.count('.'))
+            event_entity = pending.pop(event_key)
+            self.UPDATER_MAPPING[event_entity](self, progress, event_key)
+            updated.append((event_entity, event_key))
+            update_course |= self._add_parent_events(
+                pending, event_entity, event_key)
+
+        if update_course:
+            self._update_course(progress, student)
+
+        for event_entity, event_key in updated:
+            utils.run_hooks(self.POST_UPDATE_PROGRESS_HOOK, self._get_course(),
+                            student, progress, event_entity, event_key)
 
         progress.updated_on = datetime.datetime.now()
         progress.put()
 
+    def _add_parent_events(self, pending, event_entity, event_key):
+        """Adds the containers of an event to pending, as _update_event() would.
+
+        Returns:
+          True if the event is at the top of its containment list, so the
+          course status should be re-evaluated.
+        """
+        if event_entity not in self.DERIVED_EVENTS:
+            return True
+        update_course = False
+        for derived_event in self.DERIVED_EVENTS[event_entity]:
+            parent_event_key = derived_event['generate_parent_id'](event_key)
+            if parent_event_key:
+                leaf_type = self.get_entity_type_from_key(parent_event_key)
+                parent_entity = derived_event['entity']
+                if leaf_type == self.EVENT_CODE_MAPPING[parent_entity]:
+                    pending[parent_event_key] = parent_entity
+            else:
+                update_course = True
+        return update_course
+
     def _update_event(self, student, progress, event_entity, event_key,
                       direct_update=False):
         """Updates statistics for the given event, and for derived events.
@@ -928,6 +1222,23 @@ class UnitLessonCompletionTracker(object):
             progress.put()
         return progress
 
+    @classmethod
+    def get_progress_multi(cls, students):
+        """Loads the progress of many students with batched reads.
+
+        Returns a dict of user_id to progress entity. Unlike
+        get_or_create_progress() a student without progress gets a new entity
+        that is not saved, so read-only callers write nothing.
+        """
+        result = {}
+        for student, progress in zip(students, StudentPropertyEntity.get_multi(
+                students, cls.PROPERTY_KEY)):
+            if not progress:
+                progress = StudentPropertyEntity.create(
+                    student=student, property_name=cls.PROPERTY_KEY)
+            result[student.user_id] = progress
+        return result
+
     def get_course_progress(self, student):
         """Return [NOT_STARTED|IN_PROGRESS|COMPLETED]_STATE for course."""
         progress = self.get_or_create_progress(student)
@@ -999,11 +1310,14 @@ class UnitLessonCompletionTracker(object):
                             num_completed / float(len(lesson_progress)), 3)
         return result
 
-    def get_number_lessons_completed_for_powerful_idea_or_unit(self, student, main_lessons):
+    def get_number_lessons_completed_for_powerful_idea_or_unit(
+        self, student, main_lessons, progress=None):
+        """Returns (completed, total) for the lessons in a unit_id: list dict."""
         if student.is_transient:
-            return 0
+            return 0, 0
 
-        progress = self.get_or_create_progress(student)
+        if progress is None:
+            progress = self.get_or_create_progress(student)
         total = 0
         completed = 0
         for unit_id, lessons in main_lessons.iteritems():
@@ -1044,9 +1358,7 @@ class UnitLessonCompletionTracker(object):
             progress, unit_id, lesson_id, cpt_id) or 0
 
     def _get_entity_value(self, progress, event_key):
-        if not progress.value:
-            return None
-        return transforms.loads(progress.value).get(event_key)
+        return progress.get_value_dict().get(event_key)
 
     def _set_entity_value(self, student_property, key, value):
         """Sets the integer value of a student property.
@@ -1059,13 +1371,7 @@ class UnitLessonCompletionTracker(object):
           key: the student property whose value should be incremented
           value: the value to increment this property by
         """
-        try:
-            progress_dict = transforms.loads(student_property.value)
-        except (AttributeError, TypeError):
-            progress_dict = {}
-
-        progress_dict[key] = value
-        student_property.value = transforms.dumps(progress_dict)
+        student_property.set_value_item(key, value)
 
     def _inc(self, student_property, key, value=1):
         """Increments the integer value of a student property.
@@ -1078,16 +1384,7 @@ class UnitLessonCompletionTracker(object):
           key: the student property whose value should be incremented
           value: the value to increment this property by
         """
-        try:
-            progress_dict = transforms.loads(student_property.value)
-        except (AttributeError, TypeError):
-            progress_dict = {}
-
-        if key not in progress_dict:
-            progress_dict[key] = 0
-
-        progress_dict[key] += value
-        student_property.value = transforms.dumps(progress_dict)
+        student_property.inc_value_item(key, value)
 
     @classmethod
     def get_elements_from_key(cls, key):
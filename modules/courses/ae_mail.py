@@ -0,0 +1,551 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Queued delivery of adaptive encouragement emails.
+
+Handlers that decide a student should get an adaptive encouragement email do
+not talk to SendGrid themselves. They enqueue a small send intent and return;
+the intent is delivered later by AdaptiveEncouragementMailQueue, which runs as
+a push task queue handler and, for inactive users cron emails, records them in
+the student's AdaptiveEncouragement record once they have actually gone out.
+
+Emails go out through a mail transport. SendGridTransport reuses a kept-alive
+HTTPS connection to SendGrid per thread and sends one request per group of
+recipients that share a subject and body; the student's name is left in the body as the
+SendGrid substitution tag SUB_NAME, and its value is carried by each intent. FakeTransport records requests instead of sending them
+so delivery can be tested and benchmarked offline.
+
+Tests can switch the queue into local mode with use_local_queue(); intents
+are then kept in process and delivered synchronously by drain_local_queue().
+"""
+
+import collections
+import httplib
+import logging
+import socket
+import threading
+import time
+import urllib
+
+import sendgrid
+import webapp2
+
+from common import utils as common_utils
+from models import counters
+from models import models
+from models import transforms
+
+from google.appengine.api import namespace_manager
+from google.appengine.api import taskqueue
+
+SENDGRID_API_KEY = '<SENDGRID_API_KEY_HERE>'
+
+#change this value to your from email address
+FROM_EMAIL_ADDRESS = '<YOUR_FROM_EMAIL_ADDRESS_HERE>'
+
+# Maximum number of lesson emails and of feedback emails sent in one week; see
+# ae_quota.
+MAX_EMAILS_PER_WEEK = 4
+
+# The kind of each email: the weekly quota it counts against, or the flag it
+# sets once sent.
+COUNTER_LESSON = 'lesson'
+COUNTER_FEEDBACK = 'feedback'
+COUNTER_CRON_NOT_STARTED = 'cron_not_started'
+COUNTER_CRON_STARTED = 'cron_started'
+COUNTERS = [
+    COUNTER_LESSON, COUNTER_FEEDBACK,
+    COUNTER_CRON_NOT_STARTED, COUNTER_CRON_STARTED]
+
+# The AdaptiveEncouragement flag each inactive users cron email sets once sent.
+CRON_SENT_FLAGS = {
+    COUNTER_CRON_NOT_STARTED: 'cron_inactive_not_started_email',
+    COUNTER_CRON_STARTED: 'cron_inactive_started_email',
+}
+
+# Give up on an intent after this many failed delivery attempts.
+MAX_DELIVERY_ATTEMPTS = 10
+
+# SendGrid substitution tag for the student's name, the only part of an email
+# body that varies by recipient.
+SUB_NAME = '-name-'
+
+# The x-smtpapi header of a SendGrid v2 request takes up to 1000 recipients.
+MAX_RECIPIENTS_PER_REQUEST = 1000
+
+# Intents per queued task, which keeps task payloads well under the 100KB
+# task size limit.
+MAX_INTENTS_PER_TASK = 200
+
+# Seconds to wait for SendGrid before treating a request as failed.
+SENDGRID_TIMEOUT_SECS = 30
+
+SENDGRID_HOST = 'api.sendgrid.com'
+SENDGRID_MAIL_PATH = '/api/mail.send.json'
+
+# Seconds a connection to SendGrid is reused for after its last request; an
+# older one may have been closed by SendGrid, so a new one is opened.
+SENDGRID_KEEP_ALIVE_SECS = 15
+
+AE_MAIL_ENQUEUED = counters.PerfCounter(
+    'gcb-ae-mail-enqueued',
+    'A number of adaptive encouragement emails queued for delivery.')
+AE_MAIL_SENT = counters.PerfCounter(
+    'gcb-ae-mail-sent',
+    'A number of adaptive encouragement emails delivered to SendGrid.')
+AE_MAIL_FAILED = counters.PerfCounter(
+    'gcb-ae-mail-failed',
+    'A number of adaptive encouragement email delivery attempts that failed.')
+AE_MAIL_DROPPED = counters.PerfCounter(
+    'gcb-ae-mail-dropped',
+    'A number of adaptive encouragement emails given up on after retries.')
+AE_MAIL_REQUESTS = counters.PerfCounter(
+    'gcb-ae-mail-requests',
+    'A number of requests made to the adaptive encouragement mail transport.')
+
+
+def record_email_sent(ae, counter):
+    """Updates the AdaptiveEncouragement record after a successful send.
+
+    Only inactive users cron emails are recorded here; lesson and feedback
+    emails were counted against the weekly quota when they were queued, see
+    ae_quota.reserve().
+
+    Note: this method does not commit the change. The caller should call put()
+    on the AdaptiveEncouragement entity.
+    """
+    if counter in CRON_SENT_FLAGS:
+        setattr(ae, CRON_SENT_FLAGS[counter], True)
+
+
+def render_body(body, subs):
+    """Fills in substitution tags the way SendGrid does for one recipient."""
+    if subs:
+        for tag, value in subs.iteritems():
+            body = body.replace(tag, value)
+    return body
+
+
+class SendGridTransport(object):
+    """Sends emails to SendGrid over kept-alive HTTPS connections.
+
+    Each thread keeps one httplib.HTTPSConnection and reuses it for its
+    requests, so the requests of a delivery share one TLS handshake. On App
+    Engine connections are only kept alive when httplib uses the sockets API
+    (GAE_USE_SOCKETS_HTTPLIB in app.yaml); over urlfetch, App Engine manages
+    them. A connection is replaced after a failed request, when SendGrid asks
+    to close it, or once idle for SENDGRID_KEEP_ALIVE_SECS.
+    """
+
+    # Builds the form of a request the way the sendgrid library does.
+    _CLIENT = None
+    _LOCAL = threading.local()
+
+    @classmethod
+    def _get_client(cls):
+        if cls._CLIENT is None:
+            cls._CLIENT = sendgrid.SendGridClient(SENDGRID_API_KEY)
+        return cls._CLIENT
+
+    @classmethod
+    def _get_connection(cls, now):
+        connection = getattr(cls._LOCAL, 'connection', None)
+        if (connection is not None and
+            now - cls._LOCAL.used_on > SENDGRID_KEEP_ALIVE_SECS):
+            cls._close_connection()
+            connection = None
+        if connection is None:
+            connection = httplib.HTTPSConnection(
+                SENDGRID_HOST, timeout=SENDGRID_TIMEOUT_SECS)
+            cls._LOCAL.connection = connection
+        cls._LOCAL.used_on = now
+        return connection
+
+    @classmethod
+    def _close_connection(cls):
+        connection = getattr(cls._LOCAL, 'connection', None)
+        if connection is not None:
+            connection.close()
+        cls._LOCAL.connection = None
+
+    def send(self, subject, body, recipients):
+        """Sends one request for a list of (email_address, subs) recipients.
+
+        Args:
+          subject: the subject line shared by all recipients.
+          body: the HTML body, with substitution tags where it varies.
+          recipients: list of (email_address, subs) pairs; subs is a dict of
+              substitution tag to value for that recipient.
+
+        Returns:
+          True if SendGrid accepted the request, False if it refused it.
+
+        Raises:
+          httplib.HTTPException, socket.error: the request failed, and may or
+              may not have reached SendGrid.
+        """
+        tags = set()
+        for unused_email_address, subs in recipients:
+            tags.update(subs or {})
+
+        message = sendgrid.Mail()
+        message.set_subject(subject)
+        message.set_html(body)
+        message.set_from(FROM_EMAIL_ADDRESS)
+        message.smtpapi.set_tos(
+            [email_address for email_address, unused_subs in recipients])
+        if tags:
+            message.set_substitutions({
+                tag: [(subs or {}).get(tag, '')
+                      for unused_email_address, subs in recipients]
+                for tag in tags})
+
+        client = self._get_client()
+        form = urllib.urlencode(
+            client._build_body(message), True)  # pylint: disable=protected-access
+        headers = {
+            'Authorization': 'Bearer %s' % SENDGRID_API_KEY,
+            'Content-Type': 'application/x-www-form-urlencoded',
+            'User-Agent': client.useragent,
+        }
+        try:
+            connection = self._get_connection(time.time())
+            connection.request('POST', SENDGRID_MAIL_PATH, form, headers)
+            response = connection.getresponse()
+            # The response is read in full so the connection can be reused.
+            response_body = response.read()
+        except (httplib.HTTPException, socket.error):
+            self._close_connection()
+            raise
+        if response.will_close:
+            self._close_connection()
+        if response.status != 200:
+            logging.warning('SendGrid refused a request: %s %s',
+                            response.status, response_body)
+            return False
+        return True
+
+
+class FakeTransport(object):
+    """Records requests instead of sending them; for tests and benchmarks."""
+
+    def __init__(self, status=200, latency_secs=0):
+        self.status = status
+        self.latency_secs = latency_secs
+        self.requests = []
+        self.sent = []
+
+    def send(self, subject, body, recipients):
+        if self.latency_secs:
+            time.sleep(self.latency_secs)
+        self.requests.append((subject, body, list(recipients)))
+        if self.status != 200:
+            return False
+        for email_address, subs in recipients:
+            self.sent.append(
+                (email_address, subject, render_body(body, subs)))
+        return True
+
+
+_TRANSPORT = None
+
+
+def get_transport():
+    global _TRANSPORT  # pylint: disable=global-statement
+    if _TRANSPORT is None:
+        _TRANSPORT = SendGridTransport()
+    return _TRANSPORT
+
+
+def set_transport(transport):
+    """Replaces the transport used for all sends; None restores SendGrid."""
+    global _TRANSPORT  # pylint: disable=global-statement
+    _TRANSPORT = transport
+
+
+def send_email(email_address, subject, body, subs=None):
+    """Sends one email; returns True on success."""
+    if subject is None or body is None:
+        return False
+    AE_MAIL_REQUESTS.inc()
+    return get_transport().send(subject, body, [(email_address, subs)])
+
+
+def send_batched(intents, on_sent=None):
+    """Sends intents grouped by subject and body; returns the intents not sent.
+
+    Each group of intents sharing a subject and body goes out as one request
+    per MAX_RECIPIENTS_PER_REQUEST recipients, with each recipient's
+    substitutions filled in by SendGrid. A request that fails or raises only
+    fails its own intents; the other requests are still made.
+
+    Args:
+      intents: list of SendIntent.
+      on_sent: optional callable, called with the list of intents of each
+          request as soon as SendGrid has accepted it.
+    """
+    groups = collections.OrderedDict()
+    for intent in intents:
+        groups.setdefault((intent.subject, intent.body), []).append(intent)
+
+    transport = get_transport()
+    failed = []
+    for (subject, body), group in groups.iteritems():
+        for start in xrange(0, len(group), MAX_RECIPIENTS_PER_REQUEST):
+            chunk = group[start:start + MAX_RECIPIENTS_PER_REQUEST]
+            AE_MAIL_REQUESTS.inc()
+            try:
+                sent = transport.send(subject, body, [
+                    (intent.email_address, intent.subs) for intent in chunk])
+            except Exception:  # pylint: disable=broad-except
+                logging.exception(
+                    'Failed to send %d adaptive encouragement emails.',
+                    len(chunk))
+                sent = False
+            if not sent:
+                failed.extend(chunk)
+            elif on_sent:
+                on_sent(chunk)
+    return failed
+
+
+class SendIntent(object):
+    """A request to send one adaptive encouragement email to one student."""
+
+    def __init__(self, user_id, email_address, subject, body, counter,
+                 subs=None):
+        if counter not in COUNTERS:
+            raise ValueError('Counter "%s" not in allowed list: %s' % (
+                counter, ' '.join(COUNTERS)))
+        self.user_id = user_id
+        self.email_address = email_address
+        self.subject = subject
+        self.body = body
+        self.counter = counter
+        self.subs = subs or {}
+
+    @classmethod
+    def to_payload(cls, intents):
+        """Serializes intents, storing each distinct subject and body once."""
+        contents = []
+        content_index = {}
+        items = []
+        for intent in intents:
+            content = (intent.subject, intent.body)
+            if content not in content_index:
+                content_index[content] = len(contents)
+                contents.append(list(content))
+            items.append({
+                'u': intent.user_id,
+                'e': intent.email_address,
+                'c': intent.counter,
+                'x': content_index[content],
+                's': intent.subs,
+            })
+        return transforms.dumps({'contents': contents, 'intents': items})
+
+    @classmethod
+    def from_payload(cls, payload):
+        payload_dict = transforms.loads(payload)
+        contents = payload_dict['contents']
+        return [
+            cls(item['u'], item['e'], contents[item['x']][0],
+                contents[item['x']][1], item['c'], subs=item.get('s'))
+            for item in payload_dict['intents']]
+
+
+class AdaptiveEncouragementMailQueue(webapp2.RequestHandler):
+    """Push task queue handler that delivers queued send intents."""
+
+    QUEUE_NAME = 'default'
+    URL = '/_ah/queue/ae-mail'
+
+    # List of (namespace, intents, record_only) items when running in local
+    # mode; None when intents go to the App Engine task queue.
+    _LOCAL_QUEUE = None
+    # Names of the tasks queued in local mode, which like task names in the
+    # task queue can only be used once.
+    _LOCAL_TASK_NAMES = None
+
+    @classmethod
+    def use_local_queue(cls, enabled=True):
+        """Keeps intents in process instead of in the task queue."""
+        cls._LOCAL_QUEUE = [] if enabled else None
+        cls._LOCAL_TASK_NAMES = set() if enabled else None
+
+    @classmethod
+    def drain_local_queue(cls):
+        """Delivers all locally queued intents; returns the number sent."""
+        sent = 0
+        while cls._LOCAL_QUEUE:
+            namespace, intents, record_only = cls._LOCAL_QUEUE.pop(0)
+            with common_utils.Namespace(namespace):
+                if record_only:
+                    cls._record_sent(intents)
+                else:
+                    sent += len(intents) - len(cls.deliver(intents))
+        return sent
+
+    @classmethod
+    def enqueue(cls, user_id, email_address, subject, body, counter,
+                subs=None):
+        """Queues one email for delivery; returns True if it was queued."""
+        if not email_address or subject is None or body is None:
+            return False
+        cls.enqueue_intents([SendIntent(
+            user_id, email_address, subject, body, counter, subs=subs)])
+        return True
+
+    @classmethod
+    def enqueue_intents(cls, intents, task_name=None, record_only=False):
+        """Queues intents, MAX_INTENTS_PER_TASK to a task.
+
+        Args:
+          intents: list of SendIntent.
+          task_name: optional name for the tasks. Queueing the same intents
+              again under the same name is a no-op, so a caller that may retry
+              after a failure does not send emails twice.
+          record_only: bool. Whether the intents were sent already and the
+              tasks only record them.
+        """
+        intents = [intent for intent in intents if intent.email_address]
+        if not intents:
+            return
+        if not record_only:
+            AE_MAIL_ENQUEUED.inc(increment=len(intents))
+        namespace = namespace_manager.get_namespace()
+        for start in xrange(0, len(intents), MAX_INTENTS_PER_TASK):
+            chunk = intents[start:start + MAX_INTENTS_PER_TASK]
+            name = '%s-%d' % (task_name, start) if task_name else None
+            if cls._LOCAL_QUEUE is not None:
+                if name in cls._LOCAL_TASK_NAMES:
+                    logging.info('Task %s was already queued.', name)
+                    continue
+                if name:
+                    cls._LOCAL_TASK_NAMES.add(name)
+                cls._LOCAL_QUEUE.append((namespace, chunk, record_only))
+                continue
+            params = {
+                'namespace': namespace,
+                'intents': SendIntent.to_payload(chunk),
+            }
+            if record_only:
+                params['record_only'] = '1'
+            task = taskqueue.Task(url=cls.URL, name=name, params=params)
+            try:
+                task.add(cls.QUEUE_NAME)
+            except (taskqueue.TaskAlreadyExistsError,
+                    taskqueue.TombstonedTaskError):
+                logging.info('Task %s was already queued.', task.name)
+
+    @classmethod
+    def deliver(cls, intents):
+        """Sends intents in batches and records them; returns those not sent.
+
+        The intents of each request are recorded as soon as SendGrid accepts
+        it, so a failure later in the delivery does not lose the record of
+        emails already sent. Intents that were sent but could not be recorded
+        are queued to be recorded again, never to be sent again; only the
+        intents returned are left to send.
+        """
+        unrecorded = []
+
+        def on_sent(chunk):
+            AE_MAIL_SENT.inc(increment=len(chunk))
+            try:
+                cls._record_sent(chunk)
+            except Exception:  # pylint: disable=broad-except
+                logging.exception(
+                    'Failed to record %d sent adaptive encouragement emails.',
+                    len(chunk))
+                unrecorded.extend(chunk)
+
+        failed = send_batched(intents, on_sent=on_sent)
+        AE_MAIL_FAILED.inc(increment=len(failed))
+        if unrecorded:
+            try:
+                cls.enqueue_intents(unrecorded, record_only=True)
+            except Exception:  # pylint: disable=broad-except
+                logging.exception(
+                    'Failed to queue recording %d sent adaptive encouragement '
+                    'emails: %s', len(unrecorded),
+                    ' '.join(intent.user_id for intent in unrecorded))
+        return failed
+
+    @classmethod
+    def _record_sent(cls, intents):
+        """Records sent intents with one batched datastore get and put."""
+        intents = [
+            intent for intent in intents if intent.counter in CRON_SENT_FLAGS]
+        if not intents:
+            return
+        aes = models.AdaptiveEncouragement.get_multi_by_user_ids(
+            set(intent.user_id for intent in intents))
+        for intent in intents:
+            ae = aes.get(intent.user_id)
+            if ae is None:
+                ae = models.AdaptiveEncouragement._add_new(intent.user_id)
+                aes[intent.user_id] = ae
+            record_email_sent(ae, intent.counter)
+        models.AdaptiveEncouragement.put_multi(aes.values())
+
+    def post(self):
+        if 'X-AppEngine-QueueName' not in self.request.headers:
+            self.response.set_status(500)
+            return
+        try:
+            intents = SendIntent.from_payload(self.request.get('intents'))
+        except (IndexError, KeyError, TypeError, ValueError):
+            logging.critical(
+                'Adaptive encouragement mail queue had malformed item: %s',
+                self.request.get('intents'))
+            self.response.set_status(200)
+            return
+
+        with common_utils.Namespace(self.request.get('namespace')):
+            if self.request.get('record_only'):
+                # Sent already; errors propagate so the queue retries the
+                # record, which does not send anything.
+                self._record_sent(intents)
+                self.response.set_status(200)
+                return
+
+            failed = self.deliver(intents)
+            if not failed:
+                self.response.set_status(200)
+                return
+
+            num_tries = 1 + int(
+                self.request.headers.get('X-AppEngine-TaskExecutionCount', '0'))
+            if num_tries >= MAX_DELIVERY_ATTEMPTS:
+                AE_MAIL_DROPPED.inc(increment=len(failed))
+                logging.error(
+                    'Giving up on %d adaptive encouragement emails after %d '
+                    'attempts: %s', len(failed), num_tries,
+                    ' '.join(intent.user_id for intent in failed))
+                self.response.set_status(200)
+            elif len(failed) == len(intents):
+                # No progress at all; raise to get the queue's retry backoff.
+                raise RuntimeError(
+                    'Adaptive encouragement mail delivery failed; raising '
+                    'error to force retries.')
+            else:
+                # Some progress; re-enqueue only what is left to send.
+                self.enqueue_intents(failed)
+                self.response.set_status(200)
+
+
+def get_global_handlers():
+    return [
+        (AdaptiveEncouragementMailQueue.URL, AdaptiveEncouragementMailQueue)]
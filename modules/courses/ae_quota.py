@@ -0,0 +1,143 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Weekly send quota of adaptive encouragement emails.
+
+A student gets at most ae_mail.MAX_EMAILS_PER_WEEK lesson emails, and as many
+feedback emails, in a week; the week starts with the first email of either
+kind. reserve() checks the quota and takes an email from it in one atomic
+step, so parallel requests for one student cannot both take the last email.
+
+The count for the current week is kept in memcache, where memcache.incr()
+makes a reservation in one round trip. When the count is not in memcache the
+reservation is made in a datastore transaction on the student's
+AdaptiveEncouragement record, and memcache is seeded with the result until the
+week ends. Reservations made in memcache are copied into the record passed to
+reserve(), which the caller saves, so a count evicted from memcache is rebuilt
+from the datastore. AdaptiveEncouragement.put() merges the quota into the
+stored record in a transaction, keeping the later week and the higher counts,
+so saving a record loaded before another request's reservation does not undo
+that reservation.
+
+Inactive users cron emails have no weekly quota.
+"""
+
+from models import counters
+from models import models
+from modules.courses import ae_mail
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
+from datetime import datetime
+from datetime import timedelta
+
+# The AdaptiveEncouragement field counting each kind of email with a quota.
+QUOTA_FIELDS = {
+    ae_mail.COUNTER_LESSON: 'lesson_emails_sent',
+    ae_mail.COUNTER_FEEDBACK: 'feedback_emails_sent',
+}
+
+WEEK = timedelta(days=7)
+
+AE_QUOTA_RESERVED = counters.PerfCounter(
+    'gcb-ae-quota-reserved',
+    'A number of adaptive encouragement emails reserved from a weekly quota.')
+AE_QUOTA_DENIED = counters.PerfCounter(
+    'gcb-ae-quota-denied',
+    'A number of adaptive encouragement emails not sent because the weekly '
+    'quota was used up.')
+AE_QUOTA_DATASTORE = counters.PerfCounter(
+    'gcb-ae-quota-datastore',
+    'A number of weekly quota reservations made in a datastore transaction '
+    'because the count was not in memcache.')
+
+
+def _memcache_key(user_id, counter):
+    return 'ae-quota:%s:%s' % (counter, user_id)
+
+
+def _start_week_if_over(ae, now):
+    """Starts a new week of emails, resetting the counts, if ae's is over."""
+    first_sent = ae.first_ae_email_sent_in_week
+    if first_sent is None or first_sent <= now - WEEK:
+        ae.first_ae_email_sent_in_week = now
+        for field in QUOTA_FIELDS.itervalues():
+            setattr(ae, field, 0)
+
+
+def _reserve_in_datastore(user_id, field, now):
+    ae = models.AdaptiveEncouragement.get_by_key_name(user_id)
+    if ae is None:
+        ae = models.AdaptiveEncouragement._add_new(user_id)
+    _start_week_if_over(ae, now)
+    count = getattr(ae, field) or 0
+    reserved = count < ae_mail.MAX_EMAILS_PER_WEEK
+    if reserved:
+        setattr(ae, field, count + 1)
+        # Plain db.put(): the record is cached once the caller puts its copy.
+        db.put(ae)
+    return reserved, ae.first_ae_email_sent_in_week, dict(
+        (name, getattr(ae, name)) for name in QUOTA_FIELDS.itervalues())
+
+
+def reserve(ae, counter, now=None):
+    """Takes one email of a kind from the student's weekly quota.
+
+    Args:
+        ae: AdaptiveEncouragement. The student's record. Its week and counts
+            are brought up to date; the caller should put() it.
+        counter: str. One of ae_mail.COUNTERS.
+        now: datetime or None. Injectable for tests only.
+    Returns:
+        True if the email may be sent.
+    """
+    field = QUOTA_FIELDS.get(counter)
+    if field is None:
+        return True
+    now = now if now is not None else datetime.now()
+    key = _memcache_key(ae.user_id, counter)
+    namespace = models.MemcacheManager.get_namespace()
+
+    count = None
+    if models.CAN_USE_MEMCACHE.value:
+        count = memcache.incr(key, namespace=namespace)
+    if count is not None:
+        # Counts past the quota are harmless; the item expires with the week.
+        reserved = count <= ae_mail.MAX_EMAILS_PER_WEEK
+        if reserved:
+            _start_week_if_over(ae, now)
+            setattr(ae, field, max(getattr(ae, field) or 0, count))
+    else:
+        AE_QUOTA_DATASTORE.inc()
+        reserved, week_start, counts = db.run_in_transaction(
+            _reserve_in_datastore, ae.user_id, field, now)
+        ae.first_ae_email_sent_in_week = week_start
+        for name, value in counts.iteritems():
+            setattr(ae, name, value)
+        if models.CAN_USE_MEMCACHE.value:
+            ttl = week_start + WEEK - now
+            ttl = ttl.days * 24 * 60 * 60 + ttl.seconds + 1
+            if not memcache.add(
+                    key, counts[field], time=ttl, namespace=namespace):
+                # Another request seeded the count first, maybe without this
+                # reservation; adding it errs on the side of the quota.
+                if reserved:
+                    memcache.incr(key, namespace=namespace)
+
+    if reserved:
+        AE_QUOTA_RESERVED.inc()
+    else:
+        AE_QUOTA_DENIED.inc()
+    return reserved
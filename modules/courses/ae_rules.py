@@ -0,0 +1,457 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Rules deciding when adaptive encouragement emails are sent.
+
+Each rule is a plain dict saying which event it applies to, the condition a
+student must meet and the email to send. DEFAULT_RULES holds the Citizen Maths
+rules; a course can replace them with a list of its own under
+adaptive_encouragement: rules: in course.yaml.
+
+The rules of a course are compiled once into a RulePlan, which is cached per
+course namespace and only rebuilt when the course's rules change. Handlers ask
+the plan which emails are due:
+
+    plan = ae_rules.get_plan(app_context)
+    matches = plan.evaluate_lesson(
+        progress_tracker, student_progress, student, lesson_entry)
+
+Rules are checked against data the handler has already loaded, so adding a
+rule adds no datastore reads.
+
+Lesson rules:
+  scope: 'pi' or 'unit'; the main lessons of the lesson's powerful idea or
+      unit are counted.
+  measure: 'completed' or 'remaining' lessons in the scope.
+  equals: the number of lessons the measure must equal.
+  sent_list: the AdaptiveEncouragement field listing the powerful ideas or
+      units this email has already been sent for.
+  subject, text: the email; text may use {pi}, {unit_name} and {unit_number}.
+      Rules whose text has other slots or unbalanced braces are rejected.
+
+Feedback rules (the first matching rule is used):
+  narrative: True for feedback with written comments, False otherwise.
+  counts: list of feedback counts that match; or
+  every, after: match every 'every' feedbacks after the first 'after'.
+  enrolled_after: optional 'YYYY-MM-DD'; only students enrolled after it.
+  subject, text: the email.
+
+Inactive rules, checked by the inactive users cron:
+  counter: ae_mail.COUNTER_CRON_NOT_STARTED or ae_mail.COUNTER_CRON_STARTED;
+      the email is sent once per student per counter.
+  enrolled_days, last_seen_days, progress_days: optional; the student must have
+      enrolled, been last seen, or last made progress more than this many days
+      ago.
+  completed_min, completed_max: optional bounds on main lessons completed.
+  assessment_not_completed: optional assessment id the student must not have
+      completed.
+  subject, text: the email.
+"""
+
+import collections
+import logging
+import time
+
+from models import transforms
+from modules.courses import ae_mail
+from modules.courses import ae_templates
+
+from datetime import datetime
+from datetime import timedelta
+
+KIND_LESSON = 'lesson'
+KIND_FEEDBACK = 'feedback'
+KIND_INACTIVE = 'inactive'
+
+SCOPE_PI = 'pi'
+SCOPE_UNIT = 'unit'
+
+MEASURE_COMPLETED = 'completed'
+MEASURE_REMAINING = 'remaining'
+
+# The {name} slots the text of a lesson rule may use.
+LESSON_TEXT_SLOTS = frozenset(['pi', 'unit_name', 'unit_number'])
+
+# Sent-lists a lesson rule can record sent emails in; the names are those of
+# AdaptiveEncouragement.SENT_LIST_PROPERTIES.
+SENT_LISTS = [
+    'pi_started_emails_sent',
+    'unit_completed_emails_sent',
+    'pi_completed_emails_sent',
+]
+
+PROGRESS_SUBJECT = 'A message about your progress in Citizen Maths'
+TEAM_SUBJECT = 'A message from the Citizen Maths team'
+WRITTEN_FEEDBACK_SUBJECT = 'Citizen Maths: your written feedback'
+
+DEFAULT_RULES = [
+    {
+        'id': 'pi_started',
+        'kind': KIND_LESSON,
+        'scope': SCOPE_PI,
+        'measure': MEASURE_COMPLETED,
+        'equals': 2,
+        'sent_list': 'pi_started_emails_sent',
+        'subject': PROGRESS_SUBJECT,
+        'text': (
+            "We are glad that you've made a start with {pi} in the Citizen "
+            "Maths course. We encourage you to keep going; a good way to do "
+            "this is likely to be to set aside a bit of time on most days to "
+            "do one or two lessons until you've completed the whole course."),
+    },
+    {
+        'id': 'unit_nearly_completed',
+        'kind': KIND_LESSON,
+        'scope': SCOPE_UNIT,
+        'measure': MEASURE_REMAINING,
+        'equals': 1,
+        'sent_list': 'unit_completed_emails_sent',
+        'subject': PROGRESS_SUBJECT,
+        'text': (
+            "We thought you'd like to know that you've only got one more "
+            "lesson to go in {unit_number} - {unit_name}, in the Citizen Maths "
+            "course. We encourage you to finish {unit_number} now (if you have "
+            "not already done so) whilst what you have been doing is fresh in "
+            "your mind."),
+    },
+    {
+        'id': 'pi_nearly_completed',
+        'kind': KIND_LESSON,
+        'scope': SCOPE_PI,
+        'measure': MEASURE_REMAINING,
+        'equals': 3,
+        'sent_list': 'pi_completed_emails_sent',
+        'subject': PROGRESS_SUBJECT,
+        'text': (
+            "We thought you'd like to know that you've now got just three "
+            "lessons to go to complete {pi} in the Citizen Maths course. We "
+            "encourage you to finish {pi} now whilst things are fresh in your "
+            "mind."),
+    },
+    {
+        'id': 'written_feedback_first',
+        'kind': KIND_FEEDBACK,
+        'narrative': True,
+        'counts': [1],
+        'subject': WRITTEN_FEEDBACK_SUBJECT,
+        'text': (
+            'Thanks very much for providing written feedback on Citizen '
+            'Maths. We try to read all of it, and what learners tell us will '
+            'help us improve Citizen Maths in the future. Please continue to '
+            'provide it.'),
+    },
+    {
+        'id': 'written_feedback_continued',
+        'kind': KIND_FEEDBACK,
+        'narrative': True,
+        'counts': [4],
+        'subject': WRITTEN_FEEDBACK_SUBJECT,
+        'text': (
+            'Thanks very much for continuing to provide written feedback on '
+            'Citizen Maths. As we mentioned previously we do try to read all '
+            'of it, and, when we can, to act on it. Please continue to provide '
+            'it.'),
+    },
+    {
+        'id': 'feedback_started',
+        'kind': KIND_FEEDBACK,
+        'narrative': False,
+        'counts': [2],
+        'enrolled_after': '2016-11-01',
+        'subject': TEAM_SUBJECT,
+        'text': (
+            'Thank you for beginning to give us feedback on Citizen Maths. By '
+            'doing so you are helping us to understand the impact that Citizen '
+            'Maths is having.'),
+    },
+    {
+        'id': 'feedback_continued',
+        'kind': KIND_FEEDBACK,
+        'narrative': False,
+        'counts': [8],
+        'subject': TEAM_SUBJECT,
+        'text': (
+            "Thanks for continuing to provide feedback on Citizen Maths. "
+            "Whilst we don't look at every piece of feedback, we do analyse the "
+            "feedback data overall. This helps us to understand the impact "
+            "that Citizen Maths is having."),
+    },
+    {
+        'id': 'feedback_every_ten',
+        'kind': KIND_FEEDBACK,
+        'narrative': False,
+        'every': 10,
+        'after': 8,
+        'subject': TEAM_SUBJECT,
+        'text': (
+            'Thanks for continuing to provide feedback on Citizen Maths. '
+            'Please continue to provide feedback. We really appreciate it.'),
+    },
+    {
+        'id': 'inactive_not_started',
+        'kind': KIND_INACTIVE,
+        'counter': ae_mail.COUNTER_CRON_NOT_STARTED,
+        'enrolled_days': 7,
+        'completed_max': 0,
+        'subject': TEAM_SUBJECT,
+        'text': (
+            'We noticed that in the week since you signed up for Citizen '
+            'Maths, you seem not to have got started with the course.'
+            "<br><br>We'd encourage you to make a start. If you do so, you can "
+            'do as much or as little as you like in session.'
+            '<br><br>In case of difficulty, feel free to get in touch and we '
+            'will do what we can to help.'),
+    },
+    {
+        'id': 'inactive_started',
+        'kind': KIND_INACTIVE,
+        'counter': ae_mail.COUNTER_CRON_STARTED,
+        'last_seen_days': 14,
+        'progress_days': 14,
+        'completed_min': 1,
+        'assessment_not_completed': 176,
+        'subject': TEAM_SUBJECT,
+        'text': (
+            'We noticed that it is two weeks since you last logged into '
+            'Citizen Maths.'
+            '<br><br>We hope very much that you will give Citizen Maths '
+            'another try.'
+            '<br><br>In case of difficulty, feel free to get in touch and we '
+            'will do what we can to help.'),
+    },
+]
+
+# A rule that matched: the email to send and, for lesson rules, the
+# AdaptiveEncouragement list and value that record it as sent.
+Match = collections.namedtuple(
+    'Match', ['rule_id', 'subject', 'text', 'sent_list', 'sent_value'])
+
+
+def _get_scope(lesson_entry, scope):
+    """Returns (name, main lessons) of the lesson's powerful idea or unit."""
+    if scope == SCOPE_PI:
+        return lesson_entry.pi, lesson_entry.pi_lessons
+    return lesson_entry.unit_name, lesson_entry.unit_lessons
+
+
+class RulePlan(object):
+    """Rules of one course compiled for evaluation."""
+
+    def __init__(self, rules):
+        self.lesson_rules = []
+        self.feedback_rules = {True: [], False: []}
+        self.inactive_rules = []
+        for rule in rules:
+            self._add_rule(rule)
+        self.inactive_windows = self._get_inactive_windows()
+
+    def _add_rule(self, rule):
+        rule_id = rule.get('id')
+        for field in ('kind', 'subject', 'text'):
+            if not rule.get(field):
+                raise ValueError('Rule %s has no %s.' % (rule_id, field))
+
+        kind = rule['kind']
+        if kind == KIND_LESSON:
+            if rule.get('scope') not in (SCOPE_PI, SCOPE_UNIT):
+                raise ValueError('Rule %s has a bad scope.' % rule_id)
+            if rule.get('measure') not in (
+                    MEASURE_COMPLETED, MEASURE_REMAINING):
+                raise ValueError('Rule %s has a bad measure.' % rule_id)
+            if rule.get('sent_list') not in SENT_LISTS:
+                raise ValueError('Rule %s has a bad sent_list.' % rule_id)
+            # Raises ValueError on unbalanced braces.
+            text = ae_templates.Template.compile(rule['text'])
+            unknown_slots = text.slot_names - LESSON_TEXT_SLOTS
+            if unknown_slots:
+                raise ValueError('Rule %s text has unknown slots: %s' % (
+                    rule_id, ', '.join(sorted(unknown_slots))))
+            self.lesson_rules.append((
+                rule_id, rule['scope'], rule['measure'], int(rule['equals']),
+                rule['sent_list'], rule['subject'], text))
+        elif kind == KIND_FEEDBACK:
+            counts = frozenset(int(count) for count in rule.get('counts', []))
+            every = int(rule.get('every', 0))
+            if not counts and not every:
+                raise ValueError('Rule %s has no counts or every.' % rule_id)
+            enrolled_after = rule.get('enrolled_after')
+            if enrolled_after:
+                enrolled_after = datetime.strptime(enrolled_after, '%Y-%m-%d')
+            self.feedback_rules[bool(rule.get('narrative'))].append((
+                rule_id, counts, every, int(rule.get('after', 0)),
+                enrolled_after, rule['subject'], rule['text']))
+        elif kind == KIND_INACTIVE:
+            if rule.get('counter') not in ae_mail.CRON_SENT_FLAGS:
+                raise ValueError('Rule %s has a bad counter.' % rule_id)
+            self.inactive_rules.append((rule_id, rule))
+        else:
+            raise ValueError('Rule %s has unknown kind %s.' % (rule_id, kind))
+
+    def _get_inactive_windows(self):
+        """Groups inactive rules by the indexed Student property they bound.
+
+        Returns a list of (property name, days, rule ids): a student can only
+        match the rules once the property is more than that many days old.
+        Rules with neither last_seen_days nor enrolled_days are grouped under
+        enrolled_on with 0 days.
+        """
+        windows = collections.OrderedDict()
+        for rule_id, rule in self.inactive_rules:
+            if 'last_seen_days' in rule:
+                window = ('last_seen_on', rule['last_seen_days'])
+            else:
+                window = ('enrolled_on', rule.get('enrolled_days', 0))
+            windows.setdefault(window, []).append(rule_id)
+        return [
+            (name, days, rule_ids)
+            for (name, days), rule_ids in windows.iteritems()]
+
+    def evaluate_lesson(self, progress_tracker, student_progress, student,
+                        lesson_entry):
+        """Returns Matches for the lesson rules the student now meets.
+
+        Lessons are counted once per scope however many rules use it.
+        """
+        matches = []
+        counts = {}
+        values = {
+            'pi': lesson_entry.pi,
+            'unit_name': lesson_entry.unit_name,
+            'unit_number': lesson_entry.unit_number}
+        for (rule_id, scope, measure, equals, sent_list, subject,
+             text) in self.lesson_rules:
+            name, main_lessons = _get_scope(lesson_entry, scope)
+            if name is None:
+                continue
+            if scope not in counts:
+                counts[scope] = (
+                    progress_tracker.
+                    get_number_lessons_completed_for_powerful_idea_or_unit(
+                        student, main_lessons, progress=student_progress))
+            completed, total = counts[scope]
+            actual = (
+                completed if measure == MEASURE_COMPLETED
+                else total - completed)
+            if actual == equals:
+                matches.append(Match(
+                    rule_id, subject, text.render(**values), sent_list, name))
+        return matches
+
+    def evaluate_feedback(self, feedback_count, has_narrative, enrolled_on):
+        """Returns the Match for the first feedback rule met, or None."""
+        for (rule_id, counts, every, after, enrolled_after, subject,
+             text) in self.feedback_rules[bool(has_narrative)]:
+            if feedback_count in counts:
+                pass
+            elif every and feedback_count > after and (
+                    (feedback_count - after) % every == 0):
+                pass
+            else:
+                continue
+            if enrolled_after and not enrolled_on > enrolled_after:
+                continue
+            return Match(rule_id, subject, text, None, None)
+        return None
+
+    def is_inactive_sent(self, ae, rule_ids):
+        """Whether every one of the given inactive rules has been sent."""
+        for rule_id, rule in self.inactive_rules:
+            if rule_id in rule_ids and not getattr(
+                    ae, ae_mail.CRON_SENT_FLAGS[rule['counter']]):
+                return False
+        return True
+
+    def evaluate_inactive(self, now, student, completed, progress_tracker,
+                          student_progress, ae, rule_ids=None):
+        """Returns (counter, Match) for inactive rules not yet sent.
+
+        Only the rules in rule_ids are checked, if given.
+        """
+        matches = []
+        for rule_id, rule in self.inactive_rules:
+            if rule_ids is not None and rule_id not in rule_ids:
+                continue
+            counter = rule['counter']
+            if getattr(ae, ae_mail.CRON_SENT_FLAGS[counter]):
+                continue
+            if 'completed_min' in rule and completed < rule['completed_min']:
+                continue
+            if 'completed_max' in rule and completed > rule['completed_max']:
+                continue
+            if 'enrolled_days' in rule and not (
+                    student.enrolled_on < now - timedelta(
+                        days=rule['enrolled_days'])):
+                continue
+            if 'last_seen_days' in rule and not (
+                    student.last_seen_on is not None and
+                    student.last_seen_on < now - timedelta(
+                        days=rule['last_seen_days'])):
+                continue
+            if 'assessment_not_completed' in rule and (
+                    progress_tracker.is_assessment_completed(
+                        student_progress, rule['assessment_not_completed'])):
+                continue
+            if 'progress_days' in rule and not (
+                    student_progress is not None and
+                    student_progress.updated_on is not None and
+                    student_progress.updated_on < now - timedelta(
+                        days=rule['progress_days'])):
+                continue
+            matches.append((counter, Match(
+                rule_id, rule['subject'], rule['text'], None, None)))
+        return matches
+
+
+# Seconds a plan is used for before the course's rules are serialized again to
+# check whether they changed; the same rules object is never checked.
+PLAN_CHECK_SECS = 60
+
+# Namespace to (rules as JSON, rules, checked_on, RulePlan) for each course
+# seen by the instance.
+_PLANS = {}
+
+
+def _get_course_rules(app_context):
+    settings = app_context.get_environ().get('adaptive_encouragement') or {}
+    return settings.get('rules') or DEFAULT_RULES
+
+
+def get_plan(app_context):
+    """Gets the compiled rules of a course, compiling them on first use.
+
+    The rules are only serialized to see whether they changed when the course
+    settings hand back a different rules object and the plan was last checked
+    PLAN_CHECK_SECS ago or more.
+    """
+    rules = _get_course_rules(app_context)
+    namespace = app_context.get_namespace_name()
+    now = time.time()
+    cached = _PLANS.get(namespace)
+    if cached and (
+            cached[1] is rules or now - cached[2] < PLAN_CHECK_SECS):
+        return cached[3]
+
+    rules_json = transforms.dumps(rules, sort_keys=True)
+    if cached and cached[0] == rules_json:
+        plan = cached[3]
+    else:
+        try:
+            plan = RulePlan(rules)
+        except (KeyError, TypeError, ValueError) as e:
+            logging.error(
+                'Bad adaptive encouragement rules in %s, using defaults: %s',
+                namespace, e)
+            plan = RulePlan(DEFAULT_RULES)
+    _PLANS[namespace] = (rules_json, rules, now, plan)
+    return plan
@@ -0,0 +1,162 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Adaptive encouragement email bodies, compiled once per process.
+
+Every email body has one of three layouts:
+  LAYOUT_LESSON: sent from a lesson page; its notes link to that page.
+  LAYOUT_FEEDBACK: sent when a lesson is rated; its notes link to the lesson.
+  LAYOUT_INACTIVE: sent by the inactive users cron.
+
+A layout is compiled into a Template: a list of fragments holding the static
+HTML as literal strings, and the slots filled in per email. The first time a
+rule's email text is used it is compiled into its layout as a literal too, so
+rendering an email is a single ''.join() with only the slots left to fill.
+
+The student's name is not a slot. It is left in every body as the SendGrid
+substitution tag ae_mail.SUB_NAME, so the students sent the same email share
+one body and one SendGrid request.
+"""
+
+import string
+
+from modules.courses import ae_mail
+
+LAYOUT_LESSON = 'lesson'
+LAYOUT_FEEDBACK = 'feedback'
+LAYOUT_INACTIVE = 'inactive'
+
+_HELLO = 'Hello %s,<br><br>' % ae_mail.SUB_NAME
+
+_REGARDS = """<br><br>Regards,<br>
+                     Seb Schmoller<br>
+                     For the Citizen Maths Team<br>
+                     <a href='https://citizenmaths.com/' target='_blank'>https://citizenmaths.com/</a><br><br>"""
+
+_UNSUBSCRIBE = """You've received this email because when you registered for Citizen Maths you opted to be sent occasional encouraging emails about your progress with Citizen Maths.
+                    <br><br>If you would like to unsubscribe to this service, please go to your profile page at <a href='https://course.citizenmaths.com/main/student/home' target='_blank'>https://course.citizenmaths.com/main/student/home</a> and click the "Unsubscribe from encouragement emails" button."""
+
+_SENT_FROM = "<br>Notes<br>The course page this email was sent from was <a href='%(url)s' target='_blank'>%(url)s</a>. You may have got further on in Citizen Maths in the period before you opened this email."
+
+# Layout sources; {text} is the rule's email text, the other names are slots.
+LAYOUTS = {
+    LAYOUT_LESSON: ''.join([
+        _HELLO, '{text}', _REGARDS,
+        _SENT_FROM % {'url': 'https://course.citizenmaths.com/main/unit?unit={unit_id}&lesson={lesson_id}'},
+        '<br><br>', _UNSUBSCRIBE]),
+    LAYOUT_FEEDBACK: ''.join([
+        _HELLO, '{text}', _REGARDS,
+        _SENT_FROM % {'url': 'https://course.citizenmaths.com{lesson_key}'},
+        '<br><br>', _UNSUBSCRIBE]),
+    LAYOUT_INACTIVE: ''.join([
+        _HELLO, '{text}', _REGARDS, '<br>Notes<br>', _UNSUBSCRIBE]),
+}
+
+# Most compiled (layout, text) templates kept; rule texts are few, but a course
+# can change its rules any number of times.
+MAX_TEMPLATES = 1000
+
+
+class Template(object):
+    """A body compiled into literal fragments and named slots."""
+
+    def __init__(self, fragments):
+        """Creates a template.
+
+        Args:
+            fragments: list of (literal, slot_name) pairs; exactly one of the
+                two is not None in each.
+        """
+        self._fragments = []
+        self._slots = []
+        for literal, name in fragments:
+            if name is not None:
+                self._slots.append((len(self._fragments), name))
+                self._fragments.append(None)
+            elif self._fragments and self._fragments[-1] is not None:
+                self._fragments[-1] += literal
+            else:
+                self._fragments.append(literal)
+        self.slot_names = frozenset(name for unused_index, name in self._slots)
+        self._constant = None if self._slots else ''.join(self._fragments)
+
+    @classmethod
+    def compile(cls, source):
+        """Compiles a source with str.format() style {name} slots."""
+        fragments = []
+        for literal, name, unused_spec, unused_conversion in (
+                string.Formatter().parse(source)):
+            if literal:
+                fragments.append((literal, None))
+            if name is not None:
+                fragments.append((None, name))
+        return cls(fragments)
+
+    def bind(self, **values):
+        """Returns a template with the given slots filled in as literals."""
+        fragments = []
+        slots = dict(self._slots)
+        for index, fragment in enumerate(self._fragments):
+            name = slots.get(index)
+            if name is None:
+                fragments.append((fragment, None))
+            elif name in values:
+                fragments.append(('%s' % values[name], None))
+            else:
+                fragments.append((None, name))
+        return Template(fragments)
+
+    def render(self, **values):
+        """Returns the body with every slot filled in from values."""
+        if self._constant is not None:
+            return self._constant
+        fragments = list(self._fragments)
+        for index, name in self._slots:
+            fragments[index] = '%s' % values[name]
+        return ''.join(fragments)
+
+    def render_batch(self, values_list):
+        """Returns a body for each dict of slot values in values_list."""
+        if self._constant is not None:
+            return [self._constant] * len(values_list)
+        return [self.render(**values) for values in values_list]
+
+
+_LAYOUT_TEMPLATES = dict(
+    (layout, Template.compile(source)) for layout, source in LAYOUTS.iteritems())
+
+# Layout templates with a rule's text bound, by (layout, text).
+_TEMPLATES = {}
+
+
+def get_template(layout, text):
+    """Gets the template of a layout with a rule's text; compiled once."""
+    key = (layout, text)
+    template = _TEMPLATES.get(key)
+    if template is None:
+        if len(_TEMPLATES) >= MAX_TEMPLATES:
+            _TEMPLATES.clear()
+        template = _LAYOUT_TEMPLATES[layout].bind(text=text)
+        _TEMPLATES[key] = template
+    return template
+
+
+def render(layout, text, **values):
+    """Renders one email body of a layout with a rule's text."""
+    return get_template(layout, text).render(**values)
+
+
+def render_batch(layout, text, values_list):
+    """Renders an email body for each dict of slot values in values_list."""
+    return get_template(layout, text).render_batch(values_list)
@@ -21,9 +21,11 @@ from controllers import utils
 from models import content
 from models import resources_display
 from models import custom_modules
+from models import models
 from models import roles
 from models import student_labels
 from modules.courses import admin_preferences_editor
+from modules.courses import ae_mail
 from modules.courses import assets
 from modules.courses import availability
 from modules.courses import lessons
@@ -90,11 +92,18 @@ def register_module():
     courses_routes += student_labels.get_namespaced_handlers()
     courses_routes += lessons.get_namespaced_handlers()
 
+    global_routes = [
+        (lessons.InactiveUsersAdaptiveEncouragementCronHandler.URL, lessons.InactiveUsersAdaptiveEncouragementCronHandler),
+        (lessons.InactiveUsersAdaptiveEncouragementShard.URL, lessons.InactiveUsersAdaptiveEncouragementShard),
+        (lessons.EventPipeline.URL, lessons.EventPipeline),
+        (models.JsonDaoAllMappedRefresher.URL, models.JsonDaoAllMappedRefresher)]
+    global_routes += ae_mail.get_global_handlers()
+
     global custom_module  # pylint: disable=global-statement
     custom_module = custom_modules.Module(
         MODULE_NAME,
         'A set of pages for delivering an online course.',
-        [(lessons.InactiveUsersAdaptiveEncouragementCronHandler.URL, lessons.InactiveUsersAdaptiveEncouragementCronHandler)],
+        global_routes,
         courses_routes,
         notify_module_enabled=on_module_enabled)
     return custom_module
@@ -17,22 +17,28 @@
 __author__ = 'Saifu Angto (saifu@google.com)'
 
 
+import collections
 import copy
 import datetime
+import hashlib
 import re
+import threading
+import time
 import urllib
 import urlparse
+import uuid
 import logging
 
-import sendgrid
 import webapp2
 
-import ast
-
+import appengine_config
 from common import crypto
 from common import jinja_utils
 from common import safe_dom
+from common import utils as common_utils
+from controllers import sites
 from controllers import utils
+from models import config
 from models import counters
 from models import courses
 from models import custom_modules
@@ -43,12 +49,20 @@ from models import roles
 from models import student_work
 from models import transforms
 from modules.assessments import assessments
+from modules.courses import ae_mail
+from modules.courses import ae_quota
+from modules.courses import ae_rules
+from modules.courses import ae_templates
 from modules.courses import unit_outline
 from modules.review import domain
 from tools import verify
 
 from modules.gitkit import gitkit
 
+from google.appengine.api import background_thread
+from google.appengine.api import namespace_manager
+from google.appengine.api import runtime
+from google.appengine.api import taskqueue
 from google.appengine.ext import db
 
 from datetime import datetime
@@ -62,6 +76,16 @@ COURSE_EVENTS_RECORDED = counters.PerfCounter(
     'gcb-course-events-recorded',
     'A number of activity/assessment events recorded in a datastore.')
 
+EVENTS_PIPELINE_ENABLED = config.ConfigProperty(
+    'gcb_events_pipeline_enabled', bool,
+    'Whether to record activity/assessment events, and the progress they '
+    'make, in batches after the request that received them. Only instances '
+    'that can run background threads (manual or basic scaling) batch events; '
+    'others record them as they arrive. Buffered events are handed over when '
+    'an instance is shut down, but up to 10 seconds of events are lost if an '
+    'instance stops without being shut down (e.g. it crashes).',
+    default_value=False, label='Events Pipeline')
+
 UNIT_PAGE_TYPE = 'unit'
 ACTIVITY_PAGE_TYPE = 'activity'
 ASSESSMENT_PAGE_TYPE = 'assessment'
@@ -71,8 +95,6 @@ TAGS_THAT_TRIGGER_BLOCK_COMPLETION = ['attempt-activity']
 TAGS_THAT_TRIGGER_COMPONENT_COMPLETION = ['tag-assessment']
 TAGS_THAT_TRIGGER_HTML_COMPLETION = ['attempt-lesson']
 
-SENDGRID_API_KEY = '<SENDGRID_API_KEY_HERE>'
-
 PI_PROPORTION = 'Proportion'
 PI_REPRESENTATION = 'Representation'
 PI_MEASUREMENT = 'Measurement'
@@ -173,19 +195,66 @@ DICT_CONVERTING = {151:[153, 154, 155]}
 DICT_ESTIMATING = {157:[159, 160, 161, 162]}
 DICT_QUANTIFYING = {164:[166, 167, 168, 169]}
 
-EOCQ_ASSESSMENT_ID = 176
-
-LOGIC_PI_STARTED = 0
-LOGIC_UC = 1
-LOGIC_PI_COMPLETED = 2
-
-INACTIVE_EMAIL_SUBJECT = "A message from the Citizen Maths team"
-INACTIVE_SEVEN_DAYS_EMAIL_TEXT = """We noticed that in the week since you signed up for Citizen Maths, you seem not to have got started with the course.
-                                    <br><br>We'd encourage you to make a start. If you do so, you can do as much or as little as you like in session.
-                                    <br><br>In case of difficulty, feel free to get in touch and we will do what we can to help."""
-INACTIVE_TWO_WEEKS_EMAIL_TEXT = """We noticed that it is two weeks since you last logged into Citizen Maths.
-                                   <br><br>We hope very much that you will give Citizen Maths another try. 
-                                   <br><br>In case of difficulty, feel free to get in touch and we will do what we can to help."""
+#powerful ideas and units in the order a lesson is matched against them
+POWERFUL_IDEAS = [
+    (PI_PROPORTION, ML_PROPORTION, DICT_PROPORTION),
+    (PI_UNCERTAINTY, ML_UNCERTAINTY, DICT_UNCERTAINTY),
+    (PI_REPRESENTATION, ML_REPRESENTATION, DICT_REPRESENTATION),
+    (PI_PATTERN, ML_PATTERN, DICT_PATTERN),
+    (PI_MEASUREMENT, ML_MEASUREMENT, DICT_MEASUREMENT),
+]
+UNITS = [
+    (UN_MIXING, UN_NO_MIXING, ML_MIXING, DICT_MIXING),
+    (UN_COMPARING, UN_NO_COMPARING, ML_COMPARING, DICT_COMPARING),
+    (UN_SCALING, UN_NO_SCALING, ML_SCALING, DICT_SCALING),
+    (UN_SHARING, UN_NO_SHARING, ML_SHARING, DICT_SHARING),
+    (UN_TRADING_OFF, UN_NO_TRADING_OFF, ML_TRADING_OFF, DICT_TRADING_OFF),
+    (UN_MAKING_DECISIONS, UN_NO_MAKING_DECISIONS, ML_MAKING_DECISIONS, DICT_MAKING_DECISIONS),
+    (UN_PLAYING, UN_NO_PLAYING, ML_PLAYING, DICT_PLAYING),
+    (UN_SIMULATING, UN_NO_SIMULATING, ML_SIMULATING, DICT_SIMULATING),
+    (UN_INTERPRETING_DATA, UN_NO_INTERPRETING_DATA, ML_INTERPRETING_DATA, DICT_INTERPRETING_DATA),
+    (UN_INTERPRETING_CHARTS, UN_NO_INTERPRETING_CHARTS, ML_INTERPRETING_CHARTS, DICT_INTERPRETING_CHARTS),
+    (UN_COMPARING_GROUPS, UN_NO_COMPARING_GROUPS, ML_COMPARING_GROUPS, DICT_COMPARING_GROUPS),
+    (UN_APPRECIATING, UN_NO_APPRECIATING, ML_APPRECIATING, DICT_APPRECIATING),
+    (UN_TILING, UN_NO_TILING, ML_TILING, DICT_TILING),
+    (UN_CONSTRUCTING, UN_NO_CONSTRUCTING, ML_CONSTRUCTING, DICT_CONSTRUCTING),
+    (UN_READING_SCALES, UN_NO_READING_SCALES, ML_READING_SCALES, DICT_READING_SCALES),
+    (UN_CONVERTING, UN_NO_CONVERTING, ML_CONVERTING, DICT_CONVERTING),
+    (UN_ESTIMATING, UN_NO_ESTIMATING, ML_ESTIMATING, DICT_ESTIMATING),
+    (UN_QUANTIFYING, UN_NO_QUANTIFYING, ML_QUANTIFYING, DICT_QUANTIFYING),
+]
+
+#what a main lesson belongs to: its powerful idea and unit, and the main lessons of each
+LessonIndexEntry = collections.namedtuple('LessonIndexEntry', [
+    'pi', 'pi_lessons', 'unit_name', 'unit_number', 'unit_lessons'])
+
+
+def _build_lesson_index():
+    #a lesson listed twice belongs to the first powerful idea or unit it is listed in
+    pis = {}
+    for pi, lesson_ids, mls in POWERFUL_IDEAS:
+        for lesson_id in lesson_ids:
+            pis.setdefault(lesson_id, (pi, mls))
+    units = {}
+    for un, uno, lesson_ids, mls in UNITS:
+        for lesson_id in lesson_ids:
+            units.setdefault(lesson_id, (un, uno, mls))
+    index = {}
+    for lesson_id in set(pis) | set(units):
+        pi, pi_lessons = pis.get(lesson_id, (None, None))
+        un, uno, unit_lessons = units.get(lesson_id, (None, None, None))
+        index[lesson_id] = LessonIndexEntry(pi, pi_lessons, un, uno, unit_lessons)
+    return index
+
+#main lesson id to its LessonIndexEntry, for every lesson that can trigger an adaptive encouragement email
+LESSON_INDEX = _build_lesson_index()
+
+#all the main lessons of the course, for counting a student's overall progress
+DICT_ALL_MAIN_LESSONS = dict(DICT_PROPORTION_AL)
+DICT_ALL_MAIN_LESSONS.update(DICT_UNCERTAINTY_AL)
+DICT_ALL_MAIN_LESSONS.update(DICT_REPRESENTATION_AL)
+DICT_ALL_MAIN_LESSONS.update(DICT_PATTERN_AL)
+DICT_ALL_MAIN_LESSONS.update(DICT_MEASUREMENT_AL)
 
 def _get_first_lesson(handler, unit_id):
     """Returns the first lesson in the unit."""
@@ -228,6 +297,10 @@ def extract_unit_and_lesson(handler):
 
 def get_unit_and_lesson_id_from_url(handler, url):
     """Extracts unit and lesson ids from a URL."""
+    return _get_unit_and_lesson_id_from_url(handler.get_course(), url)
+
+
+def _get_unit_and_lesson_id_from_url(course, url):
     url_components = urlparse.urlparse(url)
     query_dict = urlparse.parse_qs(url_components.query)
 
@@ -240,7 +313,8 @@ def get_unit_and_lesson_id_from_url(handler, url):
     if 'lesson' in query_dict:
         lesson_id = query_dict['lesson'][0]
     else:
-        lesson_id = _get_first_lesson(handler, unit_id).lesson_id
+        lessons = course.get_lessons(unit_id)
+        lesson_id = lessons[0].lesson_id
 
     return unit_id, lesson_id
 
@@ -453,329 +527,65 @@ class UnitHandler(utils.BaseHandler):
             models.MemcacheManager.end_readonly()
         self.render('unit.html')
 
-    def strip_name_from_additional_fields(self, origin, token):
-        name = None
-        index = origin.find(token)
-        if index >= 0:
-            ss = origin[index:]
-            end_index = ss.find('"]')
-            if end_index > 0:
-                name = ss[len(token) + 4:end_index]
-        return name
-
     def process_lesson_adaptive_encouragement(self, student, course, unit_id, lesson_id):
-        additional_fields = student.additional_fields
         #check that the student in question has given permission for adaptive encouragement emails to be sent
-        sm = self.strip_name_from_additional_fields(additional_fields, 'SendMail')
+        sm = student.get_additional_field('SendMail')
         if sm == 'Yes':
             logging.info('sm is yes')
             user_id = student.user_id
-            email_address = self.strip_name_from_additional_fields(additional_fields, 'EmailAddress')
-            name = self.strip_name_from_additional_fields(additional_fields, 'GivenName')
-
-            #process adaptive encouragement for starting a powerful idea
-            subject_pis, main_text_pis, pis = self.process_started_powerful_idea(course, student, lesson_id)
-            self.process_adaptive_encouragement_sending_logic(name, email_address, user_id, subject_pis, main_text_pis, unit_id, lesson_id, pis, LOGIC_PI_STARTED)
-
-            #process adaptive encouragement for nearl completing a unit
-            subject_uc, main_text_uc, uc = self.process_completed_unit(course, student, lesson_id)
-            self.process_adaptive_encouragement_sending_logic(name, email_address, user_id, subject_uc, main_text_uc, unit_id, lesson_id, uc, LOGIC_UC)
-
-            #process adaptive encouragement for nearly completing a powerful idea
-            subject_pic, main_text_pic, pic = self.process_completed_powerful_idea(course, student, lesson_id)
-            self.process_adaptive_encouragement_sending_logic(name, email_address, user_id, subject_pic, main_text_pic, unit_id, lesson_id, pic, LOGIC_PI_COMPLETED)
-
-    def process_adaptive_encouragement_sending_logic(self, name, email_address, user_id, subject, main_text, unit_id, lesson_id, list_value_check, list_value_type):
-        #check if we have email content. If there is none, the student has not met the criteria for sending of an adaptive encouragement email and goes no further
-        if subject is not None and main_text is not None:
-            #get adaptive encouragement record for the student from the datastore. If one does not exist, create one.
-            ae = models.AdaptiveEncouragement.get_by_user_id(user_id)
-            if ae is None:
-                ae = models.AdaptiveEncouragement._add_new(user_id, 0, 0, 0, 0, None, None, None, False, False)
+            email_address = student.get_additional_field('EmailAddress')
+            name = student.get_additional_field('GivenName')
 
-            #work out whether to send the adaptive encouragement email based on the type of progress it is checking for.
-            #if the record has no mention of the unit/powerful idea in the relevant field, then we send the email and add the unit/powerful idea to the field.
-            #if the record knows about the unit/powerful idea in the relevant field, then we do not send the email and the process stops here.
-            send = True
-            if list_value_type == LOGIC_PI_STARTED:
-                lst = None
-                if ae.pi_started_emails_sent is not None:
-                    lst = ast.literal_eval(ae.pi_started_emails_sent)
-
-                if lst is not None and list_value_check in lst:
-                    send = False
-                elif lst is None:
-                    ae.pi_started_emails_sent = str([list_value_check])
-                else:
-                    ae.pi_started_emails_sent = str(lst + [list_value_check])
-            elif list_value_type == LOGIC_UC:
-                lst = None
-                if ae.unit_completed_emails_sent is not None:
-                    lst = ast.literal_eval(ae.unit_completed_emails_sent)
-
-                if lst is not None and list_value_check in lst:
-                    send = False
-                elif lst is None:
-                    ae.unit_completed_emails_sent = str([list_value_check])
-                else:
-                    ae.unit_completed_emails_sent = str(lst + [list_value_check])
-            elif list_value_type == LOGIC_PI_COMPLETED:
-                lst = None
-                if ae.pi_completed_emails_sent is not None:
-                    lst = ast.literal_eval(ae.pi_completed_emails_sent)
-
-                if lst is not None and list_value_check in lst:
-                    send = False
-                elif lst is None:
-                    ae.pi_completed_emails_sent = str([list_value_check])
-                else:
-                    ae.pi_completed_emails_sent = str(lst + [list_value_check])
+            #only main lessons can trigger adaptive encouragement emails
+            lesson_entry = LESSON_INDEX.get(lesson_id)
+            if lesson_entry is None:
+                return
 
-            if send == True:
-                logging.info('into the attempting to send part')
+            #load the student's progress once and check every kind of adaptive encouragement against it
+            progress_tracker = progress.UnitLessonCompletionTracker(course)
+            student_progress = progress_tracker.get_or_create_progress(student)
+
+            #the course's adaptive encouragement rules return the emails whose criteria the student has just met
+            matches = ae_rules.get_plan(self.app_context).evaluate_lesson(progress_tracker, student_progress, student, lesson_entry)
+
+            #only touch the adaptive encouragement record if at least one email may be due
+            if matches:
+                self.process_adaptive_encouragement_sending_logic(name, email_address, user_id, unit_id, lesson_id, matches)
+
+    def process_adaptive_encouragement_sending_logic(self, name, email_address, user_id, unit_id, lesson_id, matches):
+        #get adaptive encouragement record for the student from the datastore. If one does not exist, create one.
+        ae = models.AdaptiveEncouragement.get_by_user_id(user_id)
+        if ae is None:
+            ae = models.AdaptiveEncouragement._add_new(user_id, 0, 0, 0, 0, None, None, None, False, False)
+
+        #work out which emails to send; each rule records what it has been sent for in its own field
+        now = datetime.now()
+        emails = []
+        for match in matches:
+            #the record keeps the units/powerful ideas each kind of email has been sent for; mark_sent returns False if this one is already there, so it is not sent again
+            if not ae.mark_sent(match.sent_list, match.sent_value):
+                continue
+            #only queue the email if the student has not had too many lesson emails this week. reserving it from the weekly quota is atomic, so parallel page views cannot overshoot it
+            if ae_quota.reserve(ae, ae_mail.COUNTER_LESSON, now):
                 #constructs the main email body
-                body = self.get_ae_email_body(name, main_text, unit_id, lesson_id)
-
-                now = datetime.now()
-                if ae.first_ae_email_sent_in_week and ae.first_ae_email_sent_in_week < now-timedelta(days=7):
-                    #if the date we first sent an email is more than a week ago, send the email and also reset the emails sent counters and update the date to now
-                    sent = self.send_ae_email(email_address, subject, body)
-                    if sent:
-                        ae.lesson_emails_sent = 1
-                        ae.feedback_emails_sent = 0
-                        ae.first_ae_email_sent_in_week = now
-                elif ae.first_ae_email_sent_in_week and ae.first_ae_email_sent_in_week > now-timedelta(days=7) and ae.lesson_emails_sent<4:
-                    #send email if emails sent in week is less than 4
-                    sent = self.send_ae_email(email_address, subject, body)
-                    if sent:
-                        ae.lesson_emails_sent = ae.lesson_emails_sent + 1
-                elif ae.first_ae_email_sent_in_week is None:
-                    #no date is set for first email in week, so just send the email, and set the emails sent counters up and the date to now
-                    sent = self.send_ae_email(email_address, subject, body)
-                    if sent:
-                        ae.lesson_emails_sent = 1
-                        ae.feedback_emails_sent = 0
-                        ae.first_ae_email_sent_in_week = now
-
-            ae.put()
-
-    def process_started_powerful_idea(self, course, student, lesson_id):
-        #work out which powerful idea the lesson is in, and set up the variables
-        if lesson_id in ML_PROPORTION:
-            pi = PI_PROPORTION
-            mls = DICT_PROPORTION
-        elif lesson_id in ML_UNCERTAINTY:
-            pi = PI_UNCERTAINTY
-            mls = DICT_UNCERTAINTY
-        elif lesson_id in ML_REPRESENTATION:
-            pi = PI_REPRESENTATION
-            mls = DICT_REPRESENTATION
-        elif lesson_id in ML_PATTERN:
-            pi = PI_PATTERN
-            mls = DICT_PATTERN
-        elif lesson_id in ML_MEASUREMENT:
-            pi = PI_MEASUREMENT
-            mls = DICT_MEASUREMENT
-        else:
-            pi = None
-            mls = None
+                emails.append((match.subject, self.get_ae_email_body(match.text, unit_id, lesson_id)))
 
-        #check that the criteria matches and then set up the email subject and body if it does, otherwise return no values
-        if pi is not None and mls is not None:
-            progress_tracker = progress.UnitLessonCompletionTracker(course)
-            completed, total = progress_tracker.get_number_lessons_completed_for_powerful_idea_or_unit(student, mls)
-            if completed == 2:
-                logging.info('pi started')
-                subject, main_text = self.get_email_text_pi_started(pi)
-            else:
-                return None, None, None
-        else:
-            return None, None, None
-
-        return subject, main_text, pi
-
-    def process_completed_unit(self, course, student, lesson_id):
-        #work out which unit the lesson is in, and set up the variables
-        if lesson_id in ML_MIXING:
-            un = UN_MIXING
-            uno = UN_NO_MIXING
-            mls = DICT_MIXING
-        elif lesson_id in ML_COMPARING:
-            un = UN_COMPARING
-            uno = UN_NO_COMPARING
-            mls = DICT_COMPARING
-        elif lesson_id in ML_SCALING:
-            un = UN_SCALING
-            uno = UN_NO_SCALING
-            mls = DICT_SCALING
-        elif lesson_id in ML_SHARING:
-            un = UN_SHARING
-            uno = UN_NO_SHARING
-            mls = DICT_SHARING
-        elif lesson_id in ML_TRADING_OFF:
-            un = UN_TRADING_OFF
-            uno = UN_NO_TRADING_OFF
-            mls = DICT_TRADING_OFF
-        elif lesson_id in ML_MAKING_DECISIONS:
-            un = UN_MAKING_DECISIONS
-            uno = UN_NO_MAKING_DECISIONS
-            mls = DICT_MAKING_DECISIONS
-        elif lesson_id in ML_PLAYING:
-            un = UN_PLAYING
-            uno = UN_NO_PLAYING
-            mls = DICT_PLAYING
-        elif lesson_id in ML_SIMULATING:
-            un = UN_SIMULATING
-            uno = UN_NO_SIMULATING
-            mls = DICT_SIMULATING
-        elif lesson_id in ML_INTERPRETING_DATA:
-            un = UN_INTERPRETING_DATA
-            uno = UN_NO_INTERPRETING_DATA
-            mls = DICT_INTERPRETING_DATA
-        elif lesson_id in ML_INTERPRETING_CHARTS:
-            un = UN_INTERPRETING_CHARTS
-            uno = UN_NO_INTERPRETING_CHARTS
-            mls = DICT_INTERPRETING_CHARTS
-        elif lesson_id in ML_COMPARING_GROUPS:
-            un = UN_COMPARING_GROUPS
-            uno = UN_NO_COMPARING_GROUPS
-            mls = DICT_COMPARING_GROUPS
-        elif lesson_id in ML_APPRECIATING:
-            un = UN_APPRECIATING
-            uno = UN_NO_APPRECIATING
-            mls = DICT_APPRECIATING
-        elif lesson_id in ML_TILING:
-            un = UN_TILING
-            uno = UN_NO_TILING
-            mls = DICT_TILING
-        elif lesson_id in ML_CONSTRUCTING:
-            un = UN_CONSTRUCTING
-            uno = UN_NO_CONSTRUCTING
-            mls = DICT_CONSTRUCTING
-        elif lesson_id in ML_READING_SCALES:
-            un = UN_READING_SCALES
-            uno = UN_NO_READING_SCALES
-            mls = DICT_READING_SCALES
-        elif lesson_id in ML_CONVERTING:
-            un = UN_CONVERTING
-            uno = UN_NO_CONVERTING
-            mls = DICT_CONVERTING
-        elif lesson_id in ML_ESTIMATING:
-            un = UN_ESTIMATING
-            uno = UN_NO_ESTIMATING
-            mls = DICT_ESTIMATING
-        elif lesson_id in ML_QUANTIFYING:
-            un = UN_QUANTIFYING
-            uno = UN_NO_QUANTIFYING
-            mls = DICT_QUANTIFYING
-        else:
-            un = None
-            uno = None
-            mls = None
+        #save the adaptive encouragement record once; put() does not write it if nothing changed
+        ae.put()
 
-        #check that the criteria matches and then set up the email subject and body if it does, otherwise return no values
-        if un is not None and uno is not None and mls is not None:
-            progress_tracker = progress.UnitLessonCompletionTracker(course)
-            completed, total = progress_tracker.get_number_lessons_completed_for_powerful_idea_or_unit(student, mls)
-            logging.info(total)
-            logging.info(completed)
-            if total - completed == 1:
-                logging.info('unit completed')
-                subject, main_text = self.get_email_text_unit_complete(un, uno)
-            else:
-                return None, None, None
-        else:
-            return None, None, None
-
-        return subject, main_text, un
-
-    def process_completed_powerful_idea(self, course, student, lesson_id):
-        #work out which powerful idea the lesson is in, and set up the variables
-        if lesson_id in ML_PROPORTION:
-            pi = PI_PROPORTION
-            mls = DICT_PROPORTION
-        elif lesson_id in ML_UNCERTAINTY:
-            pi = PI_UNCERTAINTY
-            mls = DICT_UNCERTAINTY
-        elif lesson_id in ML_REPRESENTATION:
-            pi = PI_REPRESENTATION
-            mls = DICT_REPRESENTATION
-        elif lesson_id in ML_PATTERN:
-            pi = PI_PATTERN
-            mls = DICT_PATTERN
-        elif lesson_id in ML_MEASUREMENT:
-            pi = PI_MEASUREMENT
-            mls = DICT_MEASUREMENT
-        else:
-            pi = None
-            mls = None
+        for subject, body in emails:
+            self.send_ae_email(user_id, email_address, name, subject, body)
 
-        #check that the criteria matches and then set up the email subject and body if it does, otherwise return no values
-        if pi is not None and mls is not None:
-            progress_tracker = progress.UnitLessonCompletionTracker(course)
-            completed, total = progress_tracker.get_number_lessons_completed_for_powerful_idea_or_unit(student, mls)
-            if total - completed == 3:
-                logging.info('pi completed')
-                subject, main_text = self.get_email_text_pi_complete(pi)
-            else:
-                return None, None, None
-        else:
-            return None, None, None
-
-        return subject, main_text, pi
-
-    def get_email_text_pi_started(self, powerful_idea):
-        subject = 'A message about your progress in Citizen Maths'
-        text = "We are glad that you've made a start with {pi} in the Citizen Maths course. We encourage you to keep going; a good way to do this is likely to be to set aside a bit of time on most days to do one or two lessons until you've completed the whole course.".format(pi=powerful_idea)
-        return subject, text
-
-    def get_email_text_unit_complete(self, unit_name, unit_number):
-        subject = 'A message about your progress in Citizen Maths'
-        text = "We thought you'd like to know that you've only got one more lesson to go in {un} - {u}, in the Citizen Maths course. We encourage you to finish {un} now (if you have not already done so) whilst what you have been doing is fresh in your mind.".format(u=unit_name, un=unit_number)
-        return subject, text
-
-    def get_email_text_pi_complete(self, powerful_idea):
-        subject = 'A message about your progress in Citizen Maths'
-        text = "We thought you'd like to know that you've now got just three lessons to go to complete {pi} in the Citizen Maths course. We encourage you to finish {pi} now whilst things are fresh in your mind.".format(pi=powerful_idea)
-        return subject, text
-
-    def send_ae_email(self, email_address, subject, body):
-        #sendgrid generic stuff
-        sent = False
-        if subject is not None and body is not None:
-            #send the email!
-            sg = sendgrid.SendGridClient(SENDGRID_API_KEY)
-            message = sendgrid.Mail()
-            message.set_subject(subject)
-            message.set_html(body)
-            #change the value for message.set_from to your from email address
-            message.set_from('<YOUR_FROM_EMAIL_ADDRESS_HERE>')
-            message.add_to(email_address)
-            status, msg = sg.send(message)
-            if status == 200:
-                sent = True
-
-        return sent
+    def send_ae_email(self, user_id, email_address, name, subject, body):
+        #queue the email for sending; the student's name is filled into the body by sendgrid
+        return ae_mail.AdaptiveEncouragementMailQueue.enqueue(
+            user_id, email_address, subject, body, ae_mail.COUNTER_LESSON,
+            subs={ae_mail.SUB_NAME: name or ''})
 
     #method to construct the main email body content of the adaptive encouragement email
-    def get_ae_email_body(self, name, main_text, unit_id, lesson_id):
-        hello = 'Hello {n},<br><br>'.format(n=name.encode('utf-8'))
-
-        regards = """<br><br>Regards,<br>
-                     Seb Schmoller<br>
-                     For the Citizen Maths Team<br>
-                     <a href='https://citizenmaths.com/' target='_blank'>https://citizenmaths.com/</a><br><br>"""
-
-        location = "<br>Notes<br>The course page this email was sent from was <a href='https://course.citizenmaths.com/main/unit?unit={u}&lesson={l}' target='_blank'>https://course.citizenmaths.com/main/unit?unit={u}&lesson={l}</a>. You may have got further on in Citizen Maths in the period before you opened this email.".format(u=unit_id, l=lesson_id)
-
-        footer = """<br><br>You've received this email because when you registered for Citizen Maths you opted to be sent occasional encouraging emails about your progress with Citizen Maths.
-                    <br><br>If you would like to unsubscribe to this service, please go to your profile page at <a href='https://course.citizenmaths.com/main/student/home' target='_blank'>https://course.citizenmaths.com/main/student/home</a> and click the \"Unsubscribe from encouragement emails\" button."""
-
-        bodylist = [hello, main_text, regards, location, footer]
-
-        body = ''.join(bodylist)
-
-        return body
+    def get_ae_email_body(self, main_text, unit_id, lesson_id):
+        #the body is rendered from a template compiled once per process; the name is left as a substitution tag so students sent the same email share one sendgrid request
+        return ae_templates.render(ae_templates.LAYOUT_LESSON, main_text, unit_id=unit_id, lesson_id=lesson_id)
 
     def _set_gcb_html_element_class(self):
         """Select conditional CSS to hide parts of the unit page."""
@@ -1040,6 +850,23 @@ class UnitHandler(utils.BaseHandler):
                 student, unit.unit_id, lesson.lesson_id)
 
 
+def get_email_mappings_by_user_ids(user_ids):
+    """Batched gitkit.EmailMapping.get_by_user_id(); one datastore get.
+
+    Email mappings are site wide: like get_by_user_id(), they are read from the
+    default namespace whatever the namespace of the course asking.
+
+    Args:
+        user_ids: list of str. The user ids.
+    Returns:
+        A list of the EmailMapping of each user id, or None where it has none.
+    """
+    if not user_ids:
+        return []
+    with common_utils.Namespace(appengine_config.DEFAULT_NAMESPACE_NAME):
+        return gitkit.EmailMapping.get_by_key_name(user_ids)
+
+
 #apf: added new class for sending users ae emails who have been inactive
 class InactiveUsersAdaptiveEncouragementCronHandler(utils.AbstractAllCoursesCronHandler):
 
@@ -1053,117 +880,294 @@ class InactiveUsersAdaptiveEncouragementCronHandler(utils.AbstractAllCoursesCron
     def is_enabled_for_course(cls, app_context):
         return True
 
+    #students per shard task; the cron itself only pages through keys to find where each shard starts and ends
+    SHARD_SIZE = 100
+
+    #stop well before the 10 minute cron deadline and resume on the next pass
+    MAX_RUN_SECONDS = 8 * 60
+
+    #a new run starts once a week, on the first pass in the day from Tuesday 06:00 (UTC, like the cron schedule); the passes in between only resume a run
+    RUN_WEEKDAY = 1
+    RUN_HOUR = 6
+
     def cron_action(self, app_context, global_state):
         #we only want the cron code to run for our course namespace
-        if app_context.get_namespace_name() == 'ns_main':
-            logging.info(app_context.get_namespace_name())
-            now = datetime.now()
-            users = models.Student.all()
-            course = courses.Course.get(app_context)
-            logging.info(course)
-
-            #concatenate the main lessons in a big dictionary
-            dict_all_main_lessons = dict(DICT_PROPORTION_AL)
-            dict_all_main_lessons.update(DICT_UNCERTAINTY_AL)
-            dict_all_main_lessons.update(DICT_REPRESENTATION_AL)
-            dict_all_main_lessons.update(DICT_PATTERN_AL)
-            dict_all_main_lessons.update(DICT_MEASUREMENT_AL)
-
-            #loop through the users
-            for user in users:
-                if user is not None:
-                    #check the user is known by the gitkit email mapping datastore. this is because we are only interested in users after the ae code went live, which would only be gitkit users.
-                    gu = gitkit.EmailMapping.get_by_user_id(user.user_id)
-                    if gu is not None:
-                        #set up some variables
-                        af = user.additional_fields
-                        sm = self.strip_value_from_additional_fields(af, 'SendMail')
-                        email_address = self.strip_value_from_additional_fields(af, 'EmailAddress')
-                        name = self.strip_value_from_additional_fields(af, 'GivenName')
-                        #check that the student in question has given permission for adaptive encouragement emails to be sent
-                        if sm == 'Yes':
-                            user_id = user.user_id
-                            #find out the current students progress throughout the course
-                            progress_tracker = progress.UnitLessonCompletionTracker(course)
-                            student_progress = progress_tracker.get_or_create_progress(user)
-                            completed, total = progress_tracker.get_number_lessons_completed_for_powerful_idea_or_unit(user, dict_all_main_lessons)
-                            sc = "number of lessons completed: {comp}".format(comp=completed)
-                            logging.info(sc)
-
-                            #get adaptive encouragement record for the student from the datastore. If one does not exist, create one.
-                            ae = models.AdaptiveEncouragement.get_by_user_id(user_id)
-                            if ae is None:
-                                ae = models.AdaptiveEncouragement._add_new(user_id, 0, 0, 0, 0, None, None, None, False, False)
-
-                            #if student registered more than a week ago and has yet to make a start in the course, send ths email
-                            if user.enrolled_on < now-timedelta(days=7) and completed == 0 and ae.cron_inactive_not_started_email == False:
-                                logging.info('enrolled more than 7 days ago and lessons completed is zero for user id:')
-                                logging.info(user_id)
-                                sent = self.send_ae_email(email_address, INACTIVE_EMAIL_SUBJECT, self.get_ae_email_body(name, INACTIVE_SEVEN_DAYS_EMAIL_TEXT))
-                                if sent:
-                                    logging.info('sent email to:')
-                                    logging.info(email_address)
-                                    #set this value to true so we do not send the email again on the next scheduled pass through of the code
-                                    ae.cron_inactive_not_started_email = True
-
-                            #if student registered more than two weeks ago, made a start in the course but has not completed it, send ths email
-                            if user.last_seen_on < now-timedelta(weeks=2) and completed > 0 and progress_tracker.is_assessment_completed(student_progress, EOCQ_ASSESSMENT_ID) == False and ae.cron_inactive_started_email == False:
-                                logging.info('last seen on more than 14 days ago and lessons completed more than zero but not done eocq for user id:')
-                                logging.info(user_id)
-                                if student_progress is not None and student_progress.updated_on is not None and student_progress.updated_on < now-timedelta(weeks=2):
-                                    logging.info('progress updated more than two weeks ago')
-                                    sent = self.send_ae_email(email_address, INACTIVE_EMAIL_SUBJECT, self.get_ae_email_body(name, INACTIVE_TWO_WEEKS_EMAIL_TEXT))
-                                    if sent:
-                                        logging.info('sent email to:')
-                                        logging.info(email_address)
-                                        #set this value to true so we do not send the email again on the next scheduled pass through of the code
-                                        ae.cron_inactive_started_email = True
-
-                            #save the adaptive encouragement record
-                            ae.put()
-
-    def strip_value_from_additional_fields(self, origin, token):
-        value = None
-        index = origin.find(token)
-        if index >= 0:
-            ss = origin[index:]
-            end_index = ss.find('"]')
-            if end_index > 0:
-                value = ss[len(token) + 4:end_index]
-        return value
-
-    def send_ae_email(self, email_address, subject, body):
-        sent = False
-        if subject is not None and body is not None:
-            #send the email!
-            sg = sendgrid.SendGridClient(SENDGRID_API_KEY)
-            message = sendgrid.Mail()
-            message.set_subject(subject)
-            message.set_html(body)
-            message.set_from('<YOUR_FROM_EMAIL_ADDRESS_HERE>')
-            message.add_to(email_address)
-            status, msg = sg.send(message)
-            if status == 200:
-                sent = True
-
-        return sent
-
-    def get_ae_email_body(self, name, main_text):
-        hello = 'Hello {n},<br><br>'.format(n=name)
-
-        regards = """<br><br>Regards,<br>
-                     Seb Schmoller<br>
-                     For the Citizen Maths Team<br>
-                     <a href='https://citizenmaths.com/' target='_blank'>https://citizenmaths.com/</a><br><br>"""
-
-        footer = """<br>Notes<br>You've received this email because when you registered for Citizen Maths you opted to be sent occasional encouraging emails about your progress with Citizen Maths.
-                    <br><br>If you would like to unsubscribe to this service, please go to your profile page at <a href='https://course.citizenmaths.com/main/student/home' target='_blank'>https://course.citizenmaths.com/main/student/home</a> and click the \"Unsubscribe from encouragement emails\" button."""
-
-        bodylist = [hello, main_text, regards, footer]
-
-        body = ''.join(bodylist)
-
-        return body
+        if app_context.get_namespace_name() != 'ns_main':
+            return
+
+        deadline = time.time() + self.MAX_RUN_SECONDS
+
+        #first move any adaptive encouragement records not keyed by user id, so that the shards, which look records up by key, find them all.
+        #this only does work once; if it is cut short it resumes on the next pass
+        if not models.AdaptiveEncouragementKeyMigration.run(deadline):
+            return
+
+        now = datetime.now()
+        state = models.AdaptiveEncouragementCronState.get_or_create()
+        if state.run_started_on is None:
+            anchor = self.get_run_anchor(now)
+            if now - anchor >= timedelta(days=1):
+                return
+            if state.last_run_started_on is not None and state.last_run_started_on >= anchor:
+                return
+            state.run_started_on = now
+            state.window_index = 0
+            state.cursor = None
+            state.put()
+            logging.info('starting inactive users run at %s', now)
+        else:
+            logging.info('resuming inactive users run started at %s, window %d', state.run_started_on, state.window_index)
+
+        plan = ae_rules.get_plan(app_context)
+
+        #each window is an indexed query for the students who have become inactive since the last run, checked against the rules for that window.
+        #the query is split into shards of SHARD_SIZE students, each checked by its own task
+        windows = plan.inactive_windows
+        while state.window_index < len(windows):
+            property_name, days, rule_ids = windows[state.window_index]
+            lower, upper = self.get_window_bounds(state, days)
+            query = self.get_candidates_query(property_name, lower, upper, keys_only=True)
+            start_cursor = state.cursor
+            if start_cursor:
+                query.with_cursor(start_cursor)
+            keys = query.fetch(self.SHARD_SIZE)
+            end_cursor = query.cursor()
+
+            if keys:
+                InactiveUsersAdaptiveEncouragementShard.enqueue({
+                    'run_started_on': state.run_started_on,
+                    'property_name': property_name,
+                    'lower': lower,
+                    'upper': upper,
+                    'rule_ids': rule_ids,
+                    'start_cursor': start_cursor,
+                    'end_cursor': end_cursor,
+                })
+
+            if len(keys) < self.SHARD_SIZE:
+                state.window_index += 1
+                state.cursor = None
+            else:
+                state.cursor = end_cursor
+            state.put()
+
+            if time.time() > deadline:
+                logging.info('inactive users run stopped at window %d, it will resume on the next pass', state.window_index)
+                return
+
+        state.last_run_started_on = state.run_started_on
+        state.run_started_on = None
+        state.window_index = 0
+        state.cursor = None
+        state.put()
+        logging.info('inactive users run complete; all shards queued')
+
+    @classmethod
+    def get_run_anchor(cls, now):
+        #the latest scheduled start of a run, Tuesday 06:00, at or before now
+        anchor = now.replace(hour=cls.RUN_HOUR, minute=0, second=0, microsecond=0) - timedelta(days=(now.weekday() - cls.RUN_WEEKDAY) % 7)
+        if anchor > now:
+            anchor -= timedelta(days=7)
+        return anchor
+
+    @classmethod
+    def get_window_bounds(cls, state, days):
+        #students whose property passed the window since the start of the last completed run; all of them on the first run
+        upper = state.run_started_on - timedelta(days=days)
+        lower = None
+        if state.last_run_started_on is not None:
+            lower = state.last_run_started_on - timedelta(days=days)
+        return lower, upper
+
+    @classmethod
+    def get_candidates_query(cls, property_name, lower, upper, keys_only=False):
+        query = models.Student.all(keys_only=keys_only).filter('%s <' % property_name, upper)
+        if lower is not None:
+            query.filter('%s >=' % property_name, lower)
+        return query.order(property_name)
+
+    @classmethod
+    def get_intents_for_page(cls, plan, rule_ids, now, users, progress_tracker):
+        #the records each check needs are loaded for the whole page at once, with one datastore get per kind, so the number of reads grows with pages not students.
+        #each step only loads records for the students still left after the cheaper checks before it
+
+        #check that the students in question have given permission for adaptive encouragement emails to be sent
+        users = [user for user in users if user.get_additional_field('SendMail') == 'Yes']
+        if not users:
+            return []
+
+        #skip the students whose emails here have all been sent before loading anything else.
+        #a student without a record is checked against a new one, which is not saved; the mail queue creates it once an email is delivered
+        aes = models.AdaptiveEncouragement.get_multi_by_user_ids(user.user_id for user in users)
+        users = [user for user in users if user.user_id not in aes or not plan.is_inactive_sent(aes[user.user_id], rule_ids)]
+        if not users:
+            return []
+
+        #check the users are known by the gitkit email mapping datastore. this is because we are only interested in users after the ae code went live, which would only be gitkit users.
+        mappings = get_email_mappings_by_user_ids([user.user_id for user in users])
+        users = [user for user, mapping in zip(users, mappings) if mapping is not None]
+        if not users:
+            return []
+
+        #find out the current students progress throughout the course
+        progresses = progress_tracker.get_progress_multi(users)
+
+        intents = []
+        for user in users:
+            user_id = user.user_id
+            ae = aes.get(user_id)
+            if ae is None:
+                ae = models.AdaptiveEncouragement._add_new(user_id, 0, 0, 0, 0, None, None, None, False, False)
+            student_progress = progresses[user_id]
+            completed, total = progress_tracker.get_number_lessons_completed_for_powerful_idea_or_unit(user, DICT_ALL_MAIN_LESSONS, progress=student_progress)
+
+            #the course's inactive rules return the emails this student is due and has not yet been sent.
+            #the mail queue sets the matching cron flag once an email is delivered, so it is not sent again on the next pass
+            email_address = user.get_additional_field('EmailAddress')
+            name = user.get_additional_field('GivenName')
+            for counter, match in plan.evaluate_inactive(now, user, completed, progress_tracker, student_progress, ae, rule_ids=rule_ids):
+                logging.info('inactive rule %s matched for user id: %s', match.rule_id, user_id)
+                intents.append(cls.get_ae_email_intent(user_id, email_address, name, match.subject, match.text, counter))
+        return intents
+
+    @classmethod
+    def get_ae_email_intent(cls, user_id, email_address, name, subject, main_text, counter):
+        return ae_mail.SendIntent(
+            user_id, email_address, subject,
+            cls.get_ae_email_body(main_text), counter,
+            subs={ae_mail.SUB_NAME: name or ''})
+
+    @classmethod
+    def get_ae_email_body(cls, main_text):
+        #the body only depends on the rule's text, so every student matching a rule shares one string rendered once per process
+        return ae_templates.render(ae_templates.LAYOUT_INACTIVE, main_text)
+
+
+class InactiveUsersAdaptiveEncouragementShard(webapp2.RequestHandler):
+    """Push task queue handler that checks one shard of inactive user candidates.
+
+    A shard is the part of a candidates query between two cursors. Its emails
+    are queued under a task name derived from the shard, and the shard is
+    recorded as done in an AdaptiveEncouragementCronShard entity, so a shard
+    that is retried, or queued again by a resumed run, sends nothing twice.
+
+    Tests can switch the queue into local mode with use_local_queue(); shards
+    are then kept in process and run synchronously by drain_local_queue().
+    """
+
+    QUEUE_NAME = 'default'
+    URL = '/_ah/queue/ae-inactive-shard'
+
+    # List of (namespace, params) pairs when running in local mode; None when
+    # shards go to the App Engine task queue.
+    _LOCAL_QUEUE = None
+
+    @classmethod
+    def use_local_queue(cls, enabled=True):
+        """Keeps shards in process instead of in the task queue."""
+        cls._LOCAL_QUEUE = [] if enabled else None
+
+    @classmethod
+    def drain_local_queue(cls, app_context):
+        """Runs all locally queued shards; returns the number of emails queued."""
+        queued = 0
+        while cls._LOCAL_QUEUE:
+            namespace, params = cls._LOCAL_QUEUE.pop(0)
+            with common_utils.Namespace(namespace):
+                queued += cls.run_shard(app_context, params)
+        return queued
+
+    @classmethod
+    def get_shard_name(cls, params):
+        #the window's bounds and rules are part of the name, as the first shards of two windows on one property both start with no cursor
+        bounds = [
+            bound.strftime('%Y%m%d%H%M%S') if bound else ''
+            for bound in (params['lower'], params['upper'])]
+        window = '|'.join(bounds + [
+            ','.join(sorted(str(rule_id) for rule_id in params['rule_ids'])),
+            params['start_cursor'] or ''])
+        return 'ae-inactive-%s-%s-%s' % (
+            params['run_started_on'].strftime('%Y%m%d%H%M%S'),
+            params['property_name'],
+            hashlib.md5(window).hexdigest())
+
+    @classmethod
+    def enqueue(cls, params):
+        namespace = namespace_manager.get_namespace()
+        if cls._LOCAL_QUEUE is not None:
+            cls._LOCAL_QUEUE.append((namespace, params))
+            return
+        shard = dict(params)
+        for name in ('run_started_on', 'lower', 'upper'):
+            if shard[name]:
+                shard[name] = shard[name].strftime(
+                    transforms.ISO_8601_DATETIME_FORMAT)
+        task = taskqueue.Task(
+            url=cls.URL, name=cls.get_shard_name(params), params={
+                'namespace': namespace,
+                'shard': transforms.dumps(shard),
+            })
+        try:
+            task.add(cls.QUEUE_NAME)
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            logging.info('Shard %s was already queued.', task.name)
+
+    @classmethod
+    def _parse_params(cls, shard):
+        params = transforms.loads(shard)
+        for name in ('run_started_on', 'lower', 'upper'):
+            if params[name]:
+                params[name] = datetime.strptime(
+                    params[name], transforms.ISO_8601_DATETIME_FORMAT)
+        return params
+
+    @classmethod
+    def run_shard(cls, app_context, params):
+        """Checks the students in one shard; returns the number of emails queued."""
+        shard_name = cls.get_shard_name(params)
+        if models.AdaptiveEncouragementCronShard.get_by_key_name(shard_name):
+            logging.info('Shard %s is already done.', shard_name)
+            return 0
+
+        query = InactiveUsersAdaptiveEncouragementCronHandler.get_candidates_query(params['property_name'], params['lower'], params['upper'])
+        query.with_cursor(params['start_cursor'], params['end_cursor'])
+        users = query.fetch(InactiveUsersAdaptiveEncouragementCronHandler.SHARD_SIZE)
+
+        plan = ae_rules.get_plan(app_context)
+        progress_tracker = progress.UnitLessonCompletionTracker(courses.Course.get(app_context))
+        intents = InactiveUsersAdaptiveEncouragementCronHandler.get_intents_for_page(plan, params['rule_ids'], params['run_started_on'], users, progress_tracker)
+
+        ae_mail.AdaptiveEncouragementMailQueue.enqueue_intents(intents, task_name=shard_name)
+        models.AdaptiveEncouragementCronShard(
+            key_name=shard_name, students=len(users), emails=len(intents)).put()
+        logging.info('Shard %s checked %d students and queued %d emails.', shard_name, len(users), len(intents))
+        return len(intents)
+
+    def post(self):
+        if 'X-AppEngine-QueueName' not in self.request.headers:
+            self.response.set_status(500)
+            return
+        try:
+            params = self._parse_params(self.request.get('shard'))
+        except (KeyError, TypeError, ValueError):
+            logging.critical(
+                'Inactive users shard queue had malformed item: %s',
+                self.request.get('shard'))
+            self.response.set_status(200)
+            return
+
+        namespace = self.request.get('namespace')
+        for app_context in sites.get_all_courses():
+            if app_context.get_namespace_name() == namespace:
+                with common_utils.Namespace(namespace):
+                    # Errors propagate so the queue retries the shard.
+                    self.run_shard(app_context, params)
+                break
+        else:
+            logging.error('Inactive users shard for unknown course %s', namespace)
+        self.response.set_status(200)
+
 
 class ReviewDashboardHandler(utils.BaseHandler):
     """Handler for generating the index of reviews that a student has to do."""
@@ -1524,6 +1528,7 @@ class EventsRESTHandler(utils.BaseRESTHandler):
         return
 
     def _add_request_facts(self, payload_json):
+        """Adds request facts to the payload; returns it as a dict and JSON."""
         payload_dict = transforms.loads(payload_json)
         if 'loc' not in payload_dict:
             payload_dict['loc'] = {}
@@ -1543,7 +1548,7 @@ class EventsRESTHandler(utils.BaseRESTHandler):
             payload_dict['user_agent'] = user_agent
         payload_json = transforms.dumps(payload_dict).lstrip(
             models.transforms.JSON_XSSI_PREFIX)
-        return payload_json
+        return payload_dict, payload_json
 
     def post(self):
         """Receives event and puts it into datastore."""
@@ -1561,54 +1566,350 @@ class EventsRESTHandler(utils.BaseRESTHandler):
             return
 
         source = request.get('source')
-        payload_json = request.get('payload')
-        payload_json = self._add_request_facts(payload_json)
+        payload, payload_json = self._add_request_facts(request.get('payload'))
+
+        if EVENTS_PIPELINE_ENABLED.value and EventPipeline.append(
+                models.EventEntity.create(source, user, payload_json)):
+            # The event and the progress it makes are recorded later, in a
+            # batch with other events.
+            return
+
         models.EventEntity.record(source, user, payload_json)
         COURSE_EVENTS_RECORDED.inc()
 
-        self.process_event(user, source, payload_json)
+        self.process_event(user, source, payload_json, payload=payload)
 
-    def process_event(self, user, source, payload_json):
+    def process_event(self, user, source, payload_json, payload=None):
         """Processes an event after it has been recorded in the event stream."""
 
         student = models.Student.get_enrolled_student_by_user(user)
         if not student:
             return
 
-        payload = transforms.loads(payload_json)
+        if payload is None:
+            payload = transforms.loads(payload_json)
+
+        course = self.get_course()
+        tracker = course.get_progress_tracker()
+        event = get_progress_event(course, tracker, source, payload)
+        if event:
+            tracker.put_events(student, [event])
+
+
+def get_progress_event(course, tracker, source, payload):
+    """Returns the progress event an event payload records, or None.
+
+    The progress event is an (event_entity, event_key) pair for
+    UnitLessonCompletionTracker.put_events().
+    """
+    if 'location' not in payload:
+        return None
+
+    source_url = payload['location']
+
+    if source in TAGS_THAT_TRIGGER_BLOCK_COMPLETION:
+        unit_id, lesson_id = _get_unit_and_lesson_id_from_url(
+            course, source_url)
+        if unit_id is not None and lesson_id is not None:
+            return tracker.get_block_completed_event(
+                unit_id, lesson_id, payload['index'])
+    elif source in TAGS_THAT_TRIGGER_COMPONENT_COMPLETION:
+        unit_id, lesson_id = _get_unit_and_lesson_id_from_url(
+            course, source_url)
+        cpt_id = payload['instanceid']
+        if (unit_id is not None and lesson_id is not None and
+            cpt_id is not None):
+            return tracker.get_component_completed_event(
+                unit_id, lesson_id, cpt_id)
+    elif source in TAGS_THAT_TRIGGER_HTML_COMPLETION:
+        # Records progress for scored lessons.
+        unit_id, lesson_id = _get_unit_and_lesson_id_from_url(
+            course, source_url)
+        unit = course.find_unit_by_id(unit_id)
+        lesson = course.find_lesson_by_id(unit, lesson_id)
+        if (unit_id is not None and
+            lesson_id is not None and
+            lesson is not None and
+            not lesson.manual_progress):
+            return tracker.get_html_completed_event(unit_id, lesson_id)
+    return None
+
+
+class EventPipeline(webapp2.RequestHandler):
+    """Records student events in batches, off the request that received them.
+
+    In pipeline mode EventsRESTHandler only validates an event, runs the event
+    record hooks and appends the event to a buffer kept by the instance. When
+    the buffer holds MAX_BUFFERED_EVENTS events, its events would encode to
+    more than MAX_BUFFERED_BYTES of task payload, or its oldest event is
+    MAX_BUFFER_SECONDS old, the buffer is handed to a push task. The task puts
+    all the events with one datastore put, and applies the progress each
+    student made with one progress write per student.
+
+    A background thread hands over buffers that reach MAX_BUFFER_SECONDS on
+    an instance that has gone idle, and a shutdown hook hands over what is
+    left when the instance is shut down. Instances that cannot run background
+    threads (automatic scaling) do not buffer: append() returns False and the
+    handler records the event itself. A batch that cannot be queued is
+    recorded by the request or thread flushing it.
+
+    Each batch has an id. Its events are saved under key names made from it,
+    and an EventPipelineBatch records how many of its students' progress has
+    been applied, every CHECKPOINT_STUDENTS students, so a retried task does
+    not duplicate events and only applies again the progress of the students
+    after the last checkpoint, which sets the same progress again.
+
+    Events still buffered when an instance stops without being shut down
+    are lost, which is why pipeline mode is off by default.
+
+    Tests can switch the task queue into local mode with use_local_queue();
+    batches are then kept in process and recorded synchronously by
+    drain_local_queue().
+    """
+
+    QUEUE_NAME = 'default'
+    URL = '/_ah/queue/events-pipeline'
+
+    MAX_BUFFERED_EVENTS = 50
+    # Encoded events per task; the rest of the 100KB task size limit is left
+    # for the other parameters and the headers.
+    MAX_BUFFERED_BYTES = taskqueue.MAX_PUSH_TASK_SIZE_BYTES - 4 * 1024
+    MAX_BUFFER_SECONDS = 10
+    CHECKPOINT_STUDENTS = 10
+
+    _LOCK = threading.Lock()
+    # Per namespace: a list of [user_id, source, data, recorded_on] events.
+    _BUFFERS = {}
+    _BUFFER_BYTES = 0
+    _BUFFER_STARTED = None
+
+    # None until the first event; then whether the background flusher runs.
+    _FLUSHER_RUNNING = None
+    # The shutdown hook set before ours, which ours calls.
+    _PREVIOUS_SHUTDOWN_HOOK = None
+
+    # List of (namespace, batch_id, events) batches when running in local
+    # mode; None when batches go to the App Engine task queue.
+    _LOCAL_QUEUE = None
+
+    @classmethod
+    def use_local_queue(cls, enabled=True):
+        """Keeps batches in process instead of in the task queue."""
+        cls._LOCAL_QUEUE = [] if enabled else None
+
+    @classmethod
+    def drain_local_queue(cls, app_context):
+        """Flushes the buffer and records all locally queued batches."""
+        cls.flush()
+        count = 0
+        while cls._LOCAL_QUEUE:
+            namespace, batch_id, events = cls._LOCAL_QUEUE.pop(0)
+            with common_utils.Namespace(namespace):
+                count += cls.record_batch(app_context, batch_id, events)
+        return count
 
-        if 'location' not in payload:
+    @classmethod
+    def _start_flusher(cls):
+        """Starts the background flusher; returns whether it is running."""
+        if cls._LOCAL_QUEUE is not None:
+            # drain_local_queue() flushes in local mode.
+            return True
+        try:
+            background_thread.start_new_background_thread(
+                cls._run_flusher, [])
+        except Exception:  # pylint: disable=broad-except
+            logging.info(
+                'No background thread for the events pipeline; events are '
+                'recorded as they arrive.')
+            return False
+        cls._PREVIOUS_SHUTDOWN_HOOK = runtime.set_shutdown_hook(
+            cls._on_shutdown)
+        return True
+
+    @classmethod
+    def _on_shutdown(cls):
+        try:
+            cls.flush()
+        finally:
+            if cls._PREVIOUS_SHUTDOWN_HOOK:
+                cls._PREVIOUS_SHUTDOWN_HOOK()
+
+    @classmethod
+    def _run_flusher(cls):
+        while True:
+            time.sleep(cls.MAX_BUFFER_SECONDS / 2.0)
+            with cls._LOCK:
+                batches = None
+                if (cls._BUFFER_STARTED is not None and
+                    time.time() - cls._BUFFER_STARTED >=
+                    cls.MAX_BUFFER_SECONDS):
+                    batches = cls._take_buffers()
+            if batches:
+                try:
+                    cls._enqueue(batches)
+                except Exception:  # pylint: disable=broad-except
+                    logging.exception('Events pipeline flusher failed.')
+
+    @classmethod
+    def _encoded_size(cls, item):
+        """The bytes an event adds to the form-encoded events of a task."""
+        return len(urllib.quote_plus(transforms.dumps(item) + ', '))
+
+    @classmethod
+    def append(cls, event):
+        """Buffers an EventEntity made by EventEntity.create().
+
+        Returns:
+            Whether the event was buffered. It is not on instances that cannot
+            run the background flusher; the caller records it instead.
+        """
+        with cls._LOCK:
+            if cls._FLUSHER_RUNNING is None:
+                cls._FLUSHER_RUNNING = cls._start_flusher()
+        if not cls._FLUSHER_RUNNING:
+            return False
+
+        item = [
+            event.user_id, event.source, event.data,
+            event.recorded_on.strftime(transforms.ISO_8601_DATETIME_FORMAT)]
+        size = cls._encoded_size(item)
+        namespace = namespace_manager.get_namespace()
+        now = time.time()
+        full = []
+        with cls._LOCK:
+            if (cls._BUFFER_BYTES and
+                cls._BUFFER_BYTES + size > cls.MAX_BUFFERED_BYTES):
+                full.append(cls._take_buffers())
+            if cls._BUFFER_STARTED is None:
+                cls._BUFFER_STARTED = now
+            cls._BUFFERS.setdefault(namespace, []).append(item)
+            cls._BUFFER_BYTES += size
+            if (sum(len(events) for events in cls._BUFFERS.itervalues()) >=
+                cls.MAX_BUFFERED_EVENTS or
+                cls._BUFFER_BYTES >= cls.MAX_BUFFERED_BYTES or
+                now - cls._BUFFER_STARTED >= cls.MAX_BUFFER_SECONDS):
+                full.append(cls._take_buffers())
+        for batches in full:
+            cls._enqueue(batches)
+        return True
+
+    @classmethod
+    def flush(cls):
+        """Hands everything buffered so far to the task queue."""
+        with cls._LOCK:
+            batches = cls._take_buffers()
+        cls._enqueue(batches)
+
+    @classmethod
+    def _take_buffers(cls):
+        batches = cls._BUFFERS
+        cls._BUFFERS = {}
+        cls._BUFFER_BYTES = 0
+        cls._BUFFER_STARTED = None
+        return batches
+
+    @classmethod
+    def _enqueue(cls, batches):
+        for namespace, events in batches.iteritems():
+            batch_id = uuid.uuid4().hex
+            if cls._LOCAL_QUEUE is not None:
+                cls._LOCAL_QUEUE.append((namespace, batch_id, events))
+                continue
+            try:
+                taskqueue.Task(url=cls.URL, params={
+                    'namespace': namespace,
+                    'batch_id': batch_id,
+                    'events': transforms.dumps(events),
+                }).add(cls.QUEUE_NAME)
+            except Exception:  # pylint: disable=broad-except
+                logging.exception(
+                    'Failed to queue %d events for %s; recording them now.',
+                    len(events), namespace)
+                app_context = cls._get_app_context(namespace)
+                if app_context is None:
+                    raise
+                with common_utils.Namespace(namespace):
+                    cls.record_batch(app_context, batch_id, events)
+
+    @classmethod
+    def _get_app_context(cls, namespace):
+        for app_context in sites.get_all_courses():
+            if app_context.get_namespace_name() == namespace:
+                return app_context
+        return None
+
+    @classmethod
+    def record_batch(cls, app_context, batch_id, events):
+        """Records a batch of buffered events; returns the number recorded.
+
+        Recording a batch again only records what was not recorded before.
+        """
+        entities = []
+        by_user_id = collections.OrderedDict()
+        for index, (user_id, source, data, recorded_on) in enumerate(events):
+            entities.append(models.EventEntity(
+                key_name='%s-%s' % (batch_id, index),
+                source=source, user_id=user_id, data=data,
+                recorded_on=datetime.strptime(
+                    recorded_on, transforms.ISO_8601_DATETIME_FORMAT)))
+            by_user_id.setdefault(user_id, []).append((source, data))
+
+        batch = models.EventPipelineBatch.get_by_key_name(batch_id)
+        if batch is None:
+            # Events keyed by the batch are overwritten, not duplicated.
+            db.put(entities)
+            COURSE_EVENTS_RECORDED.inc(increment=len(entities))
+            batch = models.EventPipelineBatch(key_name=batch_id)
+            batch.put()
+
+        course = courses.Course.get(app_context)
+        tracker = course.get_progress_tracker()
+        # Students are applied in the order of the batch; the first
+        # batch.students_done of them were applied by an earlier attempt.
+        # Students after the last checkpoint are applied again on a retry,
+        # which sets the progress they made again.
+        students = by_user_id.items()
+        for user_id, user_events in students[batch.students_done:]:
+            student = models.Student.get_by_user_id(user_id)
+            if student and student.is_enrolled:
+                progress_events = []
+                for source, data in user_events:
+                    event = get_progress_event(
+                        course, tracker, source, transforms.loads(data))
+                    if event:
+                        progress_events.append(event)
+                tracker.put_events(student, progress_events)
+            batch.students_done += 1
+            if (batch.students_done % cls.CHECKPOINT_STUDENTS == 0 or
+                batch.students_done == len(students)):
+                batch.put()
+        return len(entities)
+
+    def post(self):
+        if 'X-AppEngine-QueueName' not in self.request.headers:
+            self.response.set_status(500)
+            return
+        try:
+            events = transforms.loads(self.request.get('events'))
+        except (TypeError, ValueError):
+            logging.critical(
+                'Events pipeline queue had malformed item: %s',
+                self.request.get('events'))
+            self.response.set_status(200)
             return
 
-        source_url = payload['location']
-
-        if source in TAGS_THAT_TRIGGER_BLOCK_COMPLETION:
-            unit_id, lesson_id = get_unit_and_lesson_id_from_url(
-                self, source_url)
-            if unit_id is not None and lesson_id is not None:
-                self.get_course().get_progress_tracker().put_block_completed(
-                    student, unit_id, lesson_id, payload['index'])
-        elif source in TAGS_THAT_TRIGGER_COMPONENT_COMPLETION:
-            unit_id, lesson_id = get_unit_and_lesson_id_from_url(
-                self, source_url)
-            cpt_id = payload['instanceid']
-            if (unit_id is not None and lesson_id is not None and
-                cpt_id is not None):
-                self.get_course().get_progress_tracker(
-                    ).put_component_completed(
-                        student, unit_id, lesson_id, cpt_id)
-        elif source in TAGS_THAT_TRIGGER_HTML_COMPLETION:
-            # Records progress for scored lessons.
-            unit_id, lesson_id = get_unit_and_lesson_id_from_url(
-                self, source_url)
-            course = self.get_course()
-            unit = course.find_unit_by_id(unit_id)
-            lesson = course.find_lesson_by_id(unit, lesson_id)
-            if (unit_id is not None and
-                lesson_id is not None and
-                not lesson.manual_progress):
-                self.get_course().get_progress_tracker().put_html_completed(
-                    student, unit_id, lesson_id)
+        namespace = self.request.get('namespace')
+        app_context = self._get_app_context(namespace)
+        if app_context is None:
+            logging.error('Events pipeline batch for unknown course %s', namespace)
+        else:
+            with common_utils.Namespace(namespace):
+                # Errors propagate so the queue retries the batch.
+                # Batches queued before they had ids are named by content.
+                batch_id = self.request.get('batch_id') or hashlib.md5(
+                    self.request.get('events')).hexdigest()
+                self.record_batch(app_context, batch_id, events)
+        self.response.set_status(200)
 
 
 def on_module_enabled(unused_custom_module):
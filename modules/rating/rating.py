@@ -24,7 +24,6 @@ import urlparse
 import jinja2
 import logging
 
-import sendgrid
 import webapp2
 
 import appengine_config
@@ -40,12 +39,13 @@ from models import data_removal
 from models import data_sources
 from models import models
 from models import transforms
+from modules.courses import ae_mail
+from modules.courses import ae_quota
+from modules.courses import ae_rules
+from modules.courses import ae_templates
 from modules.courses import lessons
 from modules.rating import messages
 
-from datetime import datetime
-from datetime import timedelta
-
 RESOURCES_PATH = '/modules/rating/resources'
 
 # The token to namespace the XSRF token to this module
@@ -59,10 +59,6 @@ TEMPLATES_DIR = os.path.join(
 
 rating_module = None
 
-SENDGRID_API_KEY = '<SENDGRID_API_KEY_HERE>'
-
-AE_LIVE_DATE = datetime(2016, 11, 1, 0, 0, 0, 0)
-
 class StudentRatingProperty(models.StudentPropertyEntity):
     """Entity to store the student's current rating of each component."""
 
@@ -178,164 +174,73 @@ class RatingHandler(utils.BaseRESTHandler):
         transforms.send_json_response(self, 200, thank_you_msg, {})
 
     def process_feedback_adaptive_encouragement(self, student, lesson_key):
-        additional_fields = student.additional_fields
         #check that the student in question has given permission for adaptive encouragement emails to be sent
-        sm = self.strip_name_from_additional_fields(additional_fields, 'SendMail')
+        sm = student.get_additional_field('SendMail')
         if sm == 'Yes':
             user_id = student.user_id
             enrolled_on = student.enrolled_on
-            email_address = self.strip_name_from_additional_fields(additional_fields, 'EmailAddress')
-            name = self.strip_name_from_additional_fields(additional_fields, 'GivenName')
+            email_address = student.get_additional_field('EmailAddress')
+            name = student.get_additional_field('GivenName')
             ae = models.AdaptiveEncouragement.get_by_user_id(user_id)
             if ae is None:
-                #send email for initial feedback, as no adaptive encouragement record exists for the student in the datastore
+                #this is the initial feedback, as no adaptive encouragement record exists for the student in the datastore
                 ae = models.AdaptiveEncouragement._add_new(user_id, 0, 0, 1, 0, None, None, None, False, False)
-                sent = self.send_feedback_ae_email(email_address, name, ae.feedback_count, lesson_key, enrolled_on)
-                if sent:
-                    ae.feedback_emails_sent = 1
-                    ae.first_ae_email_sent_in_week = now
             else:
-                now = datetime.now()
                 ae.feedback_count = ae.feedback_count + 1
-                if ae.first_ae_email_sent_in_week and ae.first_ae_email_sent_in_week < now-timedelta(days=7):
-                    #send email based on feedback number, and if the date we first sent an email is more than a week ago. Also reset the emails sent counter and update the date to now
-                    sent = self.send_feedback_ae_email(email_address, name, ae.feedback_count, lesson_key, enrolled_on)
-                    if sent:
-                        ae.feedback_emails_sent = 1
-                        ae.lesson_emails_sent = 0
-                        ae.first_ae_email_sent_in_week = now
-                elif ae.first_ae_email_sent_in_week and ae.first_ae_email_sent_in_week > now-timedelta(days=7) and ae.feedback_emails_sent<4:
-                    #send email if emails sent in week is less than 4
-                    sent = self.send_feedback_ae_email(email_address, name, ae.feedback_count, lesson_key, enrolled_on)
-                    if sent:
-                        ae.feedback_emails_sent = ae.feedback_emails_sent + 1
-                elif ae.first_ae_email_sent_in_week is None:
-                    #no date is set for first email in week, so just send the email, and set the emails sent counters up and the date to now
-                    sent = self.send_feedback_ae_email(email_address, name, ae.feedback_count, lesson_key, enrolled_on)
-                    if sent:
-                        ae.feedback_emails_sent = 1
-                        ae.lesson_emails_sent = 0
-                        ae.first_ae_email_sent_in_week = now
+
+            #work out the email this feedback gets, if any, and only queue it if the student has not had too many feedback emails this week.
+            #reserving it from the weekly quota is atomic, so parallel ratings cannot overshoot it
+            subject, body = self.get_feedback_ae_email_body(name, ae.feedback_count, lesson_key, enrolled_on)
+            queue = subject is not None and ae_quota.reserve(ae, ae_mail.COUNTER_FEEDBACK)
 
             ae.put()
 
+            if queue:
+                self.send_feedback_ae_email(user_id, email_address, name, subject, body)
+
     def process_feedback_with_narrative_adaptive_encouragement(self, student, lesson_key):
-        additional_fields = student.additional_fields
         #check that the student in question has given permission for adaptive encouragement emails to be sent
-        sm = self.strip_name_from_additional_fields(additional_fields, 'SendMail')
+        sm = student.get_additional_field('SendMail')
         if sm == 'Yes':
             user_id = student.user_id
             enrolled_on = student.enrolled_on
-            email_address = self.strip_name_from_additional_fields(additional_fields, 'EmailAddress')
-            name = self.strip_name_from_additional_fields(additional_fields, 'GivenName')
+            email_address = student.get_additional_field('EmailAddress')
+            name = student.get_additional_field('GivenName')
             ae = models.AdaptiveEncouragement.get_by_user_id(user_id)
             if ae is None:
-                #send email for initial feedback, as no adaptive encouragement record exists for the student in the datastore
+                #this is the initial feedback, as no adaptive encouragement record exists for the student in the datastore
                 ae = models.AdaptiveEncouragement._add_new(user_id, 0, 0, 0, 1, None, None, None, False, False)
-                sent = self.send_feedback_ae_email(email_address, name, ae.feedback_with_narrative_count, lesson_key, enrolled_on, True)
-                if sent:
-                    ae.feedback_emails_sent = 1
-                    ae.first_ae_email_sent_in_week = now
             else:
-                now = datetime.now()
                 ae.feedback_with_narrative_count = ae.feedback_with_narrative_count + 1
-                if ae.first_ae_email_sent_in_week and ae.first_ae_email_sent_in_week < now-timedelta(days=7):
-                    #send email based on feedback number, and if the date we first sent an email is more than a week ago. Also reset the emails sent counter and update the date to now
-                    sent = self.send_feedback_ae_email(email_address, name, ae.feedback_with_narrative_count, lesson_key, enrolled_on, True)
-                    if sent:
-                        ae.feedback_emails_sent = 1
-                        ae.lesson_emails_sent = 0
-                        ae.first_ae_email_sent_in_week = now
-                elif ae.first_ae_email_sent_in_week and ae.first_ae_email_sent_in_week > now-timedelta(days=7) and ae.feedback_emails_sent<4:
-                    #send email if emails sent in week is less than 4
-                    sent = self.send_feedback_ae_email(email_address, name, ae.feedback_with_narrative_count, lesson_key, enrolled_on, True)
-                    if sent:
-                        ae.feedback_emails_sent = ae.feedback_emails_sent + 1
-                elif ae.first_ae_email_sent_in_week is None:
-                    #no date is set for first email in week, so just send the email, and set the emails sent counters up and the date to now
-                    sent = self.send_feedback_ae_email(email_address, name, ae.feedback_with_narrative_count, lesson_key, enrolled_on, True)
-                    if sent:
-                        ae.feedback_emails_sent = 1
-                        ae.lesson_emails_sent = 0
-                        ae.first_ae_email_sent_in_week = now
+
+            #work out the email this feedback gets, if any, and only queue it if the student has not had too many feedback emails this week.
+            #reserving it from the weekly quota is atomic, so parallel ratings cannot overshoot it
+            subject, body = self.get_feedback_ae_email_body(name, ae.feedback_with_narrative_count, lesson_key, enrolled_on, True)
+            queue = subject is not None and ae_quota.reserve(ae, ae_mail.COUNTER_FEEDBACK)
 
             ae.put()
 
-    def send_feedback_ae_email(self, email_address, name, feedback_count, lesson_key, enrolled_on, has_narrative=False):
-        #sendgrid generic stuff
-        sent = False
-        subject, body = self.get_feedback_ae_email_body(name, feedback_count, lesson_key, enrolled_on, has_narrative)
-        if subject is not None and body is not None:
-            #send the email!
-            sg = sendgrid.SendGridClient(SENDGRID_API_KEY)
-            message = sendgrid.Mail()
-            message.set_subject(subject)
-            message.set_html(body)
-            #change the value for message.set_from to your from email address
-            message.set_from('<YOUR_FROM_EMAIL_ADDRESS_HERE>')
-            message.add_to(email_address)
-            status, msg = sg.send(message)
-            if status == 200:
-                sent = True
-
-        return sent
+            if queue:
+                self.send_feedback_ae_email(user_id, email_address, name, subject, body)
+
+    def send_feedback_ae_email(self, user_id, email_address, name, subject, body):
+        #queue the email for sending, so the rating post does not wait on sendgrid
+        return ae_mail.AdaptiveEncouragementMailQueue.enqueue(
+            user_id, email_address, subject, body, ae_mail.COUNTER_FEEDBACK,
+            subs={ae_mail.SUB_NAME: name or ''})
 
     def get_feedback_ae_email_body(self, name, feedback_count, lesson_key, enrolled_on, has_narrative=False):
         #work out which email body and subject line to return
-        hello = 'Hello {n},<br><br>'.format(n=name.encode('utf-8'))
+        #the course's feedback rules decide whether this feedback count gets an email, and what it says
+        match = ae_rules.get_plan(self.app_context).evaluate_feedback(feedback_count, has_narrative, enrolled_on)
+        if match is None:
+            return None, None
 
-        if has_narrative:
-            if feedback_count == 1:
-                text = 'Thanks very much for providing written feedback on Citizen Maths. We try to read all of it, and what learners tell us will help us improve Citizen Maths in the future. Please continue to provide it.'
-            elif feedback_count == 4:
-                text = 'Thanks very much for continuing to provide written feedback on Citizen Maths. As we mentioned previously we do try to read all of it, and, when we can, to act on it. Please continue to provide it.'
-            else:
-                return None, None
-        else:
-            if feedback_count == 2:
-                if enrolled_on > AE_LIVE_DATE:
-                    text = 'Thank you for beginning to give us feedback on Citizen Maths. By doing so you are helping us to understand the impact that Citizen Maths is having.'
-                else:
-                    return None, None
-            elif feedback_count == 8:
-                text = "Thanks for continuing to provide feedback on Citizen Maths. Whilst we don't look at every piece of feedback, we do analyse the feedback data overall. This helps us to understand the impact that Citizen Maths is having."
-            else:
-                fb_check = feedback_count - 8
-                if fb_check % 10 == 0:
-                    text = 'Thanks for continuing to provide feedback on Citizen Maths. Please continue to provide feedback. We really appreciate it.'
-                else:
-                    return None, None
-
-        regards = """<br><br>Regards,<br>
-                     Seb Schmoller<br>
-                     For the Citizen Maths Team<br>
-                     <a href='https://citizenmaths.com/' target='_blank'>https://citizenmaths.com/</a><br><br>"""
-
-        location = "<br>Notes<br>The course page this email was sent from was <a href='https://course.citizenmaths.com{lk}' target='_blank'>https://course.citizenmaths.com{lk}</a>. You may have got further on in Citizen Maths in the period before you opened this email.".format(lk=lesson_key)
+        #the body is rendered from a template compiled once per process; the name is left as a substitution tag so students sent the same email share one sendgrid request
+        body = ae_templates.render(ae_templates.LAYOUT_FEEDBACK, match.text, lesson_key=lesson_key)
 
-        footer = """<br><br>You've received this email because when you registered for Citizen Maths you opted to be sent occasional encouraging emails about your progress with Citizen Maths.
-                    <br><br>If you would like to unsubscribe to this service, please go to your profile page at <a href='https://course.citizenmaths.com/main/student/home' target='_blank'>https://course.citizenmaths.com/main/student/home</a> and click the \"Unsubscribe from encouragement emails\" button."""
+        return match.subject, body
 
-        bodylist = [hello, text, regards, location, footer]
-
-        body = ''.join(bodylist)
-
-        if has_narrative:
-            subject = 'Citizen Maths: your written feedback'
-        else:
-            subject = 'A message from the Citizen Maths team'
-
-        return subject, body
-
-    def strip_name_from_additional_fields(self, origin, token):
-        name = None
-        index = origin.find(token)
-        if index >= 0:
-            ss = origin[index:]
-            end_index = ss.find('"]')
-            if end_index > 0:
-                name = ss[len(token) + 4:end_index]
-        return name
 
 class RatingEventDataSource(data_sources.AbstractDbTableRestDataSource):
     """Data source to export all rating responses."""
@@ -0,0 +1,147 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the shards of the inactive users adaptive encouragement cron."""
+
+import datetime
+
+from models import models
+from models import transforms
+from modules.courses import ae_mail
+from modules.courses import lessons
+from tests.functional import actions
+
+from google.appengine.api import namespace_manager
+from google.appengine.ext import db
+
+ADMIN_EMAIL = 'admin@example.com'
+COURSE_NAME = 'main'
+NAMESPACE = 'ns_%s' % COURSE_NAME
+
+Shard = lessons.InactiveUsersAdaptiveEncouragementShard
+
+
+class InactiveUsersShardTests(actions.TestBase):
+
+    def setUp(self):
+        super(InactiveUsersShardTests, self).setUp()
+        self.app_context = actions.simple_add_course(
+            COURSE_NAME, ADMIN_EMAIL, 'Main')
+        self.old_namespace = namespace_manager.get_namespace()
+        namespace_manager.set_namespace(NAMESPACE)
+        self.transport = ae_mail.FakeTransport()
+        ae_mail.set_transport(self.transport)
+        ae_mail.AdaptiveEncouragementMailQueue.use_local_queue()
+        Shard.use_local_queue()
+        # Every student is known to gitkit.
+        self.swap(
+            lessons, 'get_email_mappings_by_user_ids',
+            lambda user_ids: [True] * len(user_ids))
+
+        self.now = datetime.datetime.now()
+        for user_id in ('u1', 'u2'):
+            self._add_student(user_id, self.now - datetime.timedelta(days=10))
+        # Enrolled too recently for the rule.
+        self._add_student('u3', self.now - datetime.timedelta(days=1))
+
+    def tearDown(self):
+        Shard.use_local_queue(False)
+        ae_mail.AdaptiveEncouragementMailQueue.use_local_queue(False)
+        ae_mail.set_transport(None)
+        namespace_manager.set_namespace(self.old_namespace)
+        super(InactiveUsersShardTests, self).tearDown()
+
+    def _add_student(self, user_id, enrolled_on):
+        models.Student(
+            key_name=user_id, user_id=user_id,
+            email='%s@example.com' % user_id, name=user_id, is_enrolled=True,
+            enrolled_on=enrolled_on,
+            additional_fields=transforms.dumps([
+                ['SendMail', 'Yes'],
+                ['EmailAddress', '%s@example.com' % user_id],
+                ['GivenName', user_id.upper()]])).put()
+
+    def _get_params(self, **overrides):
+        params = {
+            'run_started_on': self.now,
+            'property_name': 'enrolled_on',
+            'lower': None,
+            'upper': self.now - datetime.timedelta(days=7),
+            'rule_ids': ['inactive_not_started'],
+            'start_cursor': None,
+            'end_cursor': None,
+        }
+        params.update(overrides)
+        return params
+
+    def _deliver(self):
+        ae_mail.AdaptiveEncouragementMailQueue.drain_local_queue()
+        return sorted(sent[0] for sent in self.transport.sent)
+
+    def test_shard_queues_emails_for_its_inactive_students(self):
+        Shard.enqueue(self._get_params())
+
+        self.assertEqual(2, Shard.drain_local_queue(self.app_context))
+        self.assertEqual(
+            ['u1@example.com', 'u2@example.com'], self._deliver())
+        for email_address, unused_subject, body in self.transport.sent:
+            user_id = email_address.split('@')[0]
+            self.assertTrue(body.startswith('Hello %s,' % user_id.upper()))
+
+    def test_retried_shard_sends_nothing_twice(self):
+        Shard.enqueue(self._get_params())
+        Shard.enqueue(self._get_params())
+
+        self.assertEqual(2, Shard.drain_local_queue(self.app_context))
+        shard_name = Shard.get_shard_name(self._get_params())
+        shard = models.AdaptiveEncouragementCronShard.get_by_key_name(
+            shard_name)
+        self.assertEqual((2, 2), (shard.students, shard.emails))
+        self.assertEqual(
+            ['u1@example.com', 'u2@example.com'], self._deliver())
+
+    def test_shard_failing_after_queueing_its_emails_sends_them_once(self):
+        put = models.AdaptiveEncouragementCronShard.put.im_func
+        failures = []
+
+        def put_failing_once(shard):
+            if not failures:
+                failures.append(shard)
+                raise db.Timeout()
+            return put(shard)
+
+        self.swap(
+            models.AdaptiveEncouragementCronShard, 'put', put_failing_once)
+
+        params = self._get_params()
+        self.assertRaises(
+            db.Timeout, Shard.run_shard, self.app_context, params)
+        # The retry queues the same emails under the same task names.
+        self.assertEqual(2, Shard.run_shard(self.app_context, params))
+        self.assertEqual(0, Shard.run_shard(self.app_context, params))
+
+        self.assertEqual(
+            ['u1@example.com', 'u2@example.com'], self._deliver())
+
+    def test_shards_of_different_windows_have_different_names(self):
+        names = set([
+            Shard.get_shard_name(self._get_params()),
+            Shard.get_shard_name(self._get_params(
+                upper=self.now - datetime.timedelta(days=14))),
+            Shard.get_shard_name(self._get_params(
+                rule_ids=['inactive_started'])),
+            Shard.get_shard_name(self._get_params(
+                property_name='last_seen_on')),
+        ])
+        self.assertEqual(4, len(names))
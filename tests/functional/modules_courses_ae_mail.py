@@ -0,0 +1,186 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the queued delivery of adaptive encouragement emails."""
+
+import socket
+
+from models import models
+from modules.courses import ae_mail
+from tests.functional import actions
+
+from google.appengine.api import namespace_manager
+from google.appengine.ext import db
+
+ADMIN_EMAIL = 'admin@example.com'
+COURSE_NAME = 'main'
+NAMESPACE = 'ns_%s' % COURSE_NAME
+
+BODY = 'Hello %s, keep going.' % ae_mail.SUB_NAME
+OTHER_BODY = 'Hello %s, welcome back.' % ae_mail.SUB_NAME
+
+
+class _FailingTransport(ae_mail.FakeTransport):
+    """Raises a connection error for the requests of one subject."""
+
+    def __init__(self, failing_subject):
+        super(_FailingTransport, self).__init__()
+        self.failing_subject = failing_subject
+
+    def send(self, subject, body, recipients):
+        if subject == self.failing_subject:
+            self.requests.append((subject, body, list(recipients)))
+            raise socket.error('Connection reset by peer')
+        return super(_FailingTransport, self).send(subject, body, recipients)
+
+
+def _intent(user_id, name, subject='Subject', body=BODY):
+    return ae_mail.SendIntent(
+        user_id, '%s@example.com' % user_id, subject, body,
+        ae_mail.COUNTER_CRON_NOT_STARTED, subs={ae_mail.SUB_NAME: name})
+
+
+class AdaptiveEncouragementMailQueueTests(actions.TestBase):
+
+    def setUp(self):
+        super(AdaptiveEncouragementMailQueueTests, self).setUp()
+        actions.simple_add_course(COURSE_NAME, ADMIN_EMAIL, 'Main')
+        self.old_namespace = namespace_manager.get_namespace()
+        namespace_manager.set_namespace(NAMESPACE)
+        self.transport = ae_mail.FakeTransport()
+        ae_mail.set_transport(self.transport)
+        ae_mail.AdaptiveEncouragementMailQueue.use_local_queue()
+
+    def tearDown(self):
+        ae_mail.AdaptiveEncouragementMailQueue.use_local_queue(False)
+        ae_mail.set_transport(None)
+        namespace_manager.set_namespace(self.old_namespace)
+        super(AdaptiveEncouragementMailQueueTests, self).tearDown()
+
+    def _post_intents(self, intents, expect_errors=False):
+        return self.testapp.post(
+            ae_mail.AdaptiveEncouragementMailQueue.URL, {
+                'namespace': NAMESPACE,
+                'intents': ae_mail.SendIntent.to_payload(intents),
+            }, headers={'X-AppEngine-QueueName': 'default'},
+            expect_errors=expect_errors)
+
+    def _get_queued_user_ids(self):
+        return [
+            [intent.user_id for intent in intents]
+            for unused_namespace, intents, unused_record_only
+            in ae_mail.AdaptiveEncouragementMailQueue._LOCAL_QUEUE]
+
+    def _is_recorded(self, user_id):
+        ae = models.AdaptiveEncouragement.get_by_key_name(user_id)
+        return bool(ae and ae.cron_inactive_not_started_email)
+
+    def test_intents_sharing_a_body_are_sent_in_one_request(self):
+        ae_mail.AdaptiveEncouragementMailQueue.enqueue_intents([
+            _intent('u1', 'Ann'),
+            _intent('u2', 'Bob'),
+            _intent('u3', 'Cat', subject='Other', body=OTHER_BODY)])
+
+        self.assertEqual(
+            3, ae_mail.AdaptiveEncouragementMailQueue.drain_local_queue())
+        self.assertEqual(2, len(self.transport.requests))
+        subject, body, recipients = self.transport.requests[0]
+        self.assertEqual(('Subject', BODY), (subject, body))
+        self.assertEqual(
+            ['u1@example.com', 'u2@example.com'],
+            [email_address for email_address, unused_subs in recipients])
+        subject, body, recipients = self.transport.requests[1]
+        self.assertEqual(('Other', OTHER_BODY), (subject, body))
+        self.assertEqual(1, len(recipients))
+
+    def test_name_is_substituted_per_recipient(self):
+        ae_mail.AdaptiveEncouragementMailQueue.enqueue_intents([
+            _intent('u1', 'Ann'), _intent('u2', 'Bob'), _intent('u3', '')])
+        ae_mail.AdaptiveEncouragementMailQueue.drain_local_queue()
+
+        self.assertEqual([
+            ('u1@example.com', 'Subject', 'Hello Ann, keep going.'),
+            ('u2@example.com', 'Subject', 'Hello Bob, keep going.'),
+            ('u3@example.com', 'Subject', 'Hello , keep going.'),
+        ], self.transport.sent)
+
+    def test_sent_cron_emails_are_recorded(self):
+        ae_mail.AdaptiveEncouragementMailQueue.enqueue_intents([
+            _intent('u1', 'Ann')])
+        ae_mail.AdaptiveEncouragementMailQueue.drain_local_queue()
+
+        self.assertTrue(self._is_recorded('u1'))
+
+    def test_partial_failure_requeues_only_the_unsent_intents(self):
+        transport = _FailingTransport('Other')
+        ae_mail.set_transport(transport)
+
+        response = self._post_intents([
+            _intent('u1', 'Ann'),
+            _intent('u2', 'Bob'),
+            _intent('u3', 'Cat', subject='Other', body=OTHER_BODY)])
+
+        self.assertEqual(200, response.status_int)
+        self.assertEqual(
+            ['u1@example.com', 'u2@example.com'],
+            [sent[0] for sent in transport.sent])
+        self.assertTrue(self._is_recorded('u1'))
+        self.assertTrue(self._is_recorded('u2'))
+        self.assertFalse(self._is_recorded('u3'))
+        self.assertEqual([['u3']], self._get_queued_user_ids())
+
+        # Delivering the re-enqueued task sends the rest, and only the rest.
+        transport.failing_subject = None
+        self.assertEqual(
+            1, ae_mail.AdaptiveEncouragementMailQueue.drain_local_queue())
+        self.assertEqual(
+            ['u1@example.com', 'u2@example.com', 'u3@example.com'],
+            [sent[0] for sent in transport.sent])
+        self.assertTrue(self._is_recorded('u3'))
+
+    def test_failure_of_every_request_raises_for_a_retry(self):
+        ae_mail.set_transport(_FailingTransport('Subject'))
+
+        response = self._post_intents(
+            [_intent('u1', 'Ann')], expect_errors=True)
+
+        self.assertEqual(500, response.status_int)
+        self.assertEqual([], self._get_queued_user_ids())
+
+    def test_sent_intents_failing_to_record_are_recorded_not_resent(self):
+        record_sent = ae_mail.AdaptiveEncouragementMailQueue._record_sent.im_func
+        failures = []
+
+        def record_sent_failing_once(cls, intents):
+            if not failures:
+                failures.append(intents)
+                raise db.Timeout()
+            return record_sent(cls, intents)
+
+        self.swap(
+            ae_mail.AdaptiveEncouragementMailQueue, '_record_sent',
+            classmethod(record_sent_failing_once))
+
+        response = self._post_intents([_intent('u1', 'Ann')])
+
+        self.assertEqual(200, response.status_int)
+        self.assertFalse(self._is_recorded('u1'))
+        queue = ae_mail.AdaptiveEncouragementMailQueue._LOCAL_QUEUE
+        self.assertEqual(1, len(queue))
+        self.assertTrue(queue[0][2])
+
+        self.assertEqual(
+            0, ae_mail.AdaptiveEncouragementMailQueue.drain_local_queue())
+        self.assertEqual(1, len(self.transport.sent))
+        self.assertTrue(self._is_recorded('u1'))
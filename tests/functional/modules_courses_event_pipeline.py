@@ -0,0 +1,150 @@
+# Copyright 2016 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the buffered events pipeline."""
+
+import datetime
+
+from models import models
+from models import progress
+from models import transforms
+from modules.courses import lessons
+from tests.functional import actions
+
+from google.appengine.api import namespace_manager
+from google.appengine.ext import db
+
+ADMIN_EMAIL = 'admin@example.com'
+COURSE_NAME = 'main'
+NAMESPACE = 'ns_%s' % COURSE_NAME
+SOURCE = 'attempt-activity'
+
+Pipeline = lessons.EventPipeline
+
+
+class EventPipelineTests(actions.TestBase):
+
+    def setUp(self):
+        super(EventPipelineTests, self).setUp()
+        self.app_context = actions.simple_add_course(
+            COURSE_NAME, ADMIN_EMAIL, 'Main')
+        self.old_namespace = namespace_manager.get_namespace()
+        namespace_manager.set_namespace(NAMESPACE)
+        self.swap(Pipeline, '_FLUSHER_RUNNING', None)
+        self.swap(Pipeline, '_BUFFERS', {})
+        self.swap(Pipeline, '_BUFFER_BYTES', 0)
+        self.swap(Pipeline, '_BUFFER_STARTED', None)
+        Pipeline.use_local_queue()
+
+        # Every event is a progress event; put_events() records what each
+        # student is given instead of writing progress.
+        self.swap(
+            lessons, 'get_progress_event',
+            lambda course, tracker, source, payload: source)
+        self.applied = []
+        self.failing_user_ids = set()
+
+        def put_events(unused_tracker, student, events):
+            self._put_events(student, events)
+
+        self.swap(
+            progress.UnitLessonCompletionTracker, 'put_events', put_events)
+
+        self.now = datetime.datetime.now()
+        for user_id in ('u1', 'u2', 'u3'):
+            models.Student(
+                key_name=user_id, user_id=user_id,
+                email='%s@example.com' % user_id, name=user_id,
+                is_enrolled=True).put()
+
+    def tearDown(self):
+        Pipeline.use_local_queue(False)
+        namespace_manager.set_namespace(self.old_namespace)
+        super(EventPipelineTests, self).tearDown()
+
+    def _put_events(self, student, events):
+        if student.user_id in self.failing_user_ids:
+            self.failing_user_ids.discard(student.user_id)
+            raise db.Timeout()
+        self.applied.append((student.user_id, events))
+
+    def _get_events(self):
+        recorded_on = self.now.strftime(transforms.ISO_8601_DATETIME_FORMAT)
+        return [
+            [user_id, SOURCE, '{}', recorded_on]
+            for user_id in ('u1', 'u2', 'u1', 'u3')]
+
+    def _get_applied_user_ids(self):
+        return [user_id for user_id, unused_events in self.applied]
+
+    def _get_students_done(self, batch_id):
+        return models.EventPipelineBatch.get_by_key_name(
+            batch_id).students_done
+
+    def test_batch_recorded_twice_is_recorded_once(self):
+        events = self._get_events()
+        self.assertEqual(
+            4, Pipeline.record_batch(self.app_context, 'b1', events))
+        Pipeline.record_batch(self.app_context, 'b1', events)
+
+        self.assertEqual(4, models.EventEntity.all().count())
+        self.assertEqual([
+            ('u1', [SOURCE, SOURCE]), ('u2', [SOURCE]), ('u3', [SOURCE]),
+        ], self.applied)
+        self.assertEqual(3, self._get_students_done('b1'))
+
+    def test_replay_resumes_after_the_last_checkpoint(self):
+        self.swap(Pipeline, 'CHECKPOINT_STUDENTS', 1)
+        self.failing_user_ids.add('u2')
+        events = self._get_events()
+
+        self.assertRaises(
+            db.Timeout, Pipeline.record_batch, self.app_context, 'b1', events)
+        self.assertEqual(1, self._get_students_done('b1'))
+        Pipeline.record_batch(self.app_context, 'b1', events)
+
+        self.assertEqual(4, models.EventEntity.all().count())
+        self.assertEqual(['u1', 'u2', 'u3'], self._get_applied_user_ids())
+        self.assertEqual(3, self._get_students_done('b1'))
+
+    def test_replay_applies_again_the_students_after_the_checkpoint(self):
+        self.failing_user_ids.add('u2')
+        events = self._get_events()
+
+        self.assertRaises(
+            db.Timeout, Pipeline.record_batch, self.app_context, 'b1', events)
+        self.assertEqual(0, self._get_students_done('b1'))
+        Pipeline.record_batch(self.app_context, 'b1', events)
+
+        self.assertEqual(4, models.EventEntity.all().count())
+        self.assertEqual(
+            ['u1', 'u1', 'u2', 'u3'], self._get_applied_user_ids())
+        self.assertEqual(3, self._get_students_done('b1'))
+
+    def test_appended_events_are_recorded_when_drained(self):
+        for user_id in ('u1', 'u2'):
+            self.assertTrue(Pipeline.append(models.EventEntity(
+                source=SOURCE, user_id=user_id, data='{}',
+                recorded_on=self.now)))
+
+        self.assertEqual(2, Pipeline.drain_local_queue(self.app_context))
+        self.assertEqual(2, models.EventEntity.all().count())
+        self.assertEqual(['u1', 'u2'], self._get_applied_user_ids())
+
+    def test_append_declines_events_without_a_flusher(self):
+        self.swap(Pipeline, '_FLUSHER_RUNNING', False)
+
+        self.assertFalse(Pipeline.append(models.EventEntity(
+            source=SOURCE, user_id='u1', data='{}', recorded_on=self.now)))
+        self.assertEqual({}, Pipeline._BUFFERS)